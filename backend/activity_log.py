@@ -0,0 +1,137 @@
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import models
+from metrics import registry
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_LOG_BATCH_SIZE = int(os.environ.get("ACTIVITY_LOG_BATCH_SIZE", 200))
+ACTIVITY_LOG_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_LOG_FLUSH_INTERVAL", 1.0))
+ACTIVITY_LOG_MAX_QUEUE = int(os.environ.get("ACTIVITY_LOG_MAX_QUEUE", 100000))
+
+
+class ActivityLogWriter:
+    """
+    Write-behind logger for ActivityLog rows.
+    Requests only enqueue an event; a background thread turns the queue into bulk
+    INSERTs whenever batch_size events are waiting or flush_interval seconds have
+    passed, whichever comes first. stop() drains whatever is still queued.
+    """
+
+    def __init__(self, session_factory=SessionLocal, batch_size=ACTIVITY_LOG_BATCH_SIZE,
+                 flush_interval=ACTIVITY_LOG_FLUSH_INTERVAL, max_queue=ACTIVITY_LOG_MAX_QUEUE):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.flushed_total = 0
+        self.flush_count = 0
+        self.failed_total = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # Anything enqueued after the thread exited is flushed here
+        self._flush(self._drain(None))
+
+    def log(self, user_id, activity_type):
+        event = {"user_id": user_id, "activity_type": activity_type, "timestamp": datetime.now()}
+        if self._thread is None:
+            # Writer not running (e.g. scripts and tests): fall back to a direct insert
+            self._flush([event])
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # Never block a request on the log; write this one through instead
+            self._flush([event])
+
+    def _drain(self, limit):
+        batch = []
+        while limit is None or len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            batch = []
+            while len(batch) < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+                except queue.Empty:
+                    continue
+                batch.extend(self._drain(self.batch_size - len(batch)))
+            self._flush(batch)
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        started = time.perf_counter()
+        db = self.session_factory()
+        try:
+            db.bulk_insert_mappings(models.ActivityLog, batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                self.failed_total += len(batch)
+            logger.exception("Failed to write %d activity log rows", len(batch))
+            return
+        finally:
+            db.close()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.flushed_total += len(batch)
+            self.flush_count += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "queue_depth": self._queue.qsize(),
+                "flushed_total": self.flushed_total,
+                "failed_total": self.failed_total,
+                "flush_count": self.flush_count,
+                "last_flush_seconds": self.last_flush_seconds,
+                "max_flush_seconds": self.max_flush_seconds,
+            }
+
+
+activity_writer = ActivityLogWriter()
+registry.gauge(
+    "activity_log_queue_depth", "Activity log events waiting to be flushed",
+    callback=lambda: activity_writer.stats()["queue_depth"]
+)
+registry.gauge(
+    "activity_log_last_flush_seconds", "Duration of the most recent activity log bulk insert",
+    callback=lambda: activity_writer.stats()["last_flush_seconds"]
+)
@@ -1,26 +1,150 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import io
 from PIL import Image
 import time
+import threading
 import re
+import secrets
+from compact_image import compact_upload, DEFAULT_MAX_EDGE, DEFAULT_QUALITY
 
 
 # FastAPI backend URL
 API_URL = "http://localhost:8000"  # Update this if your FastAPI app is running on a different port
 
+# Read endpoints are cached across Streamlit reruns for this many seconds;
+# a mutation (upload, predict, comment, logout) clears the reads it affects
+READ_CACHE_TTL = 30
+# Uploaded images never change, so their bytes can be kept much longer
+IMAGE_CACHE_TTL = 3600
+IMAGE_CACHE_SIZE = 512
+IMAGE_FETCH_WORKERS = 8
+REQUEST_TIMEOUT = 30
+
+@st.cache_resource
+def get_http_session():
+    # One keep-alive session shared by every rerun and browser session
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=IMAGE_FETCH_WORKERS * 2,
+        max_retries=Retry(total=2, backoff_factor=0.2, allowed_methods=["GET"])
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_validator_cache():
+    # (path, token) -> (ETag, payload) of the last full response, so an expired
+    # or cleared cached_get entry is revalidated with If-None-Match instead of
+    # downloading an unchanged payload again
+    return {}
+
+VALIDATOR_CACHE_SIZE = 256
+
+@st.cache_resource
+def get_read_keys():
+    # (path, token) arguments cached_get has been called with, so a write can
+    # clear just the entries it affects
+    return set(), threading.Lock()
+
+@st.cache_data(ttl=READ_CACHE_TTL, show_spinner=False)
+def cached_get(path, token):
+    # Raises on failure, and Streamlit does not cache exceptions, so errors are retried on the next rerun
+    read_keys, lock = get_read_keys()
+    with lock:
+        read_keys.add((path, token))
+    validators = get_validator_cache()
+    key = (path, token)
+    cached = validators.get(key)
+    headers = {"Authorization": f"Bearer {token}"}
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+    response = get_http_session().get(f"{API_URL}{path}", headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304 and cached is not None:
+        return cached[1]
+    response.raise_for_status()
+    payload = response.json()
+    etag = response.headers.get("ETag")
+    if etag:
+        validators.pop(key, None)
+        validators[key] = (etag, payload)
+        while len(validators) > VALIDATOR_CACHE_SIZE:
+            validators.pop(next(iter(validators)), None)
+    return payload
+
+# Reads a write can change: the activity feeds, plus what each write touches
+ACTIVITY_PATHS = ("/activity-logs", "/user/")
+
+def invalidate_read_cache(token, *path_prefixes):
+    # Clear this user's cached reads under the given path prefixes (all of them
+    # when none are given); other users' entries and the image cache are kept
+    # and pick the change up within READ_CACHE_TTL
+    read_keys, lock = get_read_keys()
+    with lock:
+        stale = [key for key in read_keys
+                 if key[1] == token and (not path_prefixes or key[0].startswith(path_prefixes))]
+        read_keys.difference_update(stale)
+    for path, key_token in stale:
+        cached_get.clear(path, key_token)
+
+def script_thread_pool(max_workers):
+    # Worker threads inherit the script context so cached helpers such as
+    # get_http_session() work there without "missing ScriptRunContext" warnings
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    )
+
+@st.cache_data(ttl=IMAGE_CACHE_TTL, show_spinner=False, max_entries=IMAGE_CACHE_SIZE)
+def fetch_image_bytes(filename):
+    # Cached per image; a failed download raises, and Streamlit does not cache
+    # exceptions, so it is retried on the next rerun instead of hidden for IMAGE_CACHE_TTL
+    response = get_http_session().get(f"{API_URL}/image/{filename}", timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+def fetch_images(filenames):
+    # Download a page of gallery images in parallel over the pooled session;
+    # a failed download yields None for that slot
+    def fetch(filename):
+        try:
+            return fetch_image_bytes(filename)
+        except requests.exceptions.RequestException:
+            return None
+    with script_thread_pool(IMAGE_FETCH_WORKERS) as executor:
+        return list(executor.map(fetch, filenames))
+
+def show_image(image_bytes, filename, **kwargs):
+    # Fall back to letting the browser load the URL if the prefetch failed
+    st.image(image_bytes if image_bytes is not None else f"{API_URL}/image/{filename}", **kwargs)
+
+def show_alternatives(prediction):
+    # Runner-up classes, when the API has the full probability vector
+    alternatives = (prediction.get('top_k') or [])[1:]
+    if alternatives:
+        st.write("Also possible: " + ", ".join(f"{item['disease']} ({item['probability']:.2f})" for item in alternatives))
+
 # Helper functions for API calls
 def register_user(username, email, password):
-    response = requests.post(
+    response = get_http_session().post(
         f"{API_URL}/register",
-        json={"username": username, "email": email, "password": password}
+        json={"username": username, "email": email, "password": password},
+        timeout=REQUEST_TIMEOUT
     )
     return response.json()
 
 def login_user(username, password):
-    response = requests.post(
+    response = get_http_session().post(
         f"{API_URL}/login",
-        json={"username": username, "password": password}
+        json={"username": username, "password": password},
+        timeout=REQUEST_TIMEOUT
     )
     if response.status_code == 200:
         return response.json()
@@ -29,7 +153,7 @@ def login_user(username, password):
         return None
 
 def check_user_exists(username):
-    response = requests.get(f"{API_URL}/check-user/{username}")
+    response = get_http_session().get(f"{API_URL}/check-user/{username}", timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
         return response.json().get('exists', False)
     return False
@@ -77,33 +201,150 @@ def login_page():
 
 
 
-def upload_image(file, token):
-    img_byte_arr = io.BytesIO()
-    image = Image.open(file)
-    image.save(img_byte_arr, format=image.format)
-    img_byte_arr = img_byte_arr.getvalue()
+def prepare_upload(name, data, content_type, send_original=False, max_edge=DEFAULT_MAX_EDGE, image_format="JPEG", quality=DEFAULT_QUALITY):
+    # Returns the (filename, bytes, content type) triple to post to /upload
+    if send_original:
+        # Opt-in: send the file exactly as selected
+        return name, data, content_type
+    # Downscale and re-encode before sending; this is by far the largest
+    # latency cost on slow mobile links
+    return compact_upload(name, data, content_type, max_edge, image_format, quality)
 
-    files = {"file": (file.name, img_byte_arr, file.type)}
+# The _post_* helpers raise instead of calling st.error so they can also run on
+# the batch upload worker threads, which have no Streamlit script context
+def _post_upload(upload, token, idempotency_key=None):
     headers = {"Authorization": f"Bearer {token}"}
-    
+    if idempotency_key:
+        # Lets the backend return the original upload if a retry repeats one that already succeeded
+        headers["Idempotency-Key"] = idempotency_key
+    response = get_http_session().post(f"{API_URL}/upload", files={"file": upload}, headers=headers, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def _post_predict(image_id, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    response = get_http_session().post(f"{API_URL}/predict", json={"image_id": image_id}, headers=headers, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def upload_image(file, token, **upload_options):
+    upload = prepare_upload(file.name, file.getvalue(), file.type, **upload_options)
     try:
-        response = requests.post(f"{API_URL}/upload", files=files, headers=headers)
-        response.raise_for_status()
-        return response.json()
+        result = _post_upload(upload, token)
+        invalidate_read_cache(token, "/images", *ACTIVITY_PATHS)
+        return result
     except requests.exceptions.RequestException as e:
         st.error(f"Error during image upload: {str(e)}")
         return None
 
 def predict_disease(image_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
     try:
-        response = requests.post(f"{API_URL}/predict", json={"image_id": image_id}, headers=headers)
-        response.raise_for_status()
-        return response.json()
+        result = _post_predict(image_id, token)
+        invalidate_read_cache(token, "/images", "/all-predictions", f"/image-details/{image_id}", *ACTIVITY_PATHS)
+        return result
     except requests.exceptions.RequestException as e:
         st.error(f"Error during prediction request: {str(e)}")
         return None
 
+# Kept below the server's PREDICT_MAX_PENDING_PER_USER (8) so the batch never
+# overflows its own fair-queue backlog
+BATCH_UPLOAD_WORKERS = 6
+BATCH_MAX_ATTEMPTS = 3
+# Waiting out 429/503 (rate limit, draining server) costs no attempt; a file
+# only gives up after waiting this long in total
+BATCH_MAX_THROTTLED_SECONDS = 300
+
+def classify_file(name, data, content_type, token, upload_options, progress):
+    """
+    Upload then predict one file on a worker thread, retrying with backoff.
+    Each file's prediction starts as soon as its own upload finishes, so
+    predictions overlap with the remaining uploads. progress[name] is updated
+    with the current stage for the UI thread to display.
+    """
+    started = time.perf_counter()
+    image_id = None
+    error = None
+    idempotency_key = secrets.token_hex(16)
+    attempt = 1
+    throttled_for = 0.0
+    while attempt <= BATCH_MAX_ATTEMPTS:
+        try:
+            if image_id is None:
+                progress[name] = "compressing" if attempt == 1 else f"retrying upload ({attempt})"
+                upload = prepare_upload(name, data, content_type, **upload_options)
+                progress[name] = "uploading" if attempt == 1 else f"retrying upload ({attempt})"
+                image_id = _post_upload(upload, token, idempotency_key)['image']['id']
+            progress[name] = "predicting" if attempt == 1 else f"retrying prediction ({attempt})"
+            prediction = _post_predict(image_id, token)
+            progress[name] = "done"
+            return {"file": name, "status": "done", "image_id": image_id, "disease": prediction['disease'],
+                    "confidence": round(prediction['confidence'], 4), "seconds": round(time.perf_counter() - started, 2), "error": ""}
+        except (requests.exceptions.RequestException, KeyError, OSError) as e:
+            error = str(e)
+            delay = 0.5 * 2 ** (attempt - 1)
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code in (429, 503):
+                # Rate limited or the server is draining: wait as long as it
+                # asks and try the same attempt again
+                delay = max(delay, float(response.headers.get('Retry-After', delay)))
+                if throttled_for + delay <= BATCH_MAX_THROTTLED_SECONDS:
+                    throttled_for += delay
+                    progress[name] = f"waiting {delay:.0f}s (rate limited)"
+                    time.sleep(delay)
+                    continue
+            attempt += 1
+            if attempt <= BATCH_MAX_ATTEMPTS:
+                time.sleep(delay)
+    progress[name] = "failed"
+    return {"file": name, "status": "failed", "image_id": image_id, "disease": None,
+            "confidence": None, "seconds": round(time.perf_counter() - started, 2), "error": error}
+
+def batch_upload(uploaded_files, upload_options):
+    # Results persist in session_state so reruns (sorting the table, retrying)
+    # don't re-upload files that already finished
+    batch_key = tuple((f.name, f.size) for f in uploaded_files)
+    batch = st.session_state.get('batch_upload')
+    if batch is None or batch['key'] != batch_key:
+        batch = {'key': batch_key, 'results': {}}
+        st.session_state['batch_upload'] = batch
+    results = batch['results']
+
+    # Keys are made unique so two photos with the same name don't collide
+    files = {f"{idx + 1}. {f.name}": f for idx, f in enumerate(uploaded_files)}
+    retry = any(r['status'] == 'failed' for r in results.values()) and st.button("Retry failed")
+    todo = [key for key in files if key not in results or (retry and results[key]['status'] == 'failed')]
+
+    if todo:
+        progress = {key: "queued" for key in todo}
+        progress_bar = st.progress(0.0, text=f"Classifying {len(todo)} images...")
+        status_table = st.empty()
+        started = time.perf_counter()
+        with script_thread_pool(BATCH_UPLOAD_WORKERS) as executor:
+            pending = {
+                executor.submit(classify_file, key, files[key].getvalue(), files[key].type,
+                                st.session_state['token'], upload_options, progress): key
+                for key in todo
+            }
+            while pending:
+                done, _ = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+                finished = len(todo) - len(pending)
+                progress_bar.progress(finished / len(todo), text=f"{finished}/{len(todo)} images classified")
+                status_table.dataframe([{"file": key, "stage": stage} for key, stage in progress.items()],
+                                       use_container_width=True, hide_index=True)
+        status_table.empty()
+        invalidate_read_cache(st.session_state['token'], "/images", "/all-predictions", "/image-details/", *ACTIVITY_PATHS)
+        st.success(f"Processed {len(todo)} images in {time.perf_counter() - started:.1f}s")
+
+    ordered = [results[key] for key in files if key in results]
+    failed = sum(r['status'] == 'failed' for r in ordered)
+    if failed:
+        st.warning(f"{failed} of {len(ordered)} images failed. Use 'Retry failed' to try them again.")
+    # st.dataframe columns are sortable by clicking their headers
+    st.dataframe(ordered, use_container_width=True, hide_index=True,
+                 column_order=["file", "status", "disease", "confidence", "image_id", "seconds", "error"])
+
 def validate_email(email):
     # Basic email validation regex
     email_regex = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -160,47 +401,30 @@ def register_page():
 
 
 def get_user_details(user_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/users/{user_id}", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get(f"/users/{user_id}", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch user details.")
         return None
 
 def get_images(token, skip=0, limit=100):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/images?skip={skip}&limit={limit}", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get(f"/images?skip={skip}&limit={limit}", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch images.")
         return None
 
-def get_image_details(image_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/images/{image_id}", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        st.error("Failed to fetch image details.")
-        return None
-
 def get_activity_logs(token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/activity-logs", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get("/activity-logs", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch activity logs.")
         return None
 
 def get_user_activity(user_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/user/{user_id}/activity", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get(f"/user/{user_id}/activity", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch user activity.")
         return None
 
@@ -211,38 +435,46 @@ def post_comment(image_id, user_id, comment_text, token):
         "user_id": user_id,
         "comment_text": comment_text
     }
-    response = requests.post(f"{API_URL}/comment", json=data, headers=headers)
+    response = get_http_session().post(f"{API_URL}/comment", json=data, headers=headers, timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
+        invalidate_read_cache(token, f"/comments/{image_id}", f"/image-details/{image_id}", *ACTIVITY_PATHS)
         return response.json()
     else:
         st.error("Failed to post comment.")
         return None
 
 def get_comments(image_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/comments/{image_id}", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get(f"/comments/{image_id}", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch comments.")
         return None
 
+def search_comments(query, token, page=1, page_size=20):
+    # Results change with every new comment, so they bypass the validator cache
+    try:
+        response = get_http_session().get(
+            f'{API_URL}/comments/search', params={'q': query, 'page': page, 'page_size': page_size},
+            headers={"Authorization": f"Bearer {token}"}, timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException:
+        st.error("Failed to search comments.")
+        return None
+
 
 def get_all_predictions(token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/all-predictions", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get("/all-predictions", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch predictions.")
         return None
 
 def get_image_details(image_id, token):
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{API_URL}/image-details/{image_id}", headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return cached_get(f"/image-details/{image_id}", token)
+    except requests.exceptions.RequestException:
         st.error("Failed to fetch image details.")
         return None
     
@@ -250,12 +482,13 @@ def get_image_details(image_id, token):
 def logout():
     if 'token' in st.session_state:
         try:
-            response = requests.post(f'{API_URL}/logout', params={'token': st.session_state.token})
+            response = get_http_session().post(f'{API_URL}/logout', params={'token': st.session_state.token}, timeout=REQUEST_TIMEOUT)
             
             #st.write(f"Response status code: {response.status_code}")
             #st.write(f"Response content: {response.text}")
             
             if response.status_code == 200:
+                invalidate_read_cache(st.session_state.token)
                 st.session_state.clear()
                 st.success("Logged out successfully")
                 time.sleep(1)
@@ -274,7 +507,7 @@ def main_page():
     st.title("Plant Disease Detection")
     st.write(f"Welcome, {st.session_state['user']['username']}!")
     
-    menu = ["Upload Image", "My Images", "All Predictions", "Activity Logs", "User Profile"]
+    menu = ["Upload Image", "My Images", "All Predictions", "Search Comments", "Activity Logs", "User Profile"]
     choice = st.sidebar.selectbox("Menu", menu)
 
     if choice == "All Predictions":
@@ -293,11 +526,13 @@ def main_page():
             end_idx = start_idx + items_per_page
             page_predictions = predictions[start_idx:end_idx]
 
+            # Fetch the whole page of thumbnails concurrently before laying it out
+            page_images = fetch_images(tuple(pred['filename'] for pred in page_predictions))
+
             col1, col2, col3 = st.columns(3)
-            for idx, pred in enumerate(page_predictions):
+            for idx, (pred, image_bytes) in enumerate(zip(page_predictions, page_images)):
                 with col1 if idx % 3 == 0 else col2 if idx % 3 == 1 else col3:
-                    image_url = f"{API_URL}/image/{pred['filename']}"
-                    st.image(image_url, caption=f"Image {pred['id']}", use_column_width=True)
+                    show_image(image_bytes, pred['filename'], caption=f"Image {pred['id']}", use_column_width=True)
                     if st.button(f"View Details {pred['id']}"):
                         st.session_state['selected_image'] = pred['id']
                         st.rerun()
@@ -313,11 +548,12 @@ def main_page():
                 details = get_image_details(st.session_state['selected_image'], st.session_state['token'])
                 if details:
                     st.subheader(f"Details for Image {details['id']}")
-                    st.image(f"{API_URL}/image/{details['filename']}", use_column_width=True)
+                    show_image(fetch_images((details['filename'],))[0], details['filename'], use_column_width=True)
                     st.write(f"Uploaded at: {details['uploaded_at']}")
                     if details['prediction']:
                         st.write(f"Prediction: {details['prediction']['disease']}")
                         st.write(f"Confidence: {details['prediction']['confidence']:.2f}")
+                        show_alternatives(details['prediction'])
                         st.write(f"Predicted at: {details['prediction']['predicted_at']}")
 
                     st.subheader("Comments")
@@ -339,13 +575,26 @@ def main_page():
                 st.error(f"Failed to fetch image details: {str(e)}")
     
     elif choice == "Upload Image":
-        uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
-        if uploaded_file is not None:
+        with st.expander("Upload settings"):
+            send_original = st.checkbox("Upload original file (no resizing or re-encoding)", value=False)
+            max_edge = st.select_slider("Maximum image edge (px)", options=[512, 768, 1024, 1536, 2048], value=DEFAULT_MAX_EDGE, disabled=send_original)
+            image_format = st.radio("Format", ["JPEG", "WEBP"], horizontal=True, disabled=send_original)
+            quality = st.slider("Quality", min_value=50, max_value=95, value=DEFAULT_QUALITY, disabled=send_original)
+
+        upload_options = {} if send_original else {"max_edge": max_edge, "image_format": image_format, "quality": quality}
+        upload_options["send_original"] = send_original
+
+        uploaded_files = st.file_uploader("Choose images...", type=["jpg", "jpeg", "png", "webp"], accept_multiple_files=True)
+        uploaded_file = uploaded_files[0] if len(uploaded_files) == 1 else None
+        if len(uploaded_files) > 1:
+            # Several photos: upload and classify them concurrently
+            batch_upload(uploaded_files, upload_options)
+        elif uploaded_file is not None:
             image = Image.open(uploaded_file)
             st.image(image, caption='Uploaded Image.', use_column_width=True)
             st.write("Analyzing image...")
             
-            upload_result = upload_image(uploaded_file, st.session_state['token'])
+            upload_result = upload_image(uploaded_file, st.session_state['token'], **upload_options)
             if upload_result and 'image' in upload_result and 'id' in upload_result['image']:
                 image_id = upload_result['image']['id']
                 
@@ -353,6 +602,7 @@ def main_page():
                 if prediction and 'disease' in prediction and 'confidence' in prediction:
                     st.success(f"Prediction: {prediction['disease']}")
                     st.success(f"Confidence: {prediction['confidence']:.2f}")
+                    show_alternatives(prediction)
                     
                     # Add comment section
                     comment = st.text_area("Add a comment about this prediction:")
@@ -374,13 +624,30 @@ def main_page():
     elif choice == "My Images":
         images = get_images(st.session_state['token'])
         if images:
-            for image in images:
+            image_bytes_list = fetch_images(tuple(image['filename'] for image in images))
+            for image, image_bytes in zip(images, image_bytes_list):
                 st.subheader(f"Image ID: {image['id']}")
                 st.write(f"Uploaded at: {image['uploaded_at']}")
-                image_url = f"{API_URL}/image/{image['filename']}"
-                st.image(image_url, caption=f"Image {image['id']}", use_column_width=True)
+                show_image(image_bytes, image['filename'], caption=f"Image {image['id']}", use_column_width=True)
         else:
             st.write("No images found.")
+    elif choice == "Search Comments":
+        st.subheader("Search Comments")
+        query = st.text_input("Words to search for, e.g. leaf curl")
+        if query:
+            page = st.number_input("Page", min_value=1, value=1, step=1)
+            results = search_comments(query, st.session_state['token'], page=page)
+            if results:
+                total = f"{results['total']}+" if results['total_is_estimate'] else results['total']
+                st.write(f"{total} matching comments")
+                for item in results['items']:
+                    comment = item['comment']
+                    st.markdown(f"**{comment['user']['username']}** on image {comment['image_id']}: {comment['comment_text']}")
+                    if item['prediction']:
+                        st.caption(f"Prediction: {item['prediction']['disease']} ({item['prediction']['confidence']:.2f}), "
+                                   f"uploaded {item['uploaded_at']}")
+                    else:
+                        st.caption(f"Not predicted yet, uploaded {item['uploaded_at']}")
     elif choice == "Activity Logs":
         logs = get_activity_logs(st.session_state['token'])
         if logs:
@@ -0,0 +1,175 @@
+import argparse
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Date, DateTime, Float, Integer, LargeBinary, String
+
+import models
+import stats
+from database import SessionLocal
+from details_cache import details_cache
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+EXPORT_BATCH_SIZE = 5000
+
+# Tables that can be exported/archived and the column they are partitioned by
+ARCHIVABLE_TABLES = {
+    "predictions": (models.Prediction, models.Prediction.predicted_at),
+    "image_uploads": (models.ImageUpload, models.ImageUpload.uploaded_at),
+    "activity_logs": (models.ActivityLog, models.ActivityLog.timestamp),
+}
+
+_ARROW_TYPES = [
+    (Integer, pa.int64()),
+    (Float, pa.float64()),
+    (DateTime, pa.timestamp("us")),
+    (Date, pa.date32()),
+    (String, pa.string()),
+    (LargeBinary, pa.binary()),
+]
+
+
+def arrow_schema(model):
+    fields = []
+    for column in model.__table__.columns:
+        arrow_type = next((t for sa_type, t in _ARROW_TYPES if isinstance(column.type, sa_type)), pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+class MonthPartitionWriter:
+    """
+    Writes rows into <out_dir>/<table>/month=YYYY-MM/part-<run id>.parquet,
+    keeping one open ParquetWriter per month seen during the run.
+    """
+
+    def __init__(self, out_dir, table_name, model, partition_column):
+        self.out_dir = out_dir
+        self.table_name = table_name
+        self.schema = arrow_schema(model)
+        self.columns = [field.name for field in self.schema]
+        self.partition_column = partition_column.key
+        self.run_id = uuid.uuid4().hex[:12]
+        self.writers = {}
+        self.rows_written = 0
+        self.files = []
+
+    def _writer(self, month):
+        writer = self.writers.get(month)
+        if writer is None:
+            directory = os.path.join(self.out_dir, self.table_name, f"month={month}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"part-{self.run_id}.parquet")
+            writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+            self.writers[month] = writer
+            self.files.append(path)
+        return writer
+
+    def write_batch(self, rows):
+        by_month = {}
+        for row in rows:
+            stamp = row[self.partition_column]
+            month = stamp.strftime("%Y-%m") if stamp else "unknown"
+            by_month.setdefault(month, []).append(row)
+        for month, month_rows in by_month.items():
+            arrays = {name: [row[name] for row in month_rows] for name in self.columns}
+            self._writer(month).write_table(pa.Table.from_pydict(arrays, schema=self.schema))
+            self.rows_written += len(month_rows)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+def _stream_rows(db, model, partition_column, before=None, max_id=None, batch_size=EXPORT_BATCH_SIZE):
+    # stream_results asks the driver for a server-side cursor, so only one batch
+    # of rows is ever held in memory
+    query = db.query(*model.__table__.columns)
+    if before is not None:
+        query = query.filter(partition_column < before)
+    if max_id is not None:
+        query = query.filter(model.id <= max_id)
+    result = db.execute(
+        query.order_by(model.id).statement.execution_options(stream_results=True, yield_per=batch_size)
+    )
+    for partition in result.mappings().partitions(batch_size):
+        yield partition
+
+
+def export_table(db, table_name, out_dir=EXPORT_DIR, before=None, batch_size=EXPORT_BATCH_SIZE):
+    """Export one table as month-partitioned Parquet. Returns (rows written, max id written, files)."""
+    model, partition_column = ARCHIVABLE_TABLES[table_name]
+    writer = MonthPartitionWriter(out_dir, table_name, model, partition_column)
+    max_id = None
+    try:
+        for rows in _stream_rows(db, model, partition_column, before=before, batch_size=batch_size):
+            writer.write_batch(rows)
+            max_id = rows[-1]["id"]
+    finally:
+        writer.close()
+    return writer.rows_written, max_id, writer.files
+
+
+def archive_table(db, table_name, retention_days, out_dir=EXPORT_DIR, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Move rows older than the retention window out of a hot table into Parquet.
+    Files are fully written and closed before anything is deleted, and the delete
+    is bounded by the highest exported id so rows that arrive mid-run are kept.
+    Archived predictions are taken out of the statistics rollups in the same
+    transaction as their delete, so /stats always covers the predictions table
+    only, as `stats.py rebuild` does.
+    """
+    model, partition_column = ARCHIVABLE_TABLES[table_name]
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    rows_written, max_id, files = export_table(db, table_name, out_dir, before=cutoff, batch_size=batch_size)
+    if max_id is None:
+        return 0, files
+
+    deleted = 0
+    while True:
+        ids = [row.id for row in db.query(model.id).filter(
+            partition_column < cutoff, model.id <= max_id
+        ).order_by(model.id).limit(batch_size)]
+        if not ids:
+            break
+        if table_name == "image_uploads":
+            # Idempotency keys reference the uploads; a retry of an archived upload is a new one
+            db.query(models.UploadIdempotencyKey).filter(
+                models.UploadIdempotencyKey.image_upload_id.in_(ids)
+            ).delete(synchronize_session=False)
+        if table_name == "predictions":
+            stats.remove_from_rollups(db, db.query(
+                model.predicted_at, model.user_id, model.disease, model.confidence
+            ).filter(model.id.in_(ids)).all())
+        deleted += db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+    if deleted and table_name == "predictions":
+        # Bumps the epoch in the database, so every API worker drops its entries
+        details_cache.clear()
+    return deleted, files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or archive hot tables as partitioned Parquet")
+    parser.add_argument("command", choices=["export", "archive"])
+    parser.add_argument("--tables", nargs="+", choices=sorted(ARCHIVABLE_TABLES), default=sorted(ARCHIVABLE_TABLES))
+    parser.add_argument("--out", default=EXPORT_DIR)
+    parser.add_argument("--retention-days", type=int, default=365)
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        for table_name in args.tables:
+            if args.command == "export":
+                rows, _, files = export_table(db, table_name, args.out, batch_size=args.batch_size)
+                print(f"{table_name}: exported {rows} rows into {len(files)} files")
+            else:
+                deleted, files = archive_table(db, table_name, args.retention_days, args.out, batch_size=args.batch_size)
+                print(f"{table_name}: archived {deleted} rows into {len(files)} files")
+    finally:
+        db.close()
@@ -0,0 +1,110 @@
+"""
+Benchmark peak memory and time-to-first-byte of the large listing endpoints,
+comparing the buffered JSON path with ?format=ndjson streaming.
+
+    python bench_listings.py --rows 200000
+
+Requests are driven straight through the ASGI app, so the numbers measure the
+server side only. The database defaults to a local SQLite file that is seeded
+on first run; point --database-url elsewhere to benchmark a real server.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import time
+import tracemalloc
+
+LISTINGS = ["/all-predictions", "/activity-logs", "/user/1/activity"]
+DISEASES = ["bacteria", "fungus", "healthy", "pests", "virus"]
+
+
+def seed(rows):
+    import models
+    from database import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if db.query(models.Prediction).count() >= rows:
+            return
+        now = datetime.datetime.now()
+        if db.query(models.User).filter(models.User.id == 1).first() is None:
+            db.add(models.User(id=1, username="bench", email="bench@example.com", password="bench1"))
+            db.commit()
+        start = (db.query(models.Image.id).order_by(models.Image.id.desc()).limit(1).scalar() or 0) + 1
+        for offset in range(start, rows + 1, 10000):
+            ids = range(offset, min(offset + 10000, rows + 1))
+            db.bulk_insert_mappings(models.Image, [
+                {"id": i, "filename": f"bench_{i}.jpg", "content_type": "image/jpeg",
+                 "hash": f"bench{i:027d}", "user_id": 1, "uploaded_at": now} for i in ids
+            ])
+            db.bulk_insert_mappings(models.Prediction, [
+                {"image_id": i, "user_id": 1, "disease": random.choice(DISEASES),
+                 "confidence": random.random(), "predicted_at": now} for i in ids
+            ])
+            db.bulk_insert_mappings(models.ActivityLog, [
+                {"user_id": 1, "activity_type": "login", "timestamp": now} for i in ids
+            ])
+            db.commit()
+    finally:
+        db.close()
+
+
+async def measure(app, path, query_string=b""):
+    disconnected = asyncio.Event()
+    request_sent = False
+    started = time.perf_counter()
+    first_byte = None
+    total_bytes = 0
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal first_byte, total_bytes
+        if message["type"] == "http.response.body":
+            if first_byte is None:
+                first_byte = time.perf_counter()
+            total_bytes += len(message.get("body", b""))
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": query_string, "headers": [(b"host", b"bench")],
+        "client": ("bench", 0), "server": ("bench", 80),
+    }
+    await app(scope, receive, send)
+    disconnected.set()
+    finished = time.perf_counter()
+    return (first_byte - started) * 1000, (finished - started) * 1000, total_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--database-url", default="sqlite:///./bench_listings.db")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", args.database_url)
+    seed(args.rows)
+    from main import app
+
+    print(f"{'endpoint':<20} {'mode':<7} {'ttfb ms':>9} {'total ms':>9} {'MiB out':>8} {'peak MiB':>9}")
+    for path in LISTINGS:
+        for mode, query_string in (("json", b""), ("ndjson", b"format=ndjson")):
+            tracemalloc.start()
+            ttfb, total, size = asyncio.run(measure(app, path, query_string))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{path:<20} {mode:<7} {ttfb:>9.1f} {total:>9.1f} {size / 2**20:>8.1f} {peak / 2**20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
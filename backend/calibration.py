@@ -0,0 +1,240 @@
+"""
+Class-probability vectors and the calibration applied to them.
+
+Every prediction stores the model's full softmax over CLASS_LABELS as five
+little-endian float32 values (predictions.probabilities, 20 bytes). The
+stored disease and confidence are derived from that vector through the
+current calibration: a temperature and optional per-class weights (a prior
+correction, which also moves each class's decision threshold). The default
+calibration leaves the raw argmax and max unchanged.
+
+Changing the calibration never runs the model again:
+
+    python calibration.py report --temperature 1.5 --threshold 0.7
+    python calibration.py backfill --temperature 1.5 --weight healthy=0.8
+
+report shows what a calibration and confidence threshold would do to the
+archive; backfill re-derives disease and confidence for every stored vector
+in vectorized batches and, when any label moved, bumps the prediction-labels
+epoch (part of the ETags of responses showing labels), clears the /image-details
+cache on every node and rebuilds the statistics rollups. The command line then
+saves the calibration to CALIBRATION_PATH, where new predictions pick it up once
+the API is restarted. Predictions made before vectors were stored are left as they
+are.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from sqlalchemy import bindparam, update
+
+from schemas import DiseaseClass
+
+# models and database are imported where they are used: the inference service
+# imports this module for CLASS_LABELS and must not create a database engine
+
+CLASS_LABELS = [label.value for label in DiseaseClass]
+CALIBRATION_PATH = os.environ.get("CALIBRATION_PATH", "calibration.json")
+PREDICTION_TOP_K = int(os.environ.get("PREDICTION_TOP_K", 3))
+BACKFILL_BATCH_SIZE = 100_000
+# models.CacheEpoch row bumped whenever stored diseases/confidences are
+# rewritten; ETags of responses that show them include it
+PREDICTION_LABELS_EPOCH = "prediction-labels"
+
+_VECTOR_DTYPE = np.dtype("<f4")
+# Floor for log() of probabilities that underflowed to zero
+_MIN_PROBABILITY = 1e-12
+
+
+def pack(probabilities):
+    return np.asarray(probabilities, dtype=_VECTOR_DTYPE).tobytes()
+
+
+def unpack_many(blobs):
+    # One (n, classes) array from n stored vectors without a Python loop over values
+    return np.frombuffer(b"".join(blobs), dtype=_VECTOR_DTYPE).reshape(-1, len(CLASS_LABELS))
+
+
+class Calibration:
+    def __init__(self, temperature=1.0, class_weights=None):
+        if temperature <= 0:
+            raise ValueError("temperature must be positive")
+        unknown = set(class_weights or {}) - set(CLASS_LABELS)
+        if unknown:
+            raise ValueError(f"Unknown classes in class weights: {sorted(unknown)}")
+        self.temperature = temperature
+        self.class_weights = dict(class_weights or {})
+        self._log_weights = np.log(np.array([self.class_weights.get(label, 1.0) for label in CLASS_LABELS]))
+
+    @property
+    def is_identity(self):
+        return self.temperature == 1.0 and not np.any(self._log_weights)
+
+    def apply(self, probabilities):
+        """Calibrated copy of an (n, classes) or (classes,) array of softmax outputs."""
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        if self.is_identity:
+            return probabilities
+        # softmax(log p / T + log w) is temperature scaling of the logits,
+        # which log p equals up to a per-row constant
+        logits = np.log(np.maximum(probabilities, _MIN_PROBABILITY)) / self.temperature + self._log_weights
+        logits -= logits.max(axis=-1, keepdims=True)
+        scaled = np.exp(logits)
+        return scaled / scaled.sum(axis=-1, keepdims=True)
+
+    def classify_many(self, probabilities):
+        """(class indices, confidences) for an (n, classes) array."""
+        calibrated = self.apply(probabilities)
+        indices = calibrated.argmax(axis=1)
+        return indices, calibrated[np.arange(len(calibrated)), indices]
+
+    def to_dict(self):
+        return {"temperature": self.temperature, "class_weights": self.class_weights}
+
+    def save(self, path=CALIBRATION_PATH):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=CALIBRATION_PATH):
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config.get("temperature", 1.0), config.get("class_weights"))
+
+
+calibration = Calibration.load()
+
+
+def classify(probabilities):
+    """Disease, confidence and top-k list for one raw softmax vector."""
+    calibrated = calibration.apply(probabilities)
+    order = np.argsort(calibrated)[::-1]
+    top_k = [
+        {"disease": CLASS_LABELS[index], "probability": float(calibrated[index])}
+        for index in order[:PREDICTION_TOP_K]
+    ]
+    return top_k[0]["disease"], top_k[0]["probability"], top_k
+
+
+def top_k(blob):
+    """Top-k list for a stored vector, or None for predictions made before vectors were kept."""
+    if blob is None:
+        return None
+    return classify(unpack_many([blob])[0])[2]
+
+
+def _batches(db, batch_size):
+    import models
+
+    # Keyset pagination over id so each batch is one index range scan
+    last_id = 0
+    while True:
+        rows = db.query(
+            models.Prediction.id, models.Prediction.probabilities,
+            models.Prediction.disease, models.Prediction.confidence
+        ).filter(
+            models.Prediction.id > last_id, models.Prediction.probabilities.isnot(None)
+        ).order_by(models.Prediction.id).limit(batch_size).all()
+        if not rows:
+            return
+        ids, blobs, diseases, confidences = zip(*rows)
+        last_id = ids[-1]
+        yield np.array(ids), unpack_many(blobs), np.array(diseases, dtype=object), np.array(confidences, dtype=float)
+
+
+def report(db, candidate, threshold, batch_size=BACKFILL_BATCH_SIZE):
+    labels = np.array(CLASS_LABELS, dtype=object)
+    counts = np.zeros(len(CLASS_LABELS), dtype=np.int64)
+    below = np.zeros(len(CLASS_LABELS), dtype=np.int64)
+    changed = 0
+    for _, vectors, diseases, _ in _batches(db, batch_size):
+        indices, confidences = candidate.classify_many(vectors)
+        counts += np.bincount(indices, minlength=len(CLASS_LABELS))
+        below += np.bincount(indices[confidences < threshold], minlength=len(CLASS_LABELS))
+        changed += int(np.count_nonzero(labels[indices] != diseases))
+    return {
+        "predictions": int(counts.sum()),
+        "disease_changes": changed,
+        "per_disease": {
+            label: {"count": int(count), "below_threshold": int(low)}
+            for label, count, low in zip(CLASS_LABELS, counts, below)
+        },
+    }
+
+
+def backfill(db, candidate, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Re-derive disease and confidence of every stored vector under `candidate`,
+    then replace everything derived from the old labels: ETags, cached
+    /image-details responses and the statistics rollups.
+    """
+    import models
+    import stats
+    from details_cache import details_cache
+
+    table = models.Prediction.__table__
+    statement = update(table).where(table.c.id == bindparam("prediction_id")).values(
+        disease=bindparam("disease"), confidence=bindparam("confidence")
+    )
+    labels = np.array(CLASS_LABELS, dtype=object)
+    scanned = updated = 0
+    for ids, vectors, diseases, confidences in _batches(db, batch_size):
+        indices, new_confidences = candidate.classify_many(vectors)
+        new_diseases = labels[indices]
+        changed = (new_diseases != diseases) | ~np.isclose(new_confidences, confidences, rtol=0, atol=1e-9)
+        if changed.any():
+            # Only rows whose values moved, as one Core executemany per batch
+            # (the ORM bulk path costs about as much again in Python)
+            db.execute(statement, [
+                {"prediction_id": int(prediction_id), "disease": disease, "confidence": float(confidence)}
+                for prediction_id, disease, confidence in zip(
+                    ids[changed], new_diseases[changed], new_confidences[changed]
+                )
+            ])
+            db.commit()
+        scanned += len(ids)
+        updated += int(changed.sum())
+    if updated:
+        models.bump_epoch(db.get_bind(), PREDICTION_LABELS_EPOCH)
+        details_cache.clear()
+        stats.rebuild_stats(db)
+    return scanned, updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["report", "backfill"])
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--weight", action="append", default=[], metavar="CLASS=WEIGHT",
+                        help="Prior weight for one class, repeatable")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Confidence threshold to report on")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    args = parser.parse_args()
+
+    from database import SessionLocal
+
+    weights = {}
+    for item in args.weight:
+        label, _, value = item.partition("=")
+        weights[label.strip()] = float(value)
+    candidate = Calibration(args.temperature, weights)
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        if args.command == "report":
+            print(json.dumps(report(db, candidate, args.threshold, args.batch_size), indent=2))
+            print(f"Scanned in {time.perf_counter() - started:.2f}s")
+        else:
+            scanned, updated = backfill(db, candidate, args.batch_size)
+            print(f"Re-derived {scanned} predictions ({updated} changed) in {time.perf_counter() - started:.2f}s")
+            candidate.save()
+            print(f"Saved calibration to {CALIBRATION_PATH}; restart the API to apply it to new predictions")
+    finally:
+        db.close()
@@ -0,0 +1,454 @@
+"""
+Ranked full-text search over comments (GET /comments/search).
+
+Uses the database's own full-text index where there is one, kept up to date
+by the database itself:
+
+    sqlite      FTS5 external-content table comments_fts, maintained by triggers
+    postgresql  GIN index on to_tsvector(comment_text), ranked with ts_rank
+    mssql       full-text index with automatic change tracking (CONTAINSTABLE);
+                new comments become searchable after a short population delay
+
+Anywhere else, or on SQL Server without Full-Text Search installed, comments are
+indexed into models.CommentTerm: one posting per (term, comment) with a
+precomputed weight, written in the same flush that inserts the comment.
+Comments are append-only, so postings never need updating.
+
+COMMENT_SEARCH_BACKEND forces 'native' or 'index' instead of 'auto'.
+Workers only create what is cheap and safe to create concurrently (triggers,
+the listener) and never index existing comments themselves, so starting N
+workers costs no full scan. Index the comments that predate the backend, once
+per deployment and after importing comments with raw SQL, with:
+
+    python comment_search.py rebuild
+
+Until then a worker logs a warning at startup and older comments are missing
+from results (PostgreSQL: found, by a table scan).
+
+All query terms must match (AND). Ranking a term found in most comments would
+score every one of them, so broad queries rank only their newest
+COMMENT_SEARCH_MAX_RANKED matches (SQL Server: the best that many by its own
+rank); the total is still counted over all matches. Results are the comment
+ids in rank order; main.py joins them with the comment, its author, image and
+first prediction.
+"""
+import argparse
+import logging
+import math
+import os
+import re
+import time
+
+from abc import ABC, abstractmethod
+
+from sqlalchemy import event, func, insert, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, aliased
+
+import models
+
+COMMENT_SEARCH_BACKEND = os.environ.get("COMMENT_SEARCH_BACKEND", "auto")  # 'auto', 'native' or 'index'
+# Longer queries are cut to this many distinct terms
+MAX_QUERY_TERMS = 8
+# Terms longer than this (matching CommentTerm.term) are not indexed
+MAX_TERM_LENGTH = 64
+COMMENT_SEARCH_MAX_RANKED = int(os.environ.get("COMMENT_SEARCH_MAX_RANKED", 50000))
+INDEX_BATCH_SIZE = 10000
+# Document frequencies are counted up to here; terms in more comments than
+# this rank as equally common
+DOCUMENT_FREQUENCY_CAP = 100_000
+POSTGRES_TEXT_SEARCH_CONFIG = "english"
+
+logger = logging.getLogger("uvicorn.error")
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text_value):
+    return [word for word in _WORD.findall((text_value or "").lower()) if len(word) <= MAX_TERM_LENGTH]
+
+
+def query_terms(query):
+    # Distinct terms in the order given
+    return list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+
+
+def _quoted(terms):
+    # Terms are \w+ only, so double quotes cannot occur inside them
+    return [f'"{term}"' for term in terms]
+
+
+class CommentSearch(ABC):
+    name = None
+
+    @classmethod
+    @abstractmethod
+    def setup(cls, engine):
+        """Prepare this backend at worker startup; cheap, and safe to run in several workers at once."""
+
+    @classmethod
+    @abstractmethod
+    def rebuild(cls, engine):
+        """Index every existing comment; run from the CLI, not from workers."""
+
+    @abstractmethod
+    def search(self, db, terms, offset, limit):
+        """[(comment id, score)] best first; higher scores rank higher."""
+
+    @abstractmethod
+    def count(self, db, terms, cap):
+        """Matching comments, counted up to cap."""
+
+    def page(self, db, terms, offset, limit, count_cap):
+        return self.search(db, terms, offset, limit), self.count(db, terms, count_cap)
+
+
+class SqliteFts(CommentSearch):
+    name = "sqlite-fts5"
+
+    @classmethod
+    def setup(cls, engine):
+        with engine.begin() as connection:
+            cls._create(connection)
+            # The oldest comment is indexed unless the table was created after it
+            if connection.exec_driver_sql(
+                "SELECT 1 FROM comments WHERE id = (SELECT min(id) FROM comments) "
+                "AND id NOT IN (SELECT id FROM comments_fts_docsize)"
+            ).first():
+                _warn_unindexed()
+
+    @classmethod
+    def rebuild(cls, engine):
+        with engine.begin() as connection:
+            cls._create(connection)
+            connection.exec_driver_sql("INSERT INTO comments_fts(comments_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def _create(connection):
+        # IF NOT EXISTS throughout: workers starting together all succeed
+        # Raises OperationalError when SQLite was built without FTS5
+        connection.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5("
+            "comment_text, content='comments', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS comments_fts_insert AFTER INSERT ON comments BEGIN "
+            "INSERT INTO comments_fts(rowid, comment_text) VALUES (new.id, new.comment_text); END"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS comments_fts_delete AFTER DELETE ON comments BEGIN "
+            "INSERT INTO comments_fts(comments_fts, rowid, comment_text) VALUES ('delete', old.id, old.comment_text); END"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS comments_fts_update AFTER UPDATE OF comment_text ON comments BEGIN "
+            "INSERT INTO comments_fts(comments_fts, rowid, comment_text) VALUES ('delete', old.id, old.comment_text); "
+            "INSERT INTO comments_fts(rowid, comment_text) VALUES (new.id, new.comment_text); END"
+        )
+
+    def search(self, db, terms, offset, limit):
+        # rank is bm25(), lower is better. The newest matches are found by
+        # walking the doclists backwards; only rowids from there on are scored
+        rows = db.execute(text(
+            "SELECT rowid, rank FROM comments_fts WHERE comments_fts MATCH :query AND rowid >= ("
+            "SELECT min(rowid) FROM (SELECT rowid FROM comments_fts WHERE comments_fts MATCH :query "
+            "ORDER BY rowid DESC LIMIT :candidates)) "
+            "ORDER BY rank, rowid DESC LIMIT :limit OFFSET :offset"
+        ), {"query": " ".join(_quoted(terms)), "candidates": COMMENT_SEARCH_MAX_RANKED,
+            "limit": limit, "offset": offset}).all()
+        return [(comment_id, -rank) for comment_id, rank in rows]
+
+    def count(self, db, terms, cap):
+        return db.execute(text(
+            "SELECT count(*) FROM (SELECT rowid FROM comments_fts WHERE comments_fts MATCH :query LIMIT :cap)"
+        ), {"query": " ".join(_quoted(terms)), "cap": cap}).scalar()
+
+
+class PostgresFts(CommentSearch):
+    name = "postgresql-tsvector"
+    _document = f"to_tsvector('{POSTGRES_TEXT_SEARCH_CONFIG}', comment_text)"
+    _query = f"plainto_tsquery('{POSTGRES_TEXT_SEARCH_CONFIG}', :query)"
+
+    @classmethod
+    def setup(cls, engine):
+        # Building the GIN index scans the whole table, so workers leave it to rebuild()
+        with engine.connect() as connection:
+            if connection.exec_driver_sql("SELECT to_regclass('ix_comments_comment_text_fts')").scalar() is None:
+                _warn_unindexed()
+
+    @classmethod
+    def rebuild(cls, engine):
+        # CONCURRENTLY keeps comments writable while the index builds; it cannot run in a transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_comment_text_fts "
+                f"ON comments USING gin ({cls._document})"
+            )
+
+    def search(self, db, terms, offset, limit):
+        # The WHERE clause repeats the indexed expression so the GIN index is used
+        return db.execute(text(
+            f"SELECT id, ts_rank({self._document}, {self._query}) AS score FROM ("
+            f"SELECT id, comment_text FROM comments WHERE {self._document} @@ {self._query} "
+            "ORDER BY id DESC LIMIT :candidates) candidates "
+            "ORDER BY score DESC, id DESC LIMIT :limit OFFSET :offset"
+        ), {"query": " ".join(terms), "candidates": COMMENT_SEARCH_MAX_RANKED,
+            "limit": limit, "offset": offset}).all()
+
+    def count(self, db, terms, cap):
+        return db.execute(text(
+            f"SELECT count(*) FROM (SELECT id FROM comments WHERE {self._document} @@ {self._query} LIMIT :cap) matches"
+        ), {"query": " ".join(terms), "cap": cap}).scalar()
+
+
+class SqlServerFts(CommentSearch):
+    name = "mssql-fulltext"
+
+    @classmethod
+    def setup(cls, engine):
+        # Full-text DDL cannot run inside a transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            if not connection.exec_driver_sql("SELECT FULLTEXTSERVICEPROPERTY('IsFullTextInstalled')").scalar():
+                raise RuntimeError("Full-Text Search is not installed on this SQL Server")
+            # CONTAINSTABLE needs the index, and creating it is cheap (SQL Server
+            # populates it in the background); a session lock lets one worker
+            # at a time check for and create it
+            if connection.exec_driver_sql(
+                "SET NOCOUNT ON; DECLARE @result int; EXEC @result = sp_getapplock @Resource = 'comment_search_setup', "
+                "@LockMode = 'Exclusive', @LockOwner = 'Session', @LockTimeout = 30000; SELECT @result"
+            ).scalar() < 0:
+                raise RuntimeError("Timed out waiting for another worker to set up full-text search")
+            try:
+                cls._create_index(connection)
+            finally:
+                connection.exec_driver_sql(
+                    "EXEC sp_releaseapplock @Resource = 'comment_search_setup', @LockOwner = 'Session'"
+                )
+
+    @staticmethod
+    def _create_index(connection):
+        if connection.exec_driver_sql(
+            "SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('comments')"
+        ).first():
+            return
+        if not connection.exec_driver_sql(
+            "SELECT 1 FROM sys.fulltext_catalogs WHERE name = 'comments_catalog'"
+        ).first():
+            connection.exec_driver_sql("CREATE FULLTEXT CATALOG comments_catalog")
+        key_index = connection.exec_driver_sql(
+            "SELECT name FROM sys.indexes WHERE object_id = OBJECT_ID('comments') AND is_primary_key = 1"
+        ).scalar()
+        # Populated in the background, then kept current by change tracking
+        connection.exec_driver_sql(
+            f"CREATE FULLTEXT INDEX ON comments (comment_text) KEY INDEX [{key_index}] "
+            "ON comments_catalog WITH CHANGE_TRACKING AUTO"
+        )
+
+    @classmethod
+    def rebuild(cls, engine):
+        cls.setup(engine)
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql("ALTER FULLTEXT INDEX ON comments START FULL POPULATION")
+
+    def search(self, db, terms, offset, limit):
+        return db.execute(text(
+            "SELECT matches.[KEY], matches.RANK FROM CONTAINSTABLE(comments, comment_text, :query, :candidates) AS matches "
+            "ORDER BY matches.RANK DESC, matches.[KEY] DESC OFFSET :offset ROWS FETCH NEXT :limit ROWS ONLY"
+        ), {"query": " AND ".join(_quoted(terms)), "candidates": COMMENT_SEARCH_MAX_RANKED,
+            "limit": limit, "offset": offset}).all()
+
+    def count(self, db, terms, cap):
+        return db.execute(text(
+            "SELECT count(*) FROM (SELECT TOP (:cap) [KEY] FROM CONTAINSTABLE(comments, comment_text, :query)) matches"
+        ), {"query": " AND ".join(_quoted(terms)), "cap": cap}).scalar()
+
+
+def term_weights(comment_text):
+    """{term: weight} for one comment: log-scaled term frequency over the square root of its length."""
+    words = tokenize(comment_text)
+    counts = {}
+    for word in words:
+        counts[word] = counts.get(word, 0) + 1
+    # Length normalisation keeps long comments from ranking first by volume alone
+    norm = math.sqrt(len(words)) if words else 1.0
+    return {term: (1 + math.log(count)) / norm for term, count in counts.items()}
+
+
+def _postings(comment_id, comment_text):
+    return [
+        {"term": term, "comment_id": comment_id, "weight": weight}
+        for term, weight in term_weights(comment_text).items()
+    ]
+
+
+class InvertedIndex(CommentSearch):
+    name = "inverted-index"
+
+    @classmethod
+    def setup(cls, engine):
+        # Postings go into the same transaction as the comment they index
+        if not event.contains(Session, "after_flush", _index_new_comments):
+            event.listen(Session, "after_flush", _index_new_comments)
+        with Session(engine) as db:
+            oldest = db.execute(select(func.min(models.Comment.id))).scalar()
+            if oldest is not None and not db.execute(
+                select(models.CommentTerm.comment_id).where(models.CommentTerm.comment_id == oldest).limit(1)
+            ).first():
+                _warn_unindexed()
+
+    @classmethod
+    def rebuild(cls, engine):
+        with Session(engine) as db:
+            rebuild_index(db)
+
+    def _document_frequencies(self, db, terms):
+        # Index range counts on (term, ...), bounded so common terms stay cheap
+        frequencies = {}
+        for term in terms:
+            capped = select(models.CommentTerm.comment_id).where(
+                models.CommentTerm.term == term
+            ).limit(DOCUMENT_FREQUENCY_CAP).subquery()
+            frequencies[term] = db.execute(select(func.count()).select_from(capped)).scalar()
+        return frequencies
+
+    def _matches(self, db, terms, frequencies):
+        """(select of comment_id, score over comments containing every term; its ORDER BY; the driving posting)"""
+        total = db.execute(select(func.max(models.Comment.id))).scalar() or 1
+        # Start from the rarest term and look up the others by (term, comment_id)
+        ordered = sorted(terms, key=frequencies.get)
+        postings = [aliased(models.CommentTerm) for _ in ordered]
+        first = postings[0]
+        statement = select(first.comment_id).where(first.term == ordered[0])
+        for posting, term in zip(postings[1:], ordered[1:]):
+            statement = statement.join(posting, (posting.comment_id == first.comment_id) & (posting.term == term))
+        score = sum(
+            posting.weight * math.log(1 + total / frequencies[term]) for posting, term in zip(postings, ordered)
+        )
+        statement = statement.add_columns(score.label("score"))
+        if len(ordered) == 1:
+            # Same order as the score, read straight off ix_comment_terms_term_weight
+            order = [first.weight.desc(), first.comment_id.desc()]
+        else:
+            order = [score.desc(), first.comment_id.desc()]
+        return statement, order, first, ordered[0]
+
+    def page(self, db, terms, offset, limit, count_cap):
+        frequencies = self._document_frequencies(db, terms)
+        if not all(frequencies.values()):
+            # Some term occurs nowhere, so nothing contains them all
+            return [], 0
+        statement, order, first, rarest = self._matches(db, terms, frequencies)
+        ranked = statement
+        if frequencies[rarest] > COMMENT_SEARCH_MAX_RANKED:
+            # Only the rarest term's newest postings are ranked, found by
+            # reading its primary key range backwards
+            newest = select(models.CommentTerm.comment_id).where(
+                models.CommentTerm.term == rarest
+            ).order_by(models.CommentTerm.comment_id.desc()).limit(COMMENT_SEARCH_MAX_RANKED).subquery()
+            floor = db.execute(select(func.min(newest.c.comment_id))).scalar()
+            ranked = statement.where(first.comment_id >= floor)
+        hits = db.execute(ranked.order_by(*order).offset(offset).limit(limit)).all()
+        if len(terms) == 1 and count_cap <= DOCUMENT_FREQUENCY_CAP:
+            return hits, min(frequencies[rarest], count_cap)
+        capped = statement.limit(count_cap).subquery()
+        return hits, db.execute(select(func.count()).select_from(capped)).scalar()
+
+    def search(self, db, terms, offset, limit):
+        return self.page(db, terms, offset, limit, 0)[0]
+
+    def count(self, db, terms, cap):
+        return self.page(db, terms, 0, 0, cap)[1]
+
+
+def _warn_unindexed():
+    logger.warning("Comments that predate the search index are not searchable; run: python comment_search.py rebuild")
+
+
+def _index_new_comments(session, flush_context):
+    # After the flush ids are assigned, while session.new still lists what was inserted
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, models.Comment):
+            rows.extend(_postings(obj.id, obj.comment_text))
+    if rows:
+        session.connection().execute(insert(models.CommentTerm.__table__), rows)
+
+
+def rebuild_index(db, batch_size=INDEX_BATCH_SIZE):
+    """Re-create every posting from the comments table; returns the comments indexed."""
+    table = models.CommentTerm.__table__
+    db.query(models.CommentTerm).delete(synchronize_session=False)
+    db.commit()
+    # Secondary indexes are built once at the end instead of row by row
+    for index in table.indexes:
+        index.drop(bind=db.connection(), checkfirst=True)
+    last_id = 0
+    indexed = 0
+    while True:
+        # Keyset pagination so each batch is one primary key range scan
+        batch = db.execute(
+            select(models.Comment.id, models.Comment.comment_text)
+            .where(models.Comment.id > last_id).order_by(models.Comment.id).limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        rows = [posting for comment_id, comment_text in batch for posting in _postings(comment_id, comment_text)]
+        if rows:
+            db.execute(insert(models.CommentTerm.__table__), rows)
+        db.commit()
+        last_id = batch[-1][0]
+        indexed += len(batch)
+    for index in table.indexes:
+        index.create(bind=db.connection())
+    db.commit()
+    return indexed
+
+
+_NATIVE = {"sqlite": SqliteFts, "postgresql": PostgresFts, "mssql": SqlServerFts}
+
+
+def create_comment_search(engine):
+    """Set up the index for COMMENT_SEARCH_BACKEND on this database and return its searcher."""
+    searcher = _create_comment_search(engine)
+    logger.info("Comment search backend: %s", searcher.name)
+    return searcher
+
+
+def _create_comment_search(engine):
+    if COMMENT_SEARCH_BACKEND not in ("auto", "native", "index"):
+        raise ValueError(f"Unknown COMMENT_SEARCH_BACKEND '{COMMENT_SEARCH_BACKEND}', expected 'auto', 'native' or 'index'")
+    native = _NATIVE.get(engine.dialect.name)
+    if COMMENT_SEARCH_BACKEND != "index" and native is not None:
+        try:
+            native.setup(engine)
+            return native()
+        except (DBAPIError, RuntimeError) as e:
+            if COMMENT_SEARCH_BACKEND == "native":
+                raise
+            logger.warning("Native full-text search unavailable (%s); using the inverted index", e)
+    elif COMMENT_SEARCH_BACKEND == "native":
+        raise ValueError(f"No native full-text search for {engine.dialect.name}")
+    InvertedIndex.setup(engine)
+    return InvertedIndex()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--batch-size", type=int, default=INDEX_BATCH_SIZE)
+    args = parser.parse_args()
+
+    from database import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    searcher = _create_comment_search(engine)
+    started = time.perf_counter()
+    if isinstance(searcher, InvertedIndex):
+        db = SessionLocal()
+        try:
+            indexed = rebuild_index(db, batch_size=args.batch_size)
+        finally:
+            db.close()
+        print(f"Indexed {indexed} comments in {time.perf_counter() - started:.1f}s")
+    else:
+        searcher.rebuild(engine)
+        print(f"Rebuilt the {searcher.name} index in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,54 @@
+import io
+import os
+
+from PIL import Image
+
+# The model only sees a 256x256 letterboxed input, so anything much larger than
+# this is bandwidth spent on pixels that are thrown away during preprocessing.
+# measure_compact_tolerance.py checks these defaults against the model on
+# full-size photos (what compact_upload sends, no label may change, confidence
+# may move by at most 0.05); it needs the trained weights from Git LFS.
+DEFAULT_MAX_EDGE = 1024
+DEFAULT_QUALITY = 85
+
+FORMATS = {
+    "JPEG": ("image/jpeg", ".jpg"),
+    "WEBP": ("image/webp", ".webp"),
+}
+
+
+def compact_encode(image, max_edge=DEFAULT_MAX_EDGE, image_format="JPEG", quality=DEFAULT_QUALITY):
+    """
+    Downscale so the longest edge is at most max_edge and re-encode as a
+    quality-tuned JPEG or WebP. Only pixel data is written, so EXIF, ICC and
+    other metadata are dropped. Orientation is left as stored, matching what the
+    backend's preprocessing sees for an original upload.
+    Returns (bytes, content_type, file_extension).
+    """
+    image_format = image_format.upper()
+    if image_format not in FORMATS:
+        raise ValueError(f"Unsupported format {image_format}, expected one of {sorted(FORMATS)}")
+
+    image = image.convert("RGB")
+    if max_edge and max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    content_type, extension = FORMATS[image_format]
+    return buffer.getvalue(), content_type, extension
+
+
+def compact_upload(name, data, content_type, max_edge=DEFAULT_MAX_EDGE, image_format="JPEG", quality=DEFAULT_QUALITY):
+    """
+    The (filename, bytes, content type) a client uploads for a selected file:
+    the compact encoding, or the original when that is not smaller (small,
+    already well-compressed photos can grow when re-encoded).
+    """
+    compact, compact_type, extension = compact_encode(Image.open(io.BytesIO(data)), max_edge, image_format, quality)
+    if len(compact) < len(data):
+        return os.path.splitext(name)[0] + extension, compact, compact_type
+    return name, data, content_type
@@ -0,0 +1,291 @@
+"""
+Read-through cache of assembled /image-details responses keyed by image id.
+
+Entries hold the serialized JSON body together with its ETag and Last-Modified
+date, so a hit is answered (or turned into a 304) without touching the
+database. /comment and /predict invalidate the image they wrote to after their
+commit. The default SQLite backend is shared by every worker on a node, so an
+invalidation in one worker is seen by all of them; the memory backend is
+private to its process and only suits a single worker.
+
+Bulk writes outside the API (archive.py, calibration.py backfill) call clear(),
+which bumps an epoch kept in the main database. Every cache, on every node and
+with any backend, polls that epoch at most every DETAILS_CACHE_EPOCH_POLL_SECONDS
+and drops all its entries once it has moved.
+
+A reader that started before an invalidation must not store what it read, or
+it could put back the pre-write payload. Every invalidation bumps a local epoch;
+readers take a ticket before querying and put() drops the entry if the epoch
+has moved since.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import models
+from database import engine
+from metrics import registry
+
+# Cache configuration, overridable per deployment through the environment
+DETAILS_CACHE = os.environ.get("DETAILS_CACHE", "sqlite")  # 'memory', 'sqlite' or 'none'
+DETAILS_CACHE_SIZE = int(os.environ.get("DETAILS_CACHE_SIZE", 2048))
+DETAILS_CACHE_TTL_SECONDS = int(os.environ.get("DETAILS_CACHE_TTL_SECONDS", 300))
+DETAILS_CACHE_SQLITE_PATH = os.environ.get("DETAILS_CACHE_SQLITE_PATH", "details_cache.db")
+# How stale a cache may be after a bulk write elsewhere
+DETAILS_CACHE_EPOCH_POLL_SECONDS = float(os.environ.get("DETAILS_CACHE_EPOCH_POLL_SECONDS", 1))
+# Row of models.CacheEpoch shared by every /image-details cache
+SHARED_EPOCH_NAME = "image-details"
+
+logger = logging.getLogger(__name__)
+
+CachedDetails = namedtuple("CachedDetails", ["etag", "last_modified", "body"])
+
+details_cache_requests_total = registry.counter(
+    "details_cache_requests_total", "/image-details cache lookups by result (hit, miss)", ("result",)
+)
+details_cache_invalidations_total = registry.counter(
+    "details_cache_invalidations_total", "/image-details cache entries invalidated by writes"
+)
+
+
+def read_shared_epoch():
+    with engine.connect() as connection:
+        return models.read_epoch(connection, SHARED_EPOCH_NAME)[0]
+
+
+def bump_shared_epoch():
+    models.bump_epoch(engine, SHARED_EPOCH_NAME)
+
+
+class DetailsCache(ABC):
+    def __init__(self, maxsize=DETAILS_CACHE_SIZE, ttl=DETAILS_CACHE_TTL_SECONDS,
+                 epoch_poll=DETAILS_CACHE_EPOCH_POLL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.epoch_poll = epoch_poll
+        self._shared_epoch = None
+        self._polled_at = float("-inf")
+        self._poll_lock = threading.Lock()
+
+    def get(self, image_id):
+        self._follow_shared_epoch()
+        entry = self._get(image_id)
+        details_cache_requests_total.inc(result="miss" if entry is None else "hit")
+        return entry
+
+    def invalidate(self, image_id):
+        details_cache_invalidations_total.inc()
+        self._invalidate(image_id)
+
+    def ticket(self):
+        self._follow_shared_epoch()
+        return self._ticket()
+
+    def clear(self):
+        """Drops every entry here and, through the shared epoch, in every other cache."""
+        bump_shared_epoch()
+        self._clear()
+
+    def hit_ratio(self):
+        hits = details_cache_requests_total.get(result="hit")
+        lookups = hits + details_cache_requests_total.get(result="miss")
+        return hits / lookups if lookups else 0.0
+
+    def _follow_shared_epoch(self):
+        now = time.monotonic()
+        if now - self._polled_at < self.epoch_poll:
+            return
+        with self._poll_lock:
+            if now - self._polled_at < self.epoch_poll:
+                return
+            self._polled_at = now
+            try:
+                epoch = read_shared_epoch()
+            except SQLAlchemyError:
+                logger.exception("Could not read the shared details cache epoch")
+                return
+            # Also cleared on the first poll: a SQLite cache file can outlive
+            # a bulk write made while the API was down
+            if epoch != self._shared_epoch:
+                self._clear()
+                self._shared_epoch = epoch
+
+    @abstractmethod
+    def put(self, image_id, entry, ticket):
+        pass
+
+    @abstractmethod
+    def _ticket(self):
+        pass
+
+    @abstractmethod
+    def _get(self, image_id):
+        pass
+
+    @abstractmethod
+    def _invalidate(self, image_id):
+        pass
+
+    @abstractmethod
+    def _clear(self):
+        """Drops every entry of this cache only."""
+
+
+class NullDetailsCache(DetailsCache):
+    """Caching disabled: every lookup misses."""
+
+    def _follow_shared_epoch(self):
+        pass
+
+    def _ticket(self):
+        return 0
+
+    def put(self, image_id, entry, ticket):
+        pass
+
+    def _get(self, image_id):
+        return None
+
+    def _invalidate(self, image_id):
+        pass
+
+    def _clear(self):
+        pass
+
+
+class MemoryDetailsCache(DetailsCache):
+    """Bounded LRU private to one worker process."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _ticket(self):
+        with self._lock:
+            return self._epoch
+
+    def put(self, image_id, entry, ticket):
+        with self._lock:
+            if ticket != self._epoch:
+                return
+            self._entries[image_id] = (entry, time.monotonic())
+            self._entries.move_to_end(image_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _get(self, image_id):
+        with self._lock:
+            cached = self._entries.get(image_id)
+            if cached is None:
+                return None
+            entry, stored_at = cached
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[image_id]
+                return None
+            self._entries.move_to_end(image_id)
+            return entry
+
+    def _invalidate(self, image_id):
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(image_id, None)
+
+    def _clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+
+class SQLiteDetailsCache(DetailsCache):
+    """
+    Entries kept in a local SQLite file shared by every worker process on the
+    node, so an invalidation in one worker is seen by all of them. Eviction is
+    by insertion time rather than recency, which avoids a write on every hit.
+    """
+
+    def __init__(self, path=DETAILS_CACHE_SQLITE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_details ("
+                "image_id INTEGER PRIMARY KEY, etag TEXT NOT NULL, last_modified REAL NOT NULL, "
+                "body BLOB NOT NULL, stored_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_image_details_stored_at ON image_details (stored_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_epoch (id INTEGER PRIMARY KEY CHECK (id = 0), epoch INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO cache_epoch VALUES (0, 0)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _ticket(self):
+        return self._connect().execute("SELECT epoch FROM cache_epoch").fetchone()[0]
+
+    def put(self, image_id, entry, ticket):
+        now = time.time()
+        with self._connect() as conn:
+            # The epoch check and the insert share one transaction
+            inserted = conn.execute(
+                "INSERT OR REPLACE INTO image_details "
+                "SELECT ?, ?, ?, ?, ? FROM cache_epoch WHERE epoch = ?",
+                (image_id, entry.etag, entry.last_modified.timestamp(), entry.body, now, ticket)
+            ).rowcount
+            if inserted:
+                conn.execute(
+                    "DELETE FROM image_details WHERE image_id IN ("
+                    "SELECT image_id FROM image_details ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                    (self.maxsize,)
+                )
+
+    def _get(self, image_id):
+        row = self._connect().execute(
+            "SELECT etag, last_modified, body FROM image_details WHERE image_id = ? AND stored_at > ?",
+            (image_id, time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, body = row
+        return CachedDetails(etag, datetime.fromtimestamp(last_modified, timezone.utc), bytes(body))
+
+    def _invalidate(self, image_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE cache_epoch SET epoch = epoch + 1")
+            conn.execute("DELETE FROM image_details WHERE image_id = ?", (image_id,))
+
+    def _clear(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE cache_epoch SET epoch = epoch + 1")
+            conn.execute("DELETE FROM image_details")
+
+
+def create_details_cache():
+    if DETAILS_CACHE == "memory":
+        return MemoryDetailsCache()
+    if DETAILS_CACHE == "sqlite":
+        return SQLiteDetailsCache()
+    if DETAILS_CACHE == "none":
+        return NullDetailsCache()
+    raise ValueError(f"Unknown DETAILS_CACHE '{DETAILS_CACHE}', expected 'memory', 'sqlite' or 'none'")
+
+
+details_cache = create_details_cache()
+registry.gauge(
+    "details_cache_hit_ratio", "Fraction of /image-details lookups served from the cache",
+    callback=details_cache.hit_ratio
+)
@@ -0,0 +1,121 @@
+"""
+Conditional GET and response compression for the read endpoints.
+
+Each endpoint first runs one aggregate query (row count, max id, latest
+timestamp) over the rows it would return. The result becomes a weak ETag and a
+Last-Modified date. A client whose If-None-Match (or, failing that,
+If-Modified-Since) still matches gets an empty 304 and the rows are never
+loaded. Counting as well as taking the max id also catches rows removed by
+archive.py.
+"""
+import gzip
+import hashlib
+import os
+import zlib
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from metrics import conditional_requests_total
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+
+
+def make_etag(*parts):
+    # Weak because the same representation may be sent gzip-encoded or not
+    return 'W/"' + hashlib.sha1(repr(parts).encode()).hexdigest()[:24] + '"'
+
+
+def _as_utc(value):
+    # Timestamps are stored as naive local time (datetime.now)
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return value.astimezone(timezone.utc)
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in header.split(","))
+
+
+def _unmodified_since(header, last_modified):
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return _as_utc(last_modified).replace(microsecond=0) <= since
+
+
+def accepts_gzip(request: Request):
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+async def _gzip_stream(chunks):
+    # Sync-flush after every chunk so streamed rows still reach the client promptly
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress(request: Request, response: Response):
+    """gzip the response body if the client accepts it and the body is worth it."""
+    response.headers["Vary"] = "Accept-Encoding"
+    if "content-encoding" in response.headers or not accepts_gzip(request):
+        return response
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = _gzip_stream(response.body_iterator)
+    elif len(response.body) >= COMPRESS_MIN_BYTES:
+        response.body = gzip.compress(response.body, GZIP_LEVEL)
+        response.headers["Content-Length"] = str(len(response.body))
+    else:
+        return response
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+class Conditional:
+    """
+    Validators for one request. The ETag comes from make_etag() over the parts
+    that identify the representation (resource, variant and the aggregate that
+    changes whenever its rows do).
+    """
+
+    def __init__(self, request: Request, etag, last_modified=None):
+        self.request = request
+        self.etag = etag
+        self.headers = {"ETag": self.etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+        if last_modified is not None:
+            self.headers["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+            self.not_modified = _etag_matches(if_none_match, self.etag)
+        elif if_modified_since is not None and last_modified is not None:
+            self.not_modified = _unmodified_since(if_modified_since, last_modified)
+        else:
+            self.not_modified = False
+
+    def not_modified_response(self):
+        conditional_requests_total.inc(result="not_modified")
+        return Response(status_code=304, headers=self.headers)
+
+    def respond(self, response: Response):
+        conditional_requests_total.inc(result="full")
+        response.headers.update(self.headers)
+        return compress(self.request, response)
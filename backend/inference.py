@@ -0,0 +1,186 @@
+"""
+Thin client for the model, so API workers never import TensorFlow.
+
+With INFERENCE_BACKEND=service (the default) predictions are sent to the
+inference service (inference_service.py), a fixed pool of processes that each
+own one copy of the model, over a Unix socket (or host:port where Unix sockets
+are unavailable). Each request is one short-lived connection, so a busy API
+thread never pins an inference process and requests simply queue in the
+socket backlog until a process is free.
+
+INFERENCE_BACKEND=local runs ml_model in the API process instead; the model is
+loaded and warmed in the background at startup (see lifecycle.py) or on the
+first prediction, whichever comes first.
+
+Messages are framed as two big-endian uint32 lengths followed by a JSON header
+and a binary payload (the embedding, as raw float32). A prediction returns the
+full softmax over calibration.CLASS_LABELS; main.py derives the label from it.
+"""
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from metrics import predict_stage_seconds
+
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "service")  # 'service' or 'local'
+# Unix socket path, or host:port (the default on platforms without Unix sockets)
+INFERENCE_ADDRESS = os.environ.get(
+    "INFERENCE_ADDRESS", "inference.sock" if hasattr(socket, "AF_UNIX") else "127.0.0.1:8765"
+)
+INFERENCE_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_TIMEOUT_SECONDS", 60))
+
+_FRAME = struct.Struct("!II")
+MAX_HEADER_BYTES = 1024 * 1024
+
+
+class InferenceUnavailable(Exception):
+    """The inference service could not be reached or did not answer in time."""
+
+
+class InferenceBusy(InferenceUnavailable):
+    """The service accepted the connection but every process stayed busy past the timeout."""
+
+
+class InferenceError(Exception):
+    """The model failed on this input."""
+
+
+def parse_address(address):
+    # "host:port" means TCP on localhost-style deployments, anything else is a socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and host and os.sep not in host:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed mid-message")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, header, payload=b""):
+    encoded = json.dumps(header).encode()
+    sock.sendall(_FRAME.pack(len(encoded), len(payload)) + encoded + payload)
+
+
+def recv_message(sock):
+    header_size, payload_size = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    if header_size > MAX_HEADER_BYTES:
+        raise ConnectionError("oversized message header")
+    header = json.loads(_recv_exact(sock, header_size))
+    return header, _recv_exact(sock, payload_size)
+
+
+class ServiceInference:
+    def __init__(self, address=INFERENCE_ADDRESS, timeout=INFERENCE_TIMEOUT_SECONDS):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+        # time.monotonic() of the last call the service answered, for lifecycle.py
+        self.last_success = None
+
+    def call(self, header, payload=b"", timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        connected = False
+        try:
+            with socket.socket(self.family, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout)
+                sock.connect(self.address)
+                connected = True
+                send_message(sock, header, payload)
+                reply, reply_payload = recv_message(sock)
+        except socket.timeout:
+            if connected:
+                # Queued in the service's backlog behind other requests
+                raise InferenceBusy(f"inference service did not answer within {timeout:g}s")
+            raise InferenceUnavailable(f"inference service did not accept a connection within {timeout:g}s")
+        except (OSError, ValueError) as e:
+            raise InferenceUnavailable(f"inference service unreachable at {self.address}: {e}")
+        if not reply.get("ok"):
+            raise InferenceError(reply.get("error", "inference failed"))
+        self.last_success = time.monotonic()
+        return reply, reply_payload
+
+    def predict(self, image_path):
+        """(softmax over CLASS_LABELS as float32, penultimate-layer embedding)"""
+        # The service may run from another directory
+        started = time.perf_counter()
+        reply, payload = self.call({"op": "predict", "path": os.path.abspath(image_path)})
+        elapsed = time.perf_counter() - started
+        # Compute time inside the service, and everything else: socket round
+        # trip plus waiting for a free inference process
+        predict_stage_seconds.observe(reply["seconds"], stage="inference")
+        predict_stage_seconds.observe(max(elapsed - reply["seconds"], 0.0), stage="ipc")
+        probabilities = np.array(reply["probabilities"], dtype=np.float32)
+        return probabilities, np.frombuffer(payload, dtype=reply["dtype"])
+
+    def status(self, timeout=None):
+        return self.call({"op": "status"}, timeout=timeout)[0]
+
+    def warm_up(self):
+        # Service workers warm their own model before they accept connections
+        pass
+
+    def arm_trace(self):
+        # Arms the TensorFlow trace in whichever inference process answers
+        return self.call({"op": "arm_trace"})[0]
+
+
+class LocalInference:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ml_model = None
+        self._warm = False
+        self.last_success = None
+
+    def _model(self):
+        if self._ml_model is None:
+            with self._lock:
+                if self._ml_model is None:
+                    import ml_model
+
+                    self._ml_model = ml_model
+        return self._ml_model
+
+    def predict(self, image_path):
+        result = self._model().predict_probabilities(image_path)
+        # A completed prediction has warmed the model as well
+        self._warm = True
+        self.last_success = time.monotonic()
+        return result
+
+    def warm_up(self):
+        self._model().warm_up()
+        self._warm = True
+        self.last_success = time.monotonic()
+
+    def status(self, timeout=None):
+        return {"ok": True, "backend": "local", "pid": os.getpid(), "model_loaded": self._warm}
+
+    def arm_trace(self):
+        from profiling import tf_trace
+
+        tf_trace.arm()
+        return {"ok": True, "pid": os.getpid()}
+
+
+def create_inference():
+    if INFERENCE_BACKEND == "service":
+        return ServiceInference()
+    if INFERENCE_BACKEND == "local":
+        return LocalInference()
+    raise ValueError(f"Unknown INFERENCE_BACKEND '{INFERENCE_BACKEND}', expected 'service' or 'local'")
+
+
+inference = create_inference()
+
@@ -0,0 +1,164 @@
+"""
+Inference service: the only processes that load TensorFlow and the model.
+
+    python inference_service.py --address inference.sock --workers 2
+
+The parent binds the socket and starts a fixed number of worker processes
+that share it. Each worker loads and warms the model before it starts
+accepting, then answers one request per connection (see inference.py for the
+framing). The parent never imports TensorFlow; it restarts workers that die
+and, on SIGTERM/SIGINT, lets them finish the request in hand before exiting.
+API workers talk to it through inference.ServiceInference.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from inference import INFERENCE_ADDRESS, parse_address, recv_message, send_message
+
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 1))
+# Connections waiting for a free worker before new ones are refused
+INFERENCE_BACKLOG = int(os.environ.get("INFERENCE_BACKLOG", 128))
+CLIENT_TIMEOUT_SECONDS = 30
+# How long a stopping worker may take to finish its current request
+STOP_GRACE_SECONDS = 60
+
+
+def bind(address, backlog=INFERENCE_BACKLOG):
+    family, bind_address = parse_address(address)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        # A socket file left behind by a previous run would make bind fail
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+    else:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(bind_address)
+    listener.listen(backlog)
+    return listener
+
+
+def handle(connection, ml_model, tf_trace, served):
+    header, _ = recv_message(connection)
+    op = header.get("op")
+    if op == "predict":
+        started = time.perf_counter()
+        try:
+            probabilities, embedding = ml_model.predict_probabilities(header["path"])
+        except Exception as e:
+            send_message(connection, {"ok": False, "error": str(e)})
+            return
+        embedding = embedding.astype("float32", copy=False)
+        send_message(connection, {
+            "ok": True,
+            "probabilities": [float(value) for value in probabilities],
+            "dtype": "float32",
+            "seconds": time.perf_counter() - started,
+        }, embedding.tobytes())
+    elif op == "status":
+        send_message(connection, {"ok": True, "backend": "service", "pid": os.getpid(), "model_loaded": True,
+                                  "served": served})
+    elif op == "arm_trace":
+        tf_trace.arm()
+        send_message(connection, {"ok": True, "pid": os.getpid()})
+    else:
+        send_message(connection, {"ok": False, "error": f"unknown op {op!r}"})
+
+
+def serve_worker(listener, ready):
+    stopping = False
+
+    def stop(signum, frame):
+        # A request in progress is finished first
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import ml_model
+    from profiling import tf_trace
+
+    ml_model.warm_up()
+    ready.set()
+    print(f"inference worker {os.getpid()} ready", flush=True)
+    served = 0
+    # Wake up every second to notice a stop request, or a parent that was
+    # killed outright and so could not terminate its workers
+    parent = os.getppid()
+    listener.settimeout(1)
+    while not stopping and os.getppid() == parent:
+        try:
+            connection, _ = listener.accept()
+        except socket.timeout:
+            continue
+        with connection:
+            # A client that connects and never sends must not hold the worker
+            connection.settimeout(CLIENT_TIMEOUT_SECONDS)
+            try:
+                handle(connection, ml_model, tf_trace, served)
+                served += 1
+            except (OSError, ValueError) as e:
+                # The client went away or sent garbage; only this request is lost
+                print(f"inference worker {os.getpid()}: {e}", file=sys.stderr, flush=True)
+
+
+def run(address, workers):
+    context = multiprocessing.get_context("spawn")
+    listener = bind(address)
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def start():
+        ready = context.Event()
+        process = context.Process(target=serve_worker, args=(listener, ready), daemon=True)
+        process.start()
+        return process, ready
+
+    processes = [start() for _ in range(workers)]
+    print(f"inference service on {address} with {workers} worker(s)", flush=True)
+    try:
+        while not stopping:
+            time.sleep(1)
+            for index, (process, ready) in enumerate(processes):
+                if process.is_alive() or stopping:
+                    continue
+                if not ready.is_set():
+                    # Failed while loading the model; restarting would fail the same way
+                    print(f"inference worker {process.pid} exited with {process.exitcode} before it was ready",
+                          file=sys.stderr, flush=True)
+                    sys.exit(1)
+                print(f"inference worker {process.pid} exited with {process.exitcode}, restarting",
+                      file=sys.stderr, flush=True)
+                processes[index] = start()
+    finally:
+        for process, _ in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + STOP_GRACE_SECONDS
+        for process, _ in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+        listener.close()
+        family, bind_address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.unlink(bind_address)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--address", default=INFERENCE_ADDRESS, help="Unix socket path or host:port")
+    parser.add_argument("--workers", type=int, default=INFERENCE_WORKERS, help="Processes, each holding one model")
+    args = parser.parse_args()
+    run(args.address, args.workers)
@@ -0,0 +1,186 @@
+"""
+Liveness, readiness and graceful drain for rolling restarts.
+
+GET /healthz only says the process is up and its event loop answers; a load
+balancer or orchestrator restarts the node when it fails. GET /readyz answers
+200 only while the node can serve a prediction with low latency:
+
+    model              the model answered recently: a prediction of this worker
+                       succeeded, or, when idle, a status call did (see
+                       Lifecycle._check_model)
+    database           a pooled connection is available and SELECT 1 answers
+    inference_backlog  at most READY_MAX_QUEUED_PREDICTIONS wait for the model
+    draining           the node is not shutting down
+
+On SIGTERM the node turns not-ready at once and answers new predictions with
+503 and Retry-After, so clients retry on another node; everything else is
+still served. After DRAIN_GRACE_SECONDS (time for the load balancer to see
+/readyz fail) it waits up to DRAIN_TIMEOUT_SECONDS for queued predictions to
+finish, hands off whatever is still waiting for a model slot (503, see
+FairScheduler.hand_off) and only then lets uvicorn shut down, which finishes
+the requests in flight. A second SIGTERM, or SIGINT, stops without draining.
+"""
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+from starlette.concurrency import run_in_threadpool
+
+from database import engine
+from inference import inference, InferenceBusy, InferenceUnavailable, InferenceError, INFERENCE_TIMEOUT_SECONDS
+from metrics import registry, model_queue_depth
+from rate_limit import model_scheduler
+
+DRAIN_GRACE_SECONDS = float(os.environ.get("DRAIN_GRACE_SECONDS", 5))
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("DRAIN_TIMEOUT_SECONDS", 60))
+READY_MAX_QUEUED_PREDICTIONS = int(os.environ.get("READY_MAX_QUEUED_PREDICTIONS", 16))
+# Each dependency check gives up after this long and reports not ready
+READY_CHECK_TIMEOUT_SECONDS = 2
+# Probes arrive every few seconds from every balancer; an inference call that
+# succeeded this recently answers for the model without asking it again
+MODEL_CHECK_CACHE_SECONDS = 5
+
+logger = logging.getLogger("uvicorn.error")
+
+predictions_handed_off_total = registry.counter(
+    "predictions_handed_off_total", "Queued predictions answered with 503 while draining"
+)
+
+
+class Lifecycle:
+    def __init__(self):
+        self.draining = False
+        self._loop = None
+        self._previous_handler = None
+        self._drain_task = None
+
+    def start(self):
+        """Call from an async startup handler, after uvicorn installed its signal handlers."""
+        self._loop = asyncio.get_running_loop()
+        # Signal handlers can only be set from the main thread (not under a test client)
+        if threading.current_thread() is threading.main_thread():
+            previous = signal.getsignal(signal.SIGTERM)
+            if callable(previous):
+                self._previous_handler = previous
+                signal.signal(signal.SIGTERM, self._on_sigterm)
+        # Load the model before the first prediction instead of during it;
+        # /readyz reports not ready until this is done
+        threading.Thread(target=self._warm_up, name="model-warm-up", daemon=True).start()
+
+    def _warm_up(self):
+        started = time.perf_counter()
+        try:
+            inference.warm_up()
+        except Exception:
+            logger.exception("Model warm-up failed")
+            return
+        logger.info("Model warmed up in %.1fs", time.perf_counter() - started)
+
+    def _on_sigterm(self, signum, frame):
+        if self.draining:
+            # Asked again: stop now
+            self._previous_handler(signum, frame)
+            return
+        self.draining = True
+        self._loop.call_soon_threadsafe(self._start_drain, signum, frame)
+
+    def _start_drain(self, signum, frame):
+        self._drain_task = self._loop.create_task(self._drain(signum, frame))
+
+    async def _drain(self, signum, frame):
+        logger.info("Draining: not ready, refusing new predictions")
+        await asyncio.sleep(DRAIN_GRACE_SECONDS)
+        deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+        while model_queue_depth.get() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        handed_off = model_scheduler.hand_off()
+        if handed_off:
+            predictions_handed_off_total.inc(handed_off)
+            logger.info("Handed off %d queued predictions", handed_off)
+        # uvicorn's own shutdown then waits for the predictions still running
+        self._previous_handler(signum, frame)
+
+    async def readiness(self):
+        checks = {
+            "draining": {"ok": not self.draining},
+            "model": await self._check_model(),
+            "database": await self._check_database(),
+            "inference_backlog": self._check_backlog(),
+        }
+        return all(check["ok"] for check in checks.values()), checks
+
+    async def _check_model(self):
+        last_success = inference.last_success
+        since = time.monotonic() - last_success if last_success is not None else None
+        if since is not None and since < MODEL_CHECK_CACHE_SECONDS:
+            return {"ok": True, "last_success_seconds_ago": round(since, 1)}
+        if model_queue_depth.get() > 0:
+            # A status call would queue behind these predictions in the service's
+            # backlog; the node is busy, not unready, while they keep completing
+            if since is not None and since < INFERENCE_TIMEOUT_SECONDS:
+                return {"ok": True, "busy": True, "last_success_seconds_ago": round(since, 1)}
+            return {"ok": False, "error": f"no inference completed in the last {INFERENCE_TIMEOUT_SECONDS:g}s"}
+        try:
+            status = await run_in_threadpool(inference.status, timeout=READY_CHECK_TIMEOUT_SECONDS)
+        except InferenceBusy:
+            # Reachable, but working through other API workers' predictions
+            return {"ok": True, "busy": True}
+        except (InferenceUnavailable, InferenceError) as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": bool(status.get("model_loaded")), "backend": status.get("backend")}
+
+    async def _check_database(self):
+        pool = engine.pool
+        if isinstance(pool, QueuePool) and pool._max_overflow >= 0:
+            # A probe must not queue behind requests for a connection; an
+            # exhausted pool means requests are already waiting
+            capacity = pool.size() + pool._max_overflow
+            if pool.checkedout() >= capacity:
+                return {"ok": False, "error": f"connection pool exhausted ({capacity} in use)"}
+        try:
+            await asyncio.wait_for(run_in_threadpool(_ping_database), READY_CHECK_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            return {"ok": False, "error": f"no answer within {READY_CHECK_TIMEOUT_SECONDS}s"}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": True}
+
+    def _check_backlog(self):
+        queued = model_scheduler.queued()
+        return {"ok": queued <= READY_MAX_QUEUED_PREDICTIONS, "queued": queued,
+                "limit": READY_MAX_QUEUED_PREDICTIONS}
+
+
+def _ping_database():
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+
+class DrainMiddleware:
+    """Closes keep-alive connections while draining so clients reconnect through the balancer."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and lifecycle.draining:
+                headers = [(name, value) for name, value in message.get("headers", []) if name.lower() != b"connection"]
+                message = {**message, "headers": headers + [(b"connection", b"close")]}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+lifecycle = Lifecycle()
+registry.gauge("server_draining", "1 while the server drains before shutdown",
+               callback=lambda: int(lifecycle.draining))
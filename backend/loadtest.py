@@ -0,0 +1,213 @@
+"""
+End-to-end load generator for the register -> login -> upload -> predict ->
+comment -> list flow driven by app.py.
+
+In-process against a throwaway SQLite database and a stub model:
+    python loadtest.py --in-process --stub-model --users 50 --duration 60
+
+Over HTTP against a running server:
+    python loadtest.py --url http://localhost:8000 --rate 5 --users 200 --duration 120
+
+--users bounds how many virtual users run concurrently. With --rate, new users
+arrive as a Poisson process at that many per second (open loop); without it,
+every slot is refilled as soon as a user finishes (closed loop).
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+
+import httpx
+import numpy as np
+from PIL import Image
+
+DISEASES = ["bacteria", "fungus", "healthy", "pests", "virus"]
+
+# Relative weights of the list calls made after each prediction, mirroring the
+# pages app.py renders
+LIST_MIX = [
+    ("GET /all-predictions", 3),
+    ("GET /images", 2),
+    ("GET /comments/{image_id}", 3),
+    ("GET /image-details/{image_id}", 4),
+]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        # Open-loop arrivals turned away at the concurrency cap; not requests,
+        # so kept out of the latency and error figures
+        self.arrivals_dropped = 0
+
+    async def call(self, client, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as exc:
+            self.latencies[name].append(time.perf_counter() - started)
+            self.errors[name] += 1
+            self.statuses[name][type(exc).__name__] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - started)
+        self.statuses[name][response.status_code] += 1
+        if response.status_code >= 400:
+            self.errors[name] += 1
+            return None
+        return response
+
+    def report(self, elapsed):
+        header = f"{'endpoint':<32} {'count':>7} {'rps':>8} {'err %':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        lines = [header, "-" * len(header)]
+        total = 0
+        total_errors = 0
+        for name in sorted(self.latencies):
+            samples = np.array(self.latencies[name]) * 1000
+            count = len(samples)
+            total += count
+            total_errors += self.errors[name]
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            lines.append(
+                f"{name:<32} {count:>7} {count / elapsed:>8.1f} {100 * self.errors[name] / count:>6.1f} "
+                f"{p50:>8.1f} {p90:>8.1f} {p99:>8.1f} {samples.max():>8.1f}"
+            )
+        lines.append("-" * len(header))
+        lines.append(f"{'total':<32} {total:>7} {total / elapsed:>8.1f} {100 * total_errors / max(total, 1):>6.1f}")
+        failures = {name: dict(codes) for name, codes in self.statuses.items() if self.errors[name]}
+        if failures:
+            lines.append(f"status breakdown for failing endpoints: {failures}")
+        if self.arrivals_dropped:
+            lines.append(f"arrivals dropped at the concurrency cap: {self.arrivals_dropped}")
+        return "\n".join(lines)
+
+
+def random_jpeg(size=256):
+    # Fresh noise per upload so every image has a distinct hash
+    pixels = np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+async def virtual_user(client, recorder, predictions_per_user):
+    username = f"load_{secrets.token_hex(6)}"
+    password = "loadtest"
+    await recorder.call(client, "POST /register", "POST", "/register",
+                        json={"username": username, "email": f"{username}@example.com", "password": password})
+    response = await recorder.call(client, "POST /login", "POST", "/login",
+                                   json={"username": username, "password": password})
+    if response is None:
+        return
+    login = response.json()
+    headers = {"Authorization": f"Bearer {login['token']}"}
+    user_id = login["user"]["id"]
+
+    for _ in range(predictions_per_user):
+        response = await recorder.call(client, "POST /upload", "POST", "/upload", headers=headers,
+                                       files={"file": ("leaf.jpg", random_jpeg(), "image/jpeg")})
+        if response is None:
+            continue
+        image_id = response.json()["image"]["id"]
+        await recorder.call(client, "POST /predict", "POST", "/predict", headers=headers, json={"image_id": image_id})
+        await recorder.call(client, "POST /comment", "POST", "/comment", headers=headers,
+                            json={"image_id": image_id, "user_id": user_id, "comment_text": "load test comment"})
+        names, weights = zip(*LIST_MIX)
+        for name in random.choices(names, weights=weights, k=2):
+            path = name.split(" ", 1)[1].replace("{image_id}", str(image_id))
+            await recorder.call(client, name, "GET", path, headers=headers)
+
+    await recorder.call(client, "POST /logout", "POST", "/logout", params={"token": login["token"]})
+
+
+async def run(client, users, duration, rate, predictions_per_user):
+    recorder = Recorder()
+    slots = asyncio.Semaphore(users)
+    deadline = time.perf_counter() + duration
+    tasks = set()
+
+    async def guarded():
+        try:
+            await virtual_user(client, recorder, predictions_per_user)
+        finally:
+            slots.release()
+
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        if rate:
+            await asyncio.sleep(random.expovariate(rate))
+            if slots.locked():
+                # Open loop: arrivals beyond the concurrency cap are dropped and counted
+                recorder.arrivals_dropped += 1
+                continue
+        await slots.acquire()
+        task = asyncio.create_task(guarded())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return recorder, time.perf_counter() - started
+
+
+def install_stub_model():
+    # Replaces ml_model before main imports it so no TensorFlow is loaded, and
+    # runs it in-process instead of through the inference service
+    os.environ["INFERENCE_BACKEND"] = "local"
+    stub = types.ModuleType("ml_model")
+
+    def predict_probabilities(image_path):
+        time.sleep(0.02)
+        return np.random.dirichlet(np.full(len(DISEASES), 0.3)).astype(np.float32), np.random.rand(1056).astype(np.float32)
+
+    stub.predict_probabilities = predict_probabilities
+    stub.warm_up = lambda: None
+    sys.modules["ml_model"] = stub
+
+
+def in_process_client(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'loadtest.db')}")
+    os.environ.setdefault("SESSION_SQLITE_PATH", os.path.join(workdir, "sessions.db"))
+    if args.stub_model:
+        install_stub_model()
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from main import app
+
+    print(f"in-process run, working directory {workdir}")
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=60)
+
+
+async def main_async(args):
+    if args.in_process:
+        client = in_process_client(args)
+    else:
+        limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+        client = httpx.AsyncClient(base_url=args.url, timeout=60, limits=limits)
+    async with client:
+        recorder, elapsed = await run(client, args.users, args.duration, args.rate, args.predictions_per_user)
+    print(f"ran for {elapsed:.1f}s with up to {args.users} concurrent users")
+    print(recorder.report(elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running API server")
+    target.add_argument("--in-process", action="store_true", help="Drive main.app directly through ASGI")
+    parser.add_argument("--stub-model", action="store_true", help="In-process only: replace the model with a 20 ms stub")
+    parser.add_argument("--workdir", help="In-process only: directory for the SQLite database and uploads")
+    parser.add_argument("--users", type=int, default=10, help="Maximum concurrent virtual users")
+    parser.add_argument("--rate", type=float, default=None, help="New users per second (open loop)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to keep starting new users")
+    parser.add_argument("--predictions-per-user", type=int, default=3)
+    asyncio.run(main_async(parser.parse_args()))
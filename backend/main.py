@@ -1,4 +1,4 @@
-from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, status, Header, Body
+from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, status, Header, Body, Request, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
@@ -6,22 +6,47 @@ from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from typing import List, Optional
 import os
+import logging
 import shutil
 import hashlib
 from datetime import datetime, timedelta
 import secrets
+import time
 from typing import Dict
 import models
 import schemas
 from database import SessionLocal, engine
-from ml_model import predict_disease
-from fastapi.responses import FileResponse
-from sqlalchemy import or_,func,and_
+import stats
+from sessions import session_store, user_cache, resolve_user
+from activity_log import activity_writer
+from streaming import listing_response, json_response, wants_ndjson
+import http_cache
+from details_cache import details_cache, CachedDetails
+from metrics import (registry, MetricsMiddleware, PROMETHEUS_CONTENT_TYPE,
+                     upload_stage_seconds, predict_stage_seconds, model_queue_depth, predict_rate_limited_total)
+from rate_limit import predict_limiter, model_scheduler, quota_for, RateLimited, QueueClosed
+import profiling
+import query_stats
+from inference import inference, InferenceUnavailable
+from lifecycle import lifecycle, DrainMiddleware
+import calibration
+import comment_search
+from similarity import embedding_index
+from upload_validation import validate_image_bytes, UploadRejected, UPLOAD_MAX_BYTES, FORMAT_EXTENSIONS
+from fastapi.responses import FileResponse, Response, PlainTextResponse
+# Marks the worker thread as serving a sampled request (see profiling.py)
+from profiling import run_in_threadpool
+from sqlalchemy import or_,func,and_,select
 
 os.makedirs("uploads", exist_ok=True)
 
 app = FastAPI()
+app.router.route_class = profiling.ProfiledRoute
 security = HTTPBearer()
+logger = logging.getLogger("uvicorn.error")
+
+# Search endpoints stop counting here; larger result sets report a lower-bound estimate
+SEARCH_COUNT_CAP = 10000
 
 
 @app.get("/")
@@ -32,8 +57,43 @@ async def read_root():
     """
     return {"App": "Working"}
 
-# Create tables
+@app.get("/healthz")
+async def liveness():
+    # The process is up and its event loop answers; see /readyz for whether it should get traffic
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readiness(response: Response):
+    """Model warmed, database reachable, inference backlog short and not draining (see lifecycle.py)."""
+    ready, checks = await lifecycle.readiness()
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ready" if ready else "not ready", "checks": checks}
+
+# Create tables. Changes to existing tables (new columns and indexes) are left
+# to `python models.py migrate`, run once per deploy rather than by every worker
 models.Base.metadata.create_all(bind=engine)
+pending_migrations = models.pending_migrations(engine)
+if pending_migrations:
+    logger.warning("Database schema lacks %s; run: python models.py migrate", ", ".join(pending_migrations))
+# Native full-text index where the database has one, else the comment_terms index
+comment_searcher = comment_search.create_comment_search(engine)
+# Per-route SQL counts, DB time and the slow-query log
+query_stats.instrument(engine)
+
+@app.on_event("startup")
+def start_activity_writer():
+    activity_writer.start()
+
+@app.on_event("startup")
+async def start_lifecycle():
+    # Async so it runs on the main thread, where the SIGTERM handler is installed
+    lifecycle.start()
+
+@app.on_event("shutdown")
+def stop_activity_writer():
+    # Drain queued login/logout events before the process exits
+    activity_writer.stop()
 
 # Mount static files
 # app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -47,6 +107,19 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Request counters, latency and in-flight gauge for /metrics
+app.add_middleware(MetricsMiddleware)
+# Opens sampling-profiler windows for a fraction of requests (off by default)
+app.add_middleware(profiling.ProfilingMiddleware)
+# Attributes SQL statements to the route that issued them
+app.add_middleware(query_stats.QueryStatsMiddleware)
+# Closes keep-alive connections while draining for shutdown
+app.add_middleware(DrainMiddleware)
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 # Dependency to get the database session
 def get_db():
     db = SessionLocal()
@@ -55,19 +128,25 @@ def get_db():
     finally:
         db.close()
 
-# In-memory store for sessions (not for production use)
-user_sessions = {}
+# Sessions live in a shared store (see sessions.py) so tokens work across workers and nodes
 #FastAPI uses Depends() to declare dependencies. Dependencies are functions or objects that are provided automatically by the framework when needed in other parts of the code.
 def get_user_from_token(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
     token = credentials.credentials
-    user_id = user_sessions.get(token)
+    # Looked up on the request's own session; repeat requests hit the token cache
+    user_id = session_store.get(token, db)
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = resolve_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
+def require_admin(user: models.User = Depends(get_user_from_token)):
+    # Admins are configured through the ADMIN_USERNAMES environment variable
+    if user.username not in profiling.ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
 @app.get("/check-user/{username}")
 def check_user_exists(username: str, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == username).first()
@@ -92,23 +171,23 @@ def login_user(user: schemas.UserLogin, db: Session = Depends(get_db)):
     
     # Generate a session token
     token = secrets.token_hex(16)
-    user_sessions[token] = db_user.id
+    session_store.create(token, db_user.id)
+    # Occasionally sweep sessions that expired without a logout
+    if secrets.randbelow(100) == 0:
+        session_store.purge_expired()
 
-    # Log the login activity
-    activity_log = models.ActivityLog(user_id=db_user.id, activity_type="login")
-    db.add(activity_log)
-    db.commit()
+    # Log the login activity (written behind by activity_writer)
+    activity_writer.log(db_user.id, "login")
     
     return {"token": token, "user": schemas.User.model_validate(db_user)}
 
 @app.post("/logout")
 def logout_user(token: str, db: Session = Depends(get_db)):
-    if token in user_sessions:
-        user_id = user_sessions.pop(token)
+    user_id = session_store.delete(token)
+    if user_id is not None:
+        user_cache.invalidate(user_id)
         # Log the logout activity
-        activity_log = models.ActivityLog(user_id=user_id, activity_type="logout")
-        db.add(activity_log)
-        db.commit()
+        activity_writer.log(user_id, "logout")
         return {"message": "Logged out successfully"}
     raise HTTPException(status_code=401, detail="Invalid token")
 
@@ -116,60 +195,147 @@ def logout_user(token: str, db: Session = Depends(get_db)):
 @app.post("/upload", response_model=schemas.UploadResponse)
 async def upload_image(
     file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=64),
     user: models.User = Depends(get_user_from_token),
     db: Session = Depends(get_db)
 ):
     # Ensure uploads directory exists
     os.makedirs("uploads", exist_ok=True)
     
-    # Generate hash
-    file_contents = await file.read()
-    file_hash = hashlib.md5(file_contents).hexdigest()
-    
+    async with profiling.upload_allocations.track():
+        return await _store_upload(file, user, db, idempotency_key)
+
+# Attempts of the upload transaction; a retry only happens after losing an
+# insert race on the image hash or idempotency key, and then finds the winner's row
+UPLOAD_TRANSACTION_ATTEMPTS = 3
+# How long an Idempotency-Key replays its upload; afterwards it may be reused
+UPLOAD_IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("UPLOAD_IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+
+def idempotency_cutoff():
+    return datetime.now() - timedelta(seconds=UPLOAD_IDEMPOTENCY_TTL_SECONDS)
+
+def purge_expired_idempotency_keys(db: Session):
+    db.query(models.UploadIdempotencyKey).filter(
+        models.UploadIdempotencyKey.created_at <= idempotency_cutoff()
+    ).delete(synchronize_session=False)
+    db.commit()
 
-    # Check if an image with this hash already exists
-    existing_image = db.query(models.Image).filter(models.Image.hash == file_hash).first()
-    if existing_image:
-        upload_record = models.ImageUpload(image_id=existing_image.id, user_id=user.id)
-        db.add(upload_record)
-        db.commit()
-        db.refresh(upload_record)
-        return schemas.UploadResponse(image=existing_image, upload=upload_record)
-    
-    # If no existing image, proceed with upload
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}{file_extension}"
-    file_path = os.path.join("uploads", unique_filename)
-    
-    # Save the file
-    with open(file_path, "wb") as buffer:
+def _write_content_addressed(file_path, file_contents):
+    # Same name means same bytes, so an existing file is already correct; the
+    # rename makes a half-written file impossible to observe
+    if os.path.exists(file_path):
+        return False
+    tmp_path = f"{file_path}.{secrets.token_hex(8)}.tmp"
+    with open(tmp_path, "wb") as buffer:
         buffer.write(file_contents)
-    
-    # Create database entry
-    db_image = models.Image(
-        filename=unique_filename,
-        content_type=file.content_type,
-        hash=file_hash,
-        user_id=user.id
-    )
-    db.add(db_image)
+    os.replace(tmp_path, file_path)
+    return True
+
+def _upload_transaction(db: Session, user_id: int, file_hash: str, filename: str, content_type: str,
+                        file_contents: bytes, idempotency_key: Optional[str]):
+    """
+    Insert-or-get the image by hash and record the upload in one transaction.
+    Only the request that inserts the image writes its file, and it does so
+    after every INSERT is flushed, so any concurrent insert of the same hash
+    waits on the unique index until this transaction ends. Returns (image,
+    upload, wrote_file); the caller commits.
+    """
+    if idempotency_key is not None:
+        used_key = db.query(models.UploadIdempotencyKey).filter(
+            models.UploadIdempotencyKey.user_id == user_id, models.UploadIdempotencyKey.key == idempotency_key
+        ).first()
+        if used_key is not None and used_key.created_at <= idempotency_cutoff():
+            # Expired but not swept yet: free the key for this upload
+            db.delete(used_key)
+            db.flush()
+        elif used_key is not None:
+            replay = db.get(models.ImageUpload, used_key.image_upload_id)
+            if replay.image.hash != file_hash:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different file")
+            return replay.image, replay, False
+
+    with upload_stage_seconds.time(stage="lookup"):
+        db_image = db.query(models.Image).filter(models.Image.hash == file_hash).first()
+    new_image = db_image is None
+    if new_image:
+        db_image = models.Image(filename=filename, content_type=content_type, hash=file_hash, user_id=user_id)
+        db.add(db_image)
+        db.flush()
+
+    upload_record = models.ImageUpload(image_id=db_image.id, user_id=user_id)
+    db.add(upload_record)
+    db.flush()
+    if idempotency_key is not None:
+        db.add(models.UploadIdempotencyKey(user_id=user_id, key=idempotency_key, image_upload_id=upload_record.id))
+        db.flush()
+
+    # Last step before the commit, so nothing but the commit can fail after it
+    wrote_file = False
+    if new_image:
+        with upload_stage_seconds.time(stage="write"):
+            wrote_file = _write_content_addressed(os.path.join("uploads", filename), file_contents)
+    return db_image, upload_record, wrote_file
+
+async def _store_upload(file: UploadFile, user: models.User, db: Session, idempotency_key: Optional[str] = None):
+    # Read at most one byte past the limit so an oversized body is never buffered whole
+    with upload_stage_seconds.time(stage="read"):
+        file_contents = await file.read(UPLOAD_MAX_BYTES + 1)
+
+    # Reject non-images, corrupt headers and oversized images before any write
     try:
-        db.commit()
+        with upload_stage_seconds.time(stage="validate"):
+            image_format, _, _ = validate_image_bytes(file_contents)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    # Generate hash
+    with upload_stage_seconds.time(stage="hash"):
+        file_hash = hashlib.md5(file_contents).hexdigest()
+
+    # Files are named by content, so concurrent or repeated uploads of the same
+    # bytes all point at one file
+    filename = f"{file_hash}{FORMAT_EXTENSIONS[image_format]}"
+
+    # The transaction blocks on the pool, the database and the disk, so it
+    # runs off the event loop
+    return await run_in_threadpool(
+        _commit_upload, db, user.id, file_hash, filename, file.content_type, file_contents, idempotency_key
+    )
+
+def _commit_upload(db: Session, user_id: int, file_hash: str, filename: str, content_type: str,
+                   file_contents: bytes, idempotency_key: Optional[str]):
+    for attempt in range(UPLOAD_TRANSACTION_ATTEMPTS):
+        wrote_file = False
+        try:
+            db_image, upload_record, wrote_file = _upload_transaction(
+                db, user_id, file_hash, filename, content_type, file_contents, idempotency_key
+            )
+            with upload_stage_seconds.time(stage="commit"):
+                db.commit()
+        except Exception as e:
+            # Remove a file this attempt wrote before rolling back: until then the
+            # uncommitted image row keeps any concurrent uploader of the same
+            # bytes waiting, so it cannot have started relying on the file
+            if wrote_file:
+                os.remove(os.path.join("uploads", filename))
+            db.rollback()
+            if isinstance(e, IntegrityError):
+                # Another request committed the same hash or idempotency key first
+                continue
+            raise
         db.refresh(db_image)
-    except IntegrityError:
-        db.rollback()
-        raise HTTPException(status_code=400, detail="Error uploading image. Please try again.")
-    
-    # Create upload record
-    upload_record = models.ImageUpload(image_id=db_image.id, user_id=user.id)
-    db.add(upload_record)
-    db.commit()
-    db.refresh(upload_record)
-    
-    return schemas.UploadResponse(image=db_image, upload=upload_record)
+        db.refresh(upload_record)
+        response = schemas.UploadResponse(image=db_image, upload=upload_record)
+        # Occasionally sweep idempotency keys past their TTL
+        if idempotency_key is not None and secrets.randbelow(100) == 0:
+            purge_expired_idempotency_keys(db)
+        return response
 
-@app.post("/predict", response_model=schemas.Prediction)
+    raise HTTPException(status_code=409, detail="Upload conflicted with concurrent uploads. Please try again.")
+
+@app.post("/predict", response_model=schemas.PredictionWithTopK)
 async def predict(
+    response: Response,
     data: Dict[str, int] = Body(...),
     user: models.User = Depends(get_user_from_token),
     db: Session = Depends(get_db)
@@ -178,32 +344,90 @@ async def predict(
     if image_id is None:
         raise HTTPException(status_code=400, detail="image_id is required")
 
-    db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
+    # A draining server takes no new work; the client retries on another node
+    if lifecycle.draining:
+        raise HTTPException(status_code=503, detail="Server is shutting down, retry later",
+                            headers={"Retry-After": "1"})
+
+    # Per-user token bucket; keyed on the user behind the session token so
+    # logging in again does not reset the quota
+    user_id = user.id
+    quota = quota_for(user.username)
+    try:
+        response.headers.update(predict_limiter.acquire(user_id, quota))
+    except RateLimited as e:
+        predict_rate_limited_total.inc(reason=e.reason)
+        raise HTTPException(status_code=429, detail="Prediction rate limit exceeded, retry later", headers=e.headers)
+
+    with predict_stage_seconds.time(stage="lookup"):
+        db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
     if db_image is None:
         raise HTTPException(status_code=404, detail="Image not found")
     
     # Perform prediction
     image_path = os.path.join("uploads", db_image.filename)
-    if not os.path.exists(image_path):
+    with predict_stage_seconds.time(stage="file_check"):
+        image_exists = os.path.exists(image_path)
+    if not image_exists:
         raise HTTPException(status_code=404, detail="Image file not found")
     
+    # End the read transaction so the pooled connection is not held while
+    # waiting for the model
+    db.rollback()
+
+    # Wait for a model slot in weighted fair order across users, then hand the
+    # image to the inference service off the event loop
     try:
-        disease, confidence = predict_disease(image_path)
+        with model_queue_depth.track_inprogress():
+            queued_at = time.perf_counter()
+            async with model_scheduler.slot(user_id, weight=quota.weight):
+                predict_stage_seconds.observe(time.perf_counter() - queued_at, stage="queue")
+                probabilities, embedding = await run_in_threadpool(inference.predict, image_path)
+    except RateLimited as e:
+        predict_rate_limited_total.inc(reason=e.reason)
+        raise HTTPException(status_code=429, detail="Too many predictions queued, retry later", headers=e.headers)
+    except QueueClosed:
+        # Still queued when the drain timed out
+        raise HTTPException(status_code=503, detail="Server is shutting down, retry later",
+                            headers={"Retry-After": "1"})
+    except InferenceUnavailable:
+        raise HTTPException(status_code=503, detail="Prediction service unavailable, retry later",
+                            headers={"Retry-After": "5"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during prediction: {str(e)}")
     
-    # Create database entry
+    # The full vector is stored so the label can be re-derived later without
+    # running the model again
+    disease, confidence, top_k = calibration.classify(probabilities)
     db_prediction = models.Prediction(
-        image_id=db_image.id,
-        user_id=user.id,
+        image_id=image_id,
+        user_id=user_id,
         disease=disease,
-        confidence=confidence
+        confidence=confidence,
+        probabilities=calibration.pack(probabilities)
     )
     db.add(db_prediction)
-    db.commit()
-    db.refresh(db_prediction)
+    with predict_stage_seconds.time(stage="commit"):
+        db.commit()
+        db.refresh(db_prediction)
+    details_cache.invalidate(image_id)
+
+    # Keep the embedding for /similar lookups; only for saved predictions, and
+    # the index is best effort, so a failure here must not fail the request
+    try:
+        await run_in_threadpool(embedding_index.add, image_id, embedding)
+    except Exception:
+        logger.exception("Could not add the embedding of image %s to the similarity index", image_id)
     
-    return db_prediction
+    return schemas.PredictionWithTopK(
+        id=db_prediction.id,
+        disease=db_prediction.disease,
+        confidence=db_prediction.confidence,
+        predicted_at=db_prediction.predicted_at,
+        image_id=db_prediction.image_id,
+        user_id=db_prediction.user_id,
+        top_k=top_k
+    )
 
 
 @app.post("/comment", response_model=schemas.CommentWithUser)
@@ -212,6 +436,7 @@ async def add_comment(comment: schemas.CommentCreate, db: Session = Depends(get_
     db.add(db_comment)
     db.commit()
     db.refresh(db_comment)
+    details_cache.invalidate(db_comment.image_id)
     
     # Fetch the associated user
     user = db.query(models.User).filter(models.User.id == db_comment.user_id).first()
@@ -229,24 +454,125 @@ async def add_comment(comment: schemas.CommentCreate, db: Session = Depends(get_
         ) if user else None
     )
 
+def comment_with_user_row(row):
+    return {
+        "id": row["id"],
+        "image_id": row["image_id"],
+        "user_id": row["user_id"],
+        "comment_text": row["comment_text"],
+        "created_at": row["created_at"],
+        "user": {"id": row["user_id"], "username": row["username"], "email": row["email"]},
+    }
+
+def comments_with_users(db: Session, image_id: int):
+    # Comments and their authors in one query
+    statement = select(
+        models.Comment.id,
+        models.Comment.image_id,
+        models.Comment.user_id,
+        models.Comment.comment_text,
+        models.Comment.created_at,
+        models.User.username,
+        models.User.email
+    ).join(
+        models.User, models.User.id == models.Comment.user_id
+    ).where(models.Comment.image_id == image_id).order_by(models.Comment.id)
+    return [comment_with_user_row(row) for row in db.execute(statement).mappings()]
+
+def prediction_labels_epoch(db: Session):
+    # Bumped when calibration.py backfill rewrites stored diseases and
+    # confidences, which no count or max id of the predictions would show
+    return models.read_epoch(db, calibration.PREDICTION_LABELS_EPOCH)
+
+def comment_validator(image_id: int):
+    # Comments are append-only, so count and max id change whenever the list does
+    return select(
+        func.count(models.Comment.id),
+        func.max(models.Comment.id),
+        func.max(models.Comment.created_at)
+    ).where(models.Comment.image_id == image_id)
+
+def comment_search_row(row, score):
+    return {
+        "score": score,
+        "comment": comment_with_user_row(row),
+        "filename": row["filename"],
+        "uploaded_at": row["uploaded_at"],
+        "prediction": {
+            "id": row["prediction_id"],
+            "disease": row["disease"],
+            "confidence": row["confidence"],
+            "predicted_at": row["predicted_at"],
+            "image_id": row["image_id"],
+            "user_id": row["prediction_user_id"],
+            "top_k": calibration.top_k(row["probabilities"]),
+        } if row["prediction_id"] is not None else None,
+    }
+
+# Declared before /comments/{image_id} so "search" is not taken for an image id
+@app.get("/comments/search", response_model=schemas.CommentSearchPage)
+def search_comments(
+    q: str = Query(..., min_length=1, max_length=200),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """
+    Ranked full-text search over all comments, e.g. ?q=leaf+curl. Every word
+    must occur in a comment for it to match (see comment_search.py).
+    """
+    terms = comment_search.query_terms(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    hits, total = comment_searcher.page(db, terms, (page - 1) * page_size, page_size, SEARCH_COUNT_CAP + 1)
+    total_is_estimate = total > SEARCH_COUNT_CAP
+    if total_is_estimate:
+        total = max(SEARCH_COUNT_CAP, (page - 1) * page_size + len(hits))
+
+    # One query for the page: comment, author, image and the image's first prediction
+    first_prediction_id = select(func.min(models.Prediction.id)).where(
+        models.Prediction.image_id == models.Comment.image_id
+    ).correlate(models.Comment).scalar_subquery()
+    statement = select(
+        models.Comment.id,
+        models.Comment.image_id,
+        models.Comment.user_id,
+        models.Comment.comment_text,
+        models.Comment.created_at,
+        models.User.username,
+        models.User.email,
+        models.Image.filename,
+        models.Image.uploaded_at,
+        models.Prediction.id.label("prediction_id"),
+        models.Prediction.disease,
+        models.Prediction.confidence,
+        models.Prediction.predicted_at,
+        models.Prediction.user_id.label("prediction_user_id"),
+        models.Prediction.probabilities
+    ).join(
+        models.User, models.User.id == models.Comment.user_id
+    ).join(
+        models.Image, models.Image.id == models.Comment.image_id
+    ).outerjoin(
+        models.Prediction, models.Prediction.id == first_prediction_id
+    ).where(models.Comment.id.in_([comment_id for comment_id, _ in hits]))
+    rows = {row["id"]: row for row in db.execute(statement).mappings()}
+
+    return {
+        "items": [comment_search_row(rows[comment_id], score) for comment_id, score in hits if comment_id in rows],
+        "page": page,
+        "page_size": page_size,
+        "total": total,
+        "total_is_estimate": total_is_estimate,
+    }
+
 @app.get("/comments/{image_id}", response_model=List[schemas.CommentWithUser])
-async def get_comments(image_id: int, db: Session = Depends(get_db)):
-    comments = db.query(models.Comment).filter(models.Comment.image_id == image_id).all()
-    
-    # Fetch user information for each comment
-    comments_with_users = []
-    for comment in comments:
-        user = db.query(models.User).filter(models.User.id == comment.user_id).first()
-        comments_with_users.append(schemas.CommentWithUser(
-            id=comment.id,
-            image_id=comment.image_id,
-            user_id=comment.user_id,
-            comment_text=comment.comment_text,
-            created_at=comment.created_at,
-            user=schemas.User(id=user.id, username=user.username, email=user.email)
-        ))
-    
-    return comments_with_users
+def get_comments(image_id: int, request: Request, db: Session = Depends(get_db)):
+    count, last_id, last_created = db.execute(comment_validator(image_id)).one()
+    conditional = http_cache.Conditional(request, http_cache.make_etag("comments", image_id, count, last_id), last_created)
+    if conditional.not_modified:
+        return conditional.not_modified_response()
+    return conditional.respond(json_response(comments_with_users(db, image_id)))
 
 
 
@@ -288,7 +614,16 @@ def list_images(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
     ) for upload in image_uploads]'''
 
 @app.get("/images", response_model=List[schemas.UserImageUpload])
-def list_images(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), user: models.User = Depends(get_user_from_token)):
+def list_images(request: Request, skip: int = 0, limit: int = 100, db: Session = Depends(get_db), user: models.User = Depends(get_user_from_token)):
+    count, last_id, last_uploaded = db.execute(select(
+        func.count(models.ImageUpload.id),
+        func.max(models.ImageUpload.id),
+        func.max(models.ImageUpload.uploaded_at)
+    ).where(models.ImageUpload.user_id == user.id)).one()
+    conditional = http_cache.Conditional(request, http_cache.make_etag("images", user.id, skip, limit, count, last_id), last_uploaded)
+    if conditional.not_modified:
+        return conditional.not_modified_response()
+
     # Subquery to get the latest upload for each image by the user
     latest_uploads = db.query(
         models.ImageUpload.image_id,
@@ -313,13 +648,13 @@ def list_images(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
     ).order_by(
         models.ImageUpload.uploaded_at.desc()
     ).offset(skip).limit(limit).all()
-    return [schemas.UserImageUpload(
+    return conditional.respond(json_response([schemas.UserImageUpload(
         id=upload.image.id,
         filename=upload.image.filename,
         content_type=upload.image.content_type,
         uploaded_at=upload.uploaded_at,
         user_id=upload.user_id
-    ) for upload in image_uploads]
+    ) for upload in image_uploads]))
 
 '''If a user uploads the same image multiple times:
 There will be multiple entries in the image_uploads table.
@@ -338,93 +673,319 @@ async def get_image(image_filename: str):
     raise HTTPException(status_code=404, detail="Image not found")
 
 
+# Listing endpoints below select only the columns they return and hand plain dicts
+# to streaming.listing_response, which either serializes them in one pass or,
+# with ?format=ndjson / Accept: application/x-ndjson, streams them from a
+# server-side cursor.
+def activity_log_with_user_row(row):
+    return {
+        "id": row["id"],
+        "user_id": row["user_id"],
+        "activity_type": row["activity_type"],
+        "timestamp": row["timestamp"],
+        "user": {"id": row["user_id"], "username": row["username"], "email": row["email"]},
+    }
+
 @app.get("/activity-logs", response_model=List[schemas.ActivityLogWithUser])
-async def get_activity_logs(db: Session = Depends(get_db)):
-    logs = db.query(models.ActivityLog).all()
-    
-    # Fetch user information for each log
-    logs_with_users = []
-    for log in logs:
-        user = db.query(models.User).filter(models.User.id == log.user_id).first()
-        logs_with_users.append(schemas.ActivityLogWithUser(
-            id=log.id,
-            user_id=log.user_id,
-            activity_type=log.activity_type,
-            timestamp=log.timestamp,
-            user=schemas.User(id=user.id, username=user.username, email=user.email)
-        ))
-    
-    return logs_with_users
+def get_activity_logs(request: Request, response_format: Optional[str] = Query(None, alias="format"), db: Session = Depends(get_db)):
+    statement = select(
+        models.ActivityLog.id,
+        models.ActivityLog.user_id,
+        models.ActivityLog.activity_type,
+        models.ActivityLog.timestamp,
+        models.User.username,
+        models.User.email
+    ).join(models.User, models.User.id == models.ActivityLog.user_id).order_by(models.ActivityLog.id)
+    return listing_response(request, response_format, db, statement, activity_log_with_user_row)
+
+@app.get("/activity-logs/writer-stats")
+def get_activity_writer_stats():
+    # Queue depth and flush latency of the write-behind activity logger
+    return activity_writer.stats()
 
 @app.get("/user/{user_id}/activity", response_model=List[schemas.ActivityLog])
-def get_user_activity(user_id: int, db: Session = Depends(get_db)):
-    logs = db.query(models.ActivityLog).filter(models.ActivityLog.user_id == user_id).all()
-    return [schemas.ActivityLog.model_validate(log) for log in logs]
-
+def get_user_activity(user_id: int, request: Request, response_format: Optional[str] = Query(None, alias="format"), db: Session = Depends(get_db)):
+    statement = select(
+        models.ActivityLog.id,
+        models.ActivityLog.user_id,
+        models.ActivityLog.activity_type,
+        models.ActivityLog.timestamp
+    ).filter(models.ActivityLog.user_id == user_id).order_by(models.ActivityLog.id)
+    return listing_response(request, response_format, db, statement, dict)
+
+
+def image_with_prediction_row(row):
+    return {
+        "id": row["id"],
+        "filename": row["filename"],
+        "uploaded_at": row["uploaded_at"],
+        "prediction": {
+            "id": row["prediction_id"],
+            "disease": row["disease"],
+            "confidence": row["confidence"],
+            "predicted_at": row["predicted_at"],
+            "image_id": row["id"],
+            "user_id": row["prediction_user_id"],
+        },
+    }
 
 @app.get("/all-predictions", response_model=List[schemas.ImageWithPrediction])
-async def get_all_predictions(db: Session = Depends(get_db)):
-    # Query all images that have predictions
-    images_with_predictions = db.query(models.Image).join(models.Prediction).all()
-    
-    result = []
-    for image in images_with_predictions:
-        prediction = db.query(models.Prediction).filter(models.Prediction.image_id == image.id).first()
-        result.append(schemas.ImageWithPrediction(
-            id=image.id,
-            filename=image.filename,
-            uploaded_at=image.uploaded_at,
-            prediction=schemas.Prediction(
-                id=prediction.id,
-                disease=prediction.disease,
-                confidence=prediction.confidence,
-                predicted_at=prediction.predicted_at,
-                image_id=prediction.image_id,
-                user_id=prediction.user_id
-            )
-        ))
-    
-    return result
+def get_all_predictions(request: Request, response_format: Optional[str] = Query(None, alias="format"), db: Session = Depends(get_db)):
+    count, last_id, last_predicted = db.execute(select(
+        func.count(models.Prediction.id),
+        func.max(models.Prediction.id),
+        func.max(models.Prediction.predicted_at)
+    )).one()
+    labels_epoch, labels_changed = prediction_labels_epoch(db)
+    ndjson = wants_ndjson(request, response_format)
+    last_modified = max((value for value in (last_predicted, labels_changed) if value is not None), default=None)
+    conditional = http_cache.Conditional(
+        request, http_cache.make_etag("all-predictions", ndjson, count, last_id, labels_epoch), last_modified
+    )
+    if conditional.not_modified:
+        return conditional.not_modified_response()
+
+    # One row per image that has predictions, paired with its first prediction
+    first_prediction = select(
+        func.min(models.Prediction.id).label("id")
+    ).group_by(models.Prediction.image_id).subquery()
+    statement = select(
+        models.Image.id,
+        models.Image.filename,
+        models.Image.uploaded_at,
+        models.Prediction.id.label("prediction_id"),
+        models.Prediction.disease,
+        models.Prediction.confidence,
+        models.Prediction.predicted_at,
+        models.Prediction.user_id.label("prediction_user_id")
+    ).join(
+        models.Prediction, models.Prediction.image_id == models.Image.id
+    ).join(
+        first_prediction, first_prediction.c.id == models.Prediction.id
+    ).order_by(models.Image.id)
+    return conditional.respond(listing_response(request, response_format, db, statement, image_with_prediction_row))
+
+@app.get("/predictions/search", response_model=schemas.PredictionSearchPage)
+def search_predictions(
+    disease: Optional[List[schemas.DiseaseClass]] = Query(None),
+    min_confidence: Optional[float] = Query(None, ge=0, le=1),
+    max_confidence: Optional[float] = Query(None, ge=0, le=1),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    days: Optional[int] = Query(None, ge=1),
+    uploader_id: Optional[int] = None,
+    sort: schemas.PredictionSortField = schemas.PredictionSortField.predicted_at,
+    descending: bool = True,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_db)
+):
+    """
+    Filter predictions server-side, e.g. ?disease=virus&max_confidence=0.6&days=7.
+    min_confidence is inclusive and max_confidence exclusive. Each filter maps
+    onto an index declared on models.Prediction / models.Image.
+    """
+    filters = []
+    if disease:
+        filters.append(models.Prediction.disease.in_([d.value for d in disease]))
+    if min_confidence is not None:
+        filters.append(models.Prediction.confidence >= min_confidence)
+    if max_confidence is not None:
+        filters.append(models.Prediction.confidence < max_confidence)
+    if days is not None:
+        recent = datetime.now() - timedelta(days=days)
+        since = max(since, recent) if since else recent
+    if since is not None:
+        filters.append(models.Prediction.predicted_at >= since)
+    if until is not None:
+        filters.append(models.Prediction.predicted_at < until)
+    if uploader_id is not None:
+        filters.append(models.Image.user_id == uploader_id)
+
+    base = select(
+        models.Prediction.id,
+        models.Prediction.disease,
+        models.Prediction.confidence,
+        models.Prediction.predicted_at,
+        models.Prediction.image_id,
+        models.Prediction.user_id,
+        models.Image.filename,
+        models.Image.uploaded_at,
+        models.Image.user_id.label("uploader_id")
+    ).join(models.Image, models.Image.id == models.Prediction.image_id).where(*filters)
+
+    sort_column = {
+        schemas.PredictionSortField.predicted_at: models.Prediction.predicted_at,
+        schemas.PredictionSortField.confidence: models.Prediction.confidence,
+        schemas.PredictionSortField.uploaded_at: models.Image.uploaded_at,
+    }[sort]
+    order = [sort_column.desc(), models.Prediction.id.desc()] if descending else [sort_column.asc(), models.Prediction.id.asc()]
+    rows = db.execute(
+        base.order_by(*order).offset((page - 1) * page_size).limit(page_size)
+    ).mappings().all()
+
+    # Count at most SEARCH_COUNT_CAP + 1 matching rows so broad filters stay cheap
+    capped = select(models.Prediction.id).join(
+        models.Image, models.Image.id == models.Prediction.image_id
+    ).where(*filters).limit(SEARCH_COUNT_CAP + 1).subquery()
+    total = db.execute(select(func.count()).select_from(capped)).scalar()
+    total_is_estimate = total > SEARCH_COUNT_CAP
+    if total_is_estimate:
+        total = max(SEARCH_COUNT_CAP, (page - 1) * page_size + len(rows))
+
+    return {
+        "items": [dict(row) for row in rows],
+        "page": page,
+        "page_size": page_size,
+        "total": total,
+        "total_is_estimate": total_is_estimate,
+    }
+
+def image_details_validators(db: Session, image_id: int):
+    # The image's upload time, its first prediction and its comments decide the payload
+    uploaded_at = db.execute(select(models.Image.uploaded_at).where(models.Image.id == image_id)).first()
+    if uploaded_at is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    first_prediction_id, last_predicted = db.execute(select(
+        func.min(models.Prediction.id), func.max(models.Prediction.predicted_at)
+    ).where(models.Prediction.image_id == image_id)).one()
+    comment_count, last_comment_id, last_commented = db.execute(comment_validator(image_id)).one()
+    labels_epoch, labels_changed = prediction_labels_epoch(db)
+    last_modified = max(
+        value for value in (uploaded_at[0], last_predicted, last_commented, labels_changed) if value is not None
+    )
+    etag = http_cache.make_etag("image-details", image_id, first_prediction_id, comment_count, last_comment_id, labels_epoch)
+    return etag, last_modified
 
-@app.get("/image-details/{image_id}", response_model=schemas.ImageDetails)
-async def get_image_details(image_id: int, db: Session = Depends(get_db)):
+def image_details_body(db: Session, image_id: int):
     image = db.query(models.Image).filter(models.Image.id == image_id).first()
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    prediction = db.query(models.Prediction).filter(models.Prediction.image_id == image_id).first()
-    comments = db.query(models.Comment).filter(models.Comment.image_id == image_id).all()
-    
-    comments_with_user = []
-    for comment in comments:
-        user = db.query(models.User).filter(models.User.id == comment.user_id).first()
-        comments_with_user.append(schemas.CommentWithUser(
-            id=comment.id,
-            image_id=comment.image_id,
-            user_id=comment.user_id,
-            comment_text=comment.comment_text,
-            created_at=comment.created_at,
-            user=schemas.User(
-                id=user.id,
-                username=user.username,
-                email=user.email
-            ) if user else None
-        ))
+    prediction = db.query(models.Prediction).filter(models.Prediction.image_id == image_id).order_by(models.Prediction.id).first()
+    comments_with_user = comments_with_users(db, image_id)
 
-    return schemas.ImageDetails(
+    details = schemas.ImageDetails(
         id=image.id,
         filename=image.filename,
         uploaded_at=image.uploaded_at,
-        prediction=schemas.Prediction(
+        prediction=schemas.PredictionWithTopK(
             id=prediction.id,
             disease=prediction.disease,
             confidence=prediction.confidence,
             predicted_at=prediction.predicted_at,
             image_id=prediction.image_id,
-            user_id=prediction.user_id
+            user_id=prediction.user_id,
+            top_k=calibration.top_k(prediction.probabilities)
         ) if prediction else None,
         comments=comments_with_user
     )
+    return json_response(details).body
+
+@app.get("/image-details/{image_id}", response_model=schemas.ImageDetails)
+def get_image_details(image_id: int, request: Request, db: Session = Depends(get_db)):
+    # Served from details_cache when possible; /comment and /predict invalidate it
+    cached = details_cache.get(image_id)
+    if cached is not None:
+        conditional = http_cache.Conditional(request, cached.etag, cached.last_modified)
+        if conditional.not_modified:
+            return conditional.not_modified_response()
+        return conditional.respond(Response(content=cached.body, media_type="application/json"))
+
+    # Taken before reading so a write that lands meanwhile keeps this result out of the cache
+    ticket = details_cache.ticket()
+    etag, last_modified = image_details_validators(db, image_id)
+    conditional = http_cache.Conditional(request, etag, last_modified)
+    if conditional.not_modified:
+        return conditional.not_modified_response()
+    body = image_details_body(db, image_id)
+    details_cache.put(image_id, CachedDetails(etag, last_modified, body), ticket)
+    return conditional.respond(Response(content=body, media_type="application/json"))
+
+@app.get("/stats", response_model=schemas.PredictionStats)
+def get_prediction_stats(days: int = 30, db: Session = Depends(get_db)):
+    # Served entirely from the rollup tables maintained by stats.py
+    if days < 1:
+        raise HTTPException(status_code=400, detail="days must be at least 1")
+    return stats.read_stats(db, days=days)
+
+@app.get("/admin/profiling")
+def get_profiling_status(admin: models.User = Depends(require_admin)):
+    return profiling.status()
+
+@app.post("/admin/profiling")
+def configure_profiling(config: schemas.ProfilingConfig, admin: models.User = Depends(require_admin)):
+    # Takes effect immediately, no restart needed
+    profiling.sampler.configure(
+        sample_rate=config.sample_rate,
+        interval=config.sample_interval_ms / 1000 if config.sample_interval_ms else None
+    )
+    if config.capture_predict_trace:
+        # The model, and so the trace, lives in the inference service
+        try:
+            inference.arm_trace()
+        except InferenceUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    if config.trace_upload_allocations is not None:
+        profiling.upload_allocations.configure(config.trace_upload_allocations)
+    return profiling.status()
+
+@app.get("/admin/profiling/flamegraph", response_class=PlainTextResponse)
+def dump_flamegraph(reset: bool = False, admin: models.User = Depends(require_admin)):
+    # Folded stacks collected so far; also saved under PROFILE_DIR
+    path, folded = profiling.sampler.dump(reset=reset)
+    return PlainTextResponse(folded, headers={"X-Profile-Path": path})
+
+@app.get("/admin/query-stats")
+def get_query_stats(top: int = Query(20, ge=1, le=500), reset: bool = False,
+                    admin: models.User = Depends(require_admin)):
+    # Per-route statement totals and the statements with the most DB time
+    snapshot = query_stats.statement_stats.snapshot(top=top)
+    if reset:
+        query_stats.statement_stats.reset()
+    return snapshot
+
+@app.get("/similar/{image_id}", response_model=List[schemas.SimilarImage])
+def get_similar_images(image_id: int, k: int = Query(10, ge=1, le=100), db: Session = Depends(get_db)):
+    query = embedding_index.get(image_id)
+    if query is None:
+        raise HTTPException(status_code=404, detail="No embedding for this image yet. Run a prediction on it first.")
+    neighbours = embedding_index.search(query, k=k, exclude_image_id=image_id)
+    ids = [neighbour_id for neighbour_id, _ in neighbours]
+    if not ids:
+        return []
+
+    # Three set-based queries for all neighbours instead of lookups per image
+    images = {image.id: image for image in db.query(models.Image).filter(models.Image.id.in_(ids))}
+    predictions = {}
+    for prediction in db.query(models.Prediction).filter(
+        models.Prediction.image_id.in_(ids)
+    ).order_by(models.Prediction.id):
+        predictions.setdefault(prediction.image_id, prediction)
+    comments = {}
+    for comment, user in db.query(models.Comment, models.User).join(
+        models.User, models.User.id == models.Comment.user_id
+    ).filter(models.Comment.image_id.in_(ids)).order_by(models.Comment.id):
+        comments.setdefault(comment.image_id, []).append(schemas.CommentWithUser(
+            id=comment.id,
+            image_id=comment.image_id,
+            user_id=comment.user_id,
+            comment_text=comment.comment_text,
+            created_at=comment.created_at,
+            user=schemas.User(id=user.id, username=user.username, email=user.email)
+        ))
+
+    return [
+        schemas.SimilarImage(
+            id=neighbour_id,
+            filename=images[neighbour_id].filename,
+            uploaded_at=images[neighbour_id].uploaded_at,
+            similarity=score,
+            prediction=schemas.Prediction.model_validate(predictions[neighbour_id]) if neighbour_id in predictions else None,
+            comments=comments.get(neighbour_id, [])
+        )
+        for neighbour_id, score in neighbours if neighbour_id in images
+    ]
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,90 @@
+"""
+Measure how much client-side compaction changes model predictions compared with
+uploading the original file. Each image goes through compact_upload, so a file
+the client would send unchanged (because compaction does not make it smaller)
+counts as unchanged, exactly as in the app.
+
+    python measure_compact_tolerance.py ~/leaf-photos --max-edge 1024 --quality 85
+
+Use full-size camera photos: images no larger than --max-edge only exercise the
+re-encode, not the downscale (../example_images are all under 320 px).
+
+Reports, per format, how many images were downscaled, re-encoded or sent as
+is, the label agreement, the largest confidence change and the size saving.
+Exits non-zero if any label flips, the confidence moves by more than
+--tolerance, or no image was large enough to be downscaled.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from PIL import Image
+
+from compact_image import compact_upload, DEFAULT_MAX_EDGE, DEFAULT_QUALITY
+from ml_model import predict_disease
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_dir")
+    parser.add_argument("--max-edge", type=int, default=DEFAULT_MAX_EDGE)
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY)
+    parser.add_argument("--formats", nargs="+", default=["JPEG", "WEBP"])
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Largest acceptable confidence change")
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.image_dir, name) for name in os.listdir(args.image_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    baseline = {path: predict_disease(path) for path in paths}
+    failed = False
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for image_format in args.formats:
+            agree = 0
+            max_delta = 0.0
+            original_bytes = 0
+            compact_bytes = 0
+            sent = {"downscaled": 0, "re-encoded": 0, "original": 0}
+            for path in paths:
+                with open(path, "rb") as source:
+                    original = source.read()
+                with Image.open(path) as image:
+                    downscaled = max(image.size) > args.max_edge
+                name, data, _ = compact_upload(os.path.basename(path), original, None,
+                                               args.max_edge, image_format, args.quality)
+                original_bytes += len(original)
+                compact_bytes += len(data)
+                if data is original:
+                    # The client uploads this file unchanged
+                    sent["original"] += 1
+                    agree += 1
+                    continue
+                sent["downscaled" if downscaled else "re-encoded"] += 1
+                compact_path = os.path.join(workdir, name)
+                with open(compact_path, "wb") as output:
+                    output.write(data)
+
+                disease, confidence = predict_disease(compact_path)
+                base_disease, base_confidence = baseline[path]
+                agree += disease == base_disease
+                max_delta = max(max_delta, abs(confidence - base_confidence))
+
+            saving = 1 - compact_bytes / max(original_bytes, 1)
+            print(f"{image_format}: {sent['downscaled']} downscaled, {sent['re-encoded']} re-encoded, "
+                  f"{sent['original']} sent as is; {agree}/{len(paths)} labels unchanged, "
+                  f"max confidence change {max_delta:.4f}, {saving:.0%} smaller")
+            failed |= agree != len(paths) or max_delta > args.tolerance
+            if not sent["downscaled"]:
+                print(f"{image_format}: no image is larger than {args.max_edge}px; the downscale was not measured")
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ from tensorflow import keras
 from joblib import load
 import os
 from PIL import Image
+from metrics import predict_stage_seconds
+from profiling import tf_trace
+from calibration import CLASS_LABELS
 
 # Get the current file's directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -23,6 +26,13 @@ if not os.path.exists(MODEL_PATH):
 model = tf.keras.models.load_model(MODEL_PATH, compile=False)
 label_encoder = load(LABEL_ENCODER_PATH)
 
+# Model output column of each label in CLASS_LABELS
+CLASS_ORDER = [list(label_encoder.classes_).index(label) for label in CLASS_LABELS]
+
+# Same weights, but also returning the input of the final classification layer
+# (the penultimate-layer embedding) so one forward pass yields both
+embedding_model = keras.Model(inputs=model.inputs, outputs=[model.layers[-1].input, model.output])
+
 TARGET_SIZE = (256, 256) 
 
 def preprocess_image(image_path, target_size=TARGET_SIZE):
@@ -46,21 +56,42 @@ def preprocess_image(image_path, target_size=TARGET_SIZE):
     return img
     
 
-def predict_disease(image_path):
+def predict_probabilities(image_path):
     # Preprocess the image
-    img = preprocess_image(image_path)
-    img = tf.expand_dims(img, axis=0)  # Add batch dimension
+    with predict_stage_seconds.time(stage="preprocess"):
+        img = preprocess_image(image_path)
+        img = tf.expand_dims(img, axis=0)  # Add batch dimension
     
     # Make prediction
-    prediction = model.predict(img)
+    with predict_stage_seconds.time(stage="model"), tf_trace.maybe_trace():
+        embedding, prediction = embedding_model.predict(img, verbose=0)
+    
+    # Full softmax, reordered from the label encoder's order to CLASS_LABELS
+    probabilities = prediction[0][CLASS_ORDER].astype(np.float32)
+    
+    return probabilities, embedding[0]
+
+def predict_with_embedding(image_path):
+    probabilities, embedding = predict_probabilities(image_path)
     
     # Get the predicted class index
-    predicted_class_index = np.argmax(prediction, axis=1)[0]
+    predicted_class_index = int(np.argmax(probabilities))
     
     # Get the predicted class name
-    predicted_class = label_encoder.inverse_transform([predicted_class_index])[0]
+    predicted_class = CLASS_LABELS[predicted_class_index]
     
     # Get the confidence
-    confidence = np.max(prediction)
+    confidence = probabilities[predicted_class_index]
     
-    return predicted_class, float(confidence)
\ No newline at end of file
+    return predicted_class, float(confidence), embedding
+
+def predict_disease(image_path):
+    predicted_class, confidence, _ = predict_with_embedding(image_path)
+    return predicted_class, confidence
+
+def extract_embedding(image_path):
+    return predict_with_embedding(image_path)[2]
+
+def warm_up():
+    # The first predict call builds the graph; do it before taking requests
+    embedding_model.predict(np.zeros((1, *TARGET_SIZE, 3), dtype=np.float32), verbose=0)
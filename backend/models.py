@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Date, UniqueConstraint, Index, LargeBinary, inspect, select, update, insert
+from sqlalchemy.exc import IntegrityError, DBAPIError
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -59,6 +60,10 @@ class User(Base):
 
 class Image(Base):
     __tablename__ = "images"
+    __table_args__ = (
+        # Uploader filter of /predictions/search
+        Index("ix_images_user_id_uploaded_at", "user_id", "uploaded_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String(255), index=True)
@@ -75,12 +80,23 @@ class Image(Base):
 
 class Prediction(Base):
     __tablename__ = "predictions"
+    __table_args__ = (
+        # Indexes backing the filters and sorts of /predictions/search
+        Index("ix_predictions_disease_predicted_at", "disease", "predicted_at"),
+        Index("ix_predictions_disease_confidence", "disease", "confidence"),
+        Index("ix_predictions_predicted_at", "predicted_at"),
+        Index("ix_predictions_confidence", "confidence"),
+        Index("ix_predictions_image_id", "image_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     image_id = Column(Integer, ForeignKey("images.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
     disease = Column(String(100))
     confidence = Column(Float)
+    # Full softmax over calibration.CLASS_LABELS as float32 (see calibration.py);
+    # disease and confidence are derived from it. NULL for older predictions
+    probabilities = Column(LargeBinary(20), nullable=True)
     predicted_at = Column(DateTime, default=datetime.datetime.now)
 
     image = relationship("Image", back_populates="predictions")
@@ -98,6 +114,20 @@ class Comment(Base):
     image = relationship("Image", back_populates="comments")
     user = relationship("User", back_populates="comments")
 
+class CommentTerm(Base):
+    # Postings of the comment search index (comment_search.py), used where the
+    # database has no full-text search of its own. Term lookups and the joins
+    # between a query's terms go through the (term, comment_id) primary key
+    __tablename__ = "comment_terms"
+    __table_args__ = (
+        # Single-term results in rank order without sorting
+        Index("ix_comment_terms_term_weight", "term", "weight", "comment_id"),
+    )
+
+    term = Column(String(64), primary_key=True)
+    comment_id = Column(Integer, ForeignKey("comments.id"), primary_key=True)
+    weight = Column(Float)
+
 class ActivityLog(Base):
     __tablename__ = "activity_logs"
 
@@ -118,3 +148,164 @@ class ImageUpload(Base):
 
     image = relationship("Image", overlaps="uploaders,uploaded_images")
     user = relationship("User",  overlaps="uploaders,uploaded_images")
+
+
+# Rollup tables for dashboard statistics. These are kept up to date by stats.py
+# inside the same transaction that inserts a Prediction (or archives one, see
+# archive.py), so reading them never has to touch the predictions table itself.
+class PredictionDailyStat(Base):
+    __tablename__ = "prediction_daily_stats"
+    __table_args__ = (UniqueConstraint("day", "disease", name="uq_prediction_daily_stats_day_disease"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, index=True)
+    disease = Column(String(100))
+    prediction_count = Column(Integer, default=0)
+    confidence_sum = Column(Float, default=0.0)
+
+class PredictionUserStat(Base):
+    __tablename__ = "prediction_user_stats"
+    __table_args__ = (UniqueConstraint("user_id", "disease", name="uq_prediction_user_stats_user_disease"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    disease = Column(String(100))
+    prediction_count = Column(Integer, default=0)
+    confidence_sum = Column(Float, default=0.0)
+
+class ConfidenceHistogram(Base):
+    __tablename__ = "confidence_histogram"
+    __table_args__ = (UniqueConstraint("disease", "bucket", name="uq_confidence_histogram_disease_bucket"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    disease = Column(String(100))
+    bucket = Column(Integer)  # 0..9, each covering a 0.1 wide confidence band
+    prediction_count = Column(Integer, default=0)
+    confidence_sum = Column(Float, default=0.0)
+
+class UserSession(Base):
+    __tablename__ = "user_sessions"
+
+    token = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    expires_at = Column(DateTime, index=True)
+
+class UploadIdempotencyKey(Base):
+    # Client-supplied Idempotency-Key of an /upload, so a retried request
+    # returns the original upload instead of recording another one
+    __tablename__ = "upload_idempotency_keys"
+    __table_args__ = (UniqueConstraint("user_id", "key", name="uq_upload_idempotency_keys_user_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    key = Column(String(64))
+    # archive.py deletes the keys of the uploads it archives first
+    image_upload_id = Column(Integer, ForeignKey("image_uploads.id"), index=True)
+    # Keys expire after UPLOAD_IDEMPOTENCY_TTL_SECONDS (main.py)
+    created_at = Column(DateTime, default=datetime.datetime.now, index=True)
+
+class CacheEpoch(Base):
+    # Named generation counters bumped by bulk writes made outside the API
+    # (archive, calibration backfill): caches drop what they held before the
+    # bump and HTTP validators include it (see read_epoch / bump_epoch)
+    __tablename__ = "cache_epochs"
+
+    name = Column(String(64), primary_key=True)
+    epoch = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+
+def _missing_columns(inspector, table):
+    # create_all() does not alter existing tables, so nullable columns added to
+    # existing models have to be added separately
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    return [column for column in table.columns if column.name not in existing and column.nullable]
+
+def _missing_indexes(inspector, table):
+    # create_all() only adds indexes together with new tables
+    return [index for index in table.indexes if not inspector.has_index(table.name, index.name)]
+
+def pending_migrations(engine):
+    """Columns and indexes of the models that existing tables lack, as 'table.name' strings."""
+    inspector = inspect(engine)
+    pending = []
+    for table in Base.metadata.sorted_tables:
+        if inspector.has_table(table.name):
+            pending += [f"{table.name}.{item.name}"
+                        for item in _missing_columns(inspector, table) + _missing_indexes(inspector, table)]
+    return pending
+
+def migrate(engine):
+    """
+    Bring an existing database up to the models: new tables, then new nullable
+    columns and indexes of existing ones. Run once per deploy (python models.py
+    migrate), not from API workers: an index build on a large table blocks, and
+    workers starting together would race to create the same objects. A
+    concurrent run that gets there first is tolerated.
+    """
+    Base.metadata.create_all(bind=engine)
+    preparer = engine.dialect.identifier_preparer
+    applied = []
+    for table in Base.metadata.sorted_tables:
+        for column in _missing_columns(inspect(engine), table):
+            column_type = column.type.compile(dialect=engine.dialect)
+            statement = f"ALTER TABLE {preparer.format_table(table)} ADD {preparer.format_column(column)} {column_type}"
+            if _apply(engine, lambda connection: connection.exec_driver_sql(statement),
+                      lambda: column.name not in _names(_missing_columns(inspect(engine), table))):
+                applied.append(f"{table.name}.{column.name}")
+        for index in _missing_indexes(inspect(engine), table):
+            if _apply(engine, index.create, lambda: index.name not in _names(_missing_indexes(inspect(engine), table))):
+                applied.append(f"{table.name}.{index.name}")
+    return applied
+
+def _names(items):
+    return {item.name for item in items}
+
+def _apply(engine, change, done):
+    # True if `change` was applied here, False if another process applied it first
+    try:
+        with engine.begin() as connection:
+            change(connection)
+        return True
+    except DBAPIError:
+        if done():
+            return False
+        raise
+
+
+def read_epoch(connection, name):
+    """(epoch, time of the last bump) of a CacheEpoch row; (0, None) before the first bump."""
+    row = connection.execute(
+        select(CacheEpoch.epoch, CacheEpoch.updated_at).where(CacheEpoch.name == name)
+    ).first()
+    return (row.epoch, row.updated_at) if row else (0, None)
+
+
+def bump_epoch(engine, name, attempts=3):
+    for _ in range(attempts):
+        with engine.begin() as connection:
+            if connection.execute(
+                update(CacheEpoch).where(CacheEpoch.name == name).values(epoch=CacheEpoch.epoch + 1)
+            ).rowcount:
+                return
+        try:
+            with engine.begin() as connection:
+                connection.execute(insert(CacheEpoch).values(name=name, epoch=1))
+            return
+        except IntegrityError:
+            # Another process created the row first; bump it instead
+            continue
+    raise RuntimeError(f"Could not bump epoch '{name}'")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Bring the database schema up to the models")
+    parser.add_argument("command", choices=["migrate"])
+    parser.parse_args()
+    applied = migrate(engine)
+    print(f"Applied {len(applied)} changes: {', '.join(applied)}" if applied else "Schema is up to date")
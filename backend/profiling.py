@@ -0,0 +1,310 @@
+"""
+On-demand profiling that can be switched on and off at runtime through the
+/admin/profiling endpoints:
+
+- a sampling profiler that collects folded stacks (flamegraph.pl / speedscope
+  input) while a configurable fraction of requests is in flight,
+- a one-shot TensorFlow profiler trace around the next model.predict call,
+- tracemalloc allocation snapshots taken around /upload.
+
+Everything is off by default and costs a single attribute check per request
+while disabled.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool as starlette_run_in_threadpool
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+ADMIN_USERNAMES = {name.strip() for name in os.environ.get("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
+# True inside a sampled request, and so in the threadpool calls it makes
+_sampled = contextvars.ContextVar("profiling_sampled", default=False)
+
+
+# Ident of every thread running threadpool work for a sampled request -> nesting depth
+_sampled_threads = Counter()
+_sampled_threads_lock = threading.Lock()
+
+
+def _in_sampled_thread(func):
+    """Wraps a sync callable so the thread running it is sampled while it serves a sampled request."""
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        # The threadpool runs each call in a copy of the caller's context
+        if not _sampled.get():
+            return func(*args, **kwargs)
+        ident = threading.get_ident()
+        with _sampled_threads_lock:
+            _sampled_threads[ident] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with _sampled_threads_lock:
+                _sampled_threads[ident] -= 1
+                if not _sampled_threads[ident]:
+                    del _sampled_threads[ident]
+    return call
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """starlette's run_in_threadpool, with the worker thread sampled for sampled requests."""
+    return await starlette_run_in_threadpool(_in_sampled_thread(func), *args, **kwargs)
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route class whose sync endpoints, which FastAPI runs in the threadpool, are
+    sampled for sampled requests. Sync dependencies run in separate threadpool
+    calls and are not.
+    """
+
+    def __init__(self, path, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = _in_sampled_thread(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _output_path(prefix, extension):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.{extension}")
+
+
+class SamplingProfiler:
+    """
+    Samples Python stacks at a fixed interval while at least one sampled
+    request is running, keeping only threads busy with a sampled request: the
+    event loop thread while a sampled request's task is the one running, and
+    threadpool workers running a sampled request's endpoint or a call it made
+    through run_in_threadpool above. Stacks are aggregated in folded form
+    ("outer;inner;leaf count") so dumping is cheap.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.interval = 0.005
+        self._active_requests = 0
+        self._tasks = set()
+        # Event loop thread id -> [its loop, sampled tasks running on it]
+        self._loops = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stacks = Counter()
+        self._thread = None
+        self._running = False
+        self.samples_taken = 0
+
+    def configure(self, sample_rate=None, interval=None):
+        if interval is not None:
+            self.interval = interval
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+            if sample_rate > 0:
+                self._start()
+            else:
+                self._stop()
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def sampled_request(self):
+        """Enter from the request's own task (see ProfilingMiddleware)."""
+        task = asyncio.current_task()
+        token = _sampled.set(True)
+        with self._lock:
+            self._active_requests += 1
+            if task is not None:
+                self._tasks.add(task)
+                self._loops.setdefault(threading.get_ident(), [task.get_loop(), 0])[1] += 1
+            self._wakeup.notify()
+        try:
+            yield
+        finally:
+            _sampled.reset(token)
+            with self._lock:
+                self._active_requests -= 1
+                if task is not None:
+                    self._tasks.discard(task)
+                    ident = threading.get_ident()
+                    self._loops[ident][1] -= 1
+                    if not self._loops[ident][1]:
+                        del self._loops[ident]
+
+    def _start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def _stop(self):
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            with self._lock:
+                while self._running and self._active_requests == 0:
+                    self._wakeup.wait()
+                if not self._running:
+                    return
+                tasks = set(self._tasks)
+                loops = {ident: loop for ident, (loop, _) in self._loops.items()}
+            with _sampled_threads_lock:
+                threads = set(_sampled_threads)
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                loop = loops.get(ident)
+                if loop is not None:
+                    # The loop thread interleaves every request's coroutines
+                    if asyncio.current_task(loop) not in tasks:
+                        continue
+                elif ident not in threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples_taken += 1
+            time.sleep(self.interval)
+
+    def dump(self, reset=False):
+        with self._lock:
+            stacks = self._stacks
+            if reset:
+                self._stacks = Counter()
+        path = _output_path("stacks", "folded")
+        folded = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        with open(path, "w") as output:
+            output.write(folded)
+        return path, folded
+
+
+class TensorFlowTrace:
+    """Arms a one-shot TensorFlow profiler trace for the next model.predict."""
+
+    def __init__(self):
+        self._armed = threading.Event()
+        self.last_logdir = None
+
+    def arm(self):
+        self._armed.set()
+
+    @property
+    def armed(self):
+        return self._armed.is_set()
+
+    @contextmanager
+    def maybe_trace(self):
+        if not self._armed.is_set():
+            yield
+            return
+        self._armed.clear()
+        import tensorflow as tf
+
+        logdir = _output_path("tf-trace", "d")
+        tf.profiler.experimental.start(logdir)
+        try:
+            yield
+        finally:
+            tf.profiler.experimental.stop()
+            self.last_logdir = logdir
+
+
+class UploadAllocationTracker:
+    """
+    Records a tracemalloc diff of each /upload request while enabled. Snapshots
+    are process-wide, so uploads are serialized while tracking; allocations of
+    other requests in flight still show up in the diff.
+    """
+
+    def __init__(self, top=25):
+        self.enabled = False
+        self.top = top
+        self.last_report = None
+        self._serial = asyncio.Lock()
+
+    def configure(self, enabled):
+        self.enabled = enabled
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @asynccontextmanager
+    async def track(self):
+        if not self.enabled or not tracemalloc.is_tracing():
+            yield
+            return
+        async with self._serial:
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+            try:
+                yield
+            finally:
+                # Tracking may have been switched off meanwhile
+                if tracemalloc.is_tracing():
+                    self._report(before)
+
+    def _report(self, before):
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        stats = after.compare_to(before, "lineno")[:self.top]
+        path = _output_path("upload-alloc", "txt")
+        with open(path, "w") as output:
+            output.write(f"peak traced memory: {peak} bytes\n")
+            output.writelines(f"{stat}\n" for stat in stats)
+        after.dump(path.replace(".txt", ".snapshot"))
+        self.last_report = path
+
+
+sampler = SamplingProfiler()
+tf_trace = TensorFlowTrace()
+upload_allocations = UploadAllocationTracker()
+
+
+def status():
+    return {
+        "sample_rate": sampler.sample_rate,
+        "sample_interval_ms": sampler.interval * 1000,
+        "samples_taken": sampler.samples_taken,
+        "predict_trace_armed": tf_trace.armed,
+        "last_predict_trace": tf_trace.last_logdir,
+        "trace_upload_allocations": upload_allocations.enabled,
+        "last_upload_allocation_report": upload_allocations.last_report,
+    }
+
+
+class ProfilingMiddleware:
+    """Enters the sampling window for the configured fraction of requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not sampler.should_sample():
+            await self.app(scope, receive, send)
+            return
+        with sampler.sampled_request():
+            await self.app(scope, receive, send)
@@ -0,0 +1,263 @@
+"""
+Per-route SQL instrumentation.
+
+Engine events time every statement and attribute it to the route template of
+the request that issued it (a context variable set by QueryStatsMiddleware;
+anyio copies it into threadpool calls, so sync endpoints and dependencies are
+covered too). Statements outside a request, e.g. the activity log writer, are
+attributed to "background".
+
+Recorded per route: statement count, DB time and rows affected by
+INSERT/UPDATE/DELETE (drivers report no count for a SELECT before its rows
+are fetched, so none is recorded for queries), plus the
+heaviest statements by total time (GET /admin/query-stats) and Prometheus
+series on /metrics. Statements slower than SLOW_QUERY_MS go to the "sql.slow"
+logger (SLOW_QUERY_LOG names a file for it) with their parameters and, with
+SLOW_QUERY_EXPLAIN=1, the database's plan.
+"""
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from metrics import registry
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG")
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "0") == "1"
+# The same statement is explained at most once per this many seconds
+EXPLAIN_INTERVAL_SECONDS = 600
+MAX_TRACKED_STATEMENTS = 500
+BACKGROUND_ROUTE = "background"
+
+slow_query_logger = logging.getLogger("sql.slow")
+if SLOW_QUERY_LOG:
+    _handler = logging.FileHandler(SLOW_QUERY_LOG)
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_query_logger.addHandler(_handler)
+    slow_query_logger.setLevel(logging.INFO)
+
+db_queries_total = registry.counter(
+    "db_queries_total", "SQL statements executed, by originating route template", ("route",)
+)
+db_query_seconds_total = registry.counter(
+    "db_query_seconds_total", "Time spent executing SQL statements, by originating route template", ("route",)
+)
+db_rows_total = registry.counter(
+    "db_rows_total", "Rows affected by INSERT/UPDATE/DELETE statements, by route template", ("route",)
+)
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request", "SQL statements issued by a single request, by route template", ("route",),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+)
+db_slow_queries_total = registry.counter(
+    "db_slow_queries_total", "SQL statements slower than SLOW_QUERY_MS, by route template", ("route",)
+)
+
+
+class RequestQueries:
+    """Statement count and DB time of the request being served."""
+
+    __slots__ = ("scope", "count", "seconds")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.count = 0
+        self.seconds = 0.0
+
+    @property
+    def route(self):
+        # The router stores the matched route in the scope before the endpoint runs
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or "unmatched"
+
+
+_current_request = contextvars.ContextVar("query_stats_request", default=None)
+
+_WHITESPACE = re.compile(r"\s+")
+# Parameters of statements touching credentials are never written to the log
+_SENSITIVE = re.compile(r"\b(password|token)\b", re.IGNORECASE)
+_PARAMETER_LIST = re.compile(r"\((?:\s*(?:\?|%s|:\w+|%\(\w+\)s)\s*,)+\s*(?:\?|%s|:\w+|%\(\w+\)s)\s*\)")
+
+
+def fingerprint(statement):
+    # IN lists of different lengths are the same statement
+    return _PARAMETER_LIST.sub("(...)", _WHITESPACE.sub(" ", statement).strip())
+
+
+class StatementStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.statements = {}
+        self._explained_at = {}
+
+    def record(self, route, statement, seconds, rows):
+        key = (route, fingerprint(statement))
+        with self._lock:
+            totals = self.routes.setdefault(route, {"queries": 0, "seconds": 0.0, "rows_affected": 0, "slow": 0})
+            totals["queries"] += 1
+            totals["seconds"] += seconds
+            totals["rows_affected"] += rows or 0
+            entry = self.statements.get(key)
+            if entry is None:
+                if len(self.statements) >= MAX_TRACKED_STATEMENTS:
+                    # Drop the cheapest statement to make room
+                    del self.statements[min(self.statements, key=lambda k: self.statements[k]["seconds"])]
+                entry = self.statements[key] = {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+                if rows is not None:
+                    entry["rows_affected"] = 0
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            if rows is not None:
+                entry["rows_affected"] += rows
+
+    def record_slow(self, route):
+        with self._lock:
+            self.routes.setdefault(route, {"queries": 0, "seconds": 0.0, "rows_affected": 0, "slow": 0})["slow"] += 1
+
+    def should_explain(self, statement):
+        key = fingerprint(statement)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained_at.get(key, -EXPLAIN_INTERVAL_SECONDS) < EXPLAIN_INTERVAL_SECONDS:
+                return False
+            self._explained_at[key] = now
+            return True
+
+    def snapshot(self, top=20):
+        with self._lock:
+            routes = {route: dict(totals) for route, totals in self.routes.items()}
+            statements = sorted(self.statements.items(), key=lambda item: item[1]["seconds"], reverse=True)[:top]
+        for totals in routes.values():
+            totals["avg_ms"] = 1000 * totals["seconds"] / totals["queries"] if totals["queries"] else 0.0
+        return {
+            "slow_query_ms": SLOW_QUERY_MS,
+            "routes": dict(sorted(routes.items(), key=lambda item: item[1]["seconds"], reverse=True)),
+            "top_statements": [
+                {"route": route, "statement": statement, **entry, "avg_ms": 1000 * entry["seconds"] / entry["count"]}
+                for (route, statement), entry in statements
+            ],
+        }
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+            self.statements.clear()
+
+
+statement_stats = StatementStats()
+
+
+def _is_query(statement):
+    return statement.lstrip()[:6].upper() in ("SELECT", "WITH")
+
+
+def _explain(engine, statement, parameters):
+    dialect = engine.dialect.name
+    # Statements that undo session settings made for the plan
+    reset = []
+    if dialect == "sqlite":
+        batches = [("EXPLAIN QUERY PLAN " + statement, parameters)]
+    elif dialect in ("postgresql", "mysql", "mariadb"):
+        batches = [("EXPLAIN " + statement, parameters)]
+    elif dialect == "mssql":
+        # SHOWPLAN has to be switched on in its own batch and compiles without executing
+        batches = [("SET SHOWPLAN_TEXT ON", ()), (statement, parameters)]
+        reset = ["SET SHOWPLAN_TEXT OFF"]
+    else:
+        return None
+    # A raw DBAPI connection, so the EXPLAIN itself does not go through these events
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        plan = []
+        try:
+            for sql, params in batches:
+                cursor.execute(sql, params)
+                if cursor.description:
+                    plan.extend(" | ".join(str(value) for value in row) for row in cursor.fetchall())
+        finally:
+            for sql in reset:
+                cursor.execute(sql)
+        return "\n".join(plan)
+    except Exception as e:
+        if reset:
+            # The session may still be in SHOWPLAN mode, where nothing executes;
+            # drop the connection instead of returning it to the pool
+            connection.invalidate()
+        return f"EXPLAIN failed: {e}"
+    finally:
+        connection.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_stats_started", []).append(time.perf_counter())
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get("query_stats_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_stats_started"].pop()
+    request = _current_request.get()
+    route = request.route if request is not None else BACKGROUND_ROUTE
+    # rowcount is -1 (or a driver-specific guess) for a SELECT until it is fetched
+    rows = cursor.rowcount if not _is_query(statement) and cursor.rowcount is not None and cursor.rowcount >= 0 else None
+
+    if request is not None:
+        request.count += 1
+        request.seconds += seconds
+    statement_stats.record(route, statement, seconds, rows)
+    db_queries_total.inc(route=route)
+    db_query_seconds_total.inc(seconds, route=route)
+    if rows:
+        db_rows_total.inc(rows, route=route)
+
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        statement_stats.record_slow(route)
+        db_slow_queries_total.inc(route=route)
+        plan = None
+        if SLOW_QUERY_EXPLAIN and _is_query(statement) and not executemany \
+                and statement_stats.should_explain(statement):
+            plan = _explain(conn.engine, statement, parameters)
+        slow_query_logger.warning(
+            "slow query route=%s ms=%.1f%s statement=%s parameters=%.1000r%s",
+            route, seconds * 1000, f" rows_affected={rows}" if rows is not None else "", _WHITESPACE.sub(" ", statement),
+            "<redacted>" if _SENSITIVE.search(statement) else parameters,
+            f"\nplan:\n{plan}" if plan else ""
+        )
+
+
+def instrument(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+class QueryStatsMiddleware:
+    """Attributes the statements of each HTTP request to its route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request = RequestQueries(scope)
+        token = _current_request.set(request)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_request.reset(token)
+            if request.count:
+                db_queries_per_request.observe(request.count, route=request.route)
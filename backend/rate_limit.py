@@ -0,0 +1,248 @@
+"""
+Admission control for /predict.
+
+Every user gets a token bucket (PREDICT_RATE_PER_MINUTE refill,
+PREDICT_BURST capacity). Requests that pass it wait for one of
+MODEL_CONCURRENCY model slots in a start-time fair queue: each request is
+tagged with max(virtual time, the user's previous finish tag) and slots go to
+the smallest tag, so a user with a deep backlog only ever gets their weighted
+share and an interactive user's request is served after at most one request
+from each other active user.
+
+Per-user quotas are set through PREDICT_QUOTAS as
+"username=per_minute/burst/weight" entries separated by commas, e.g.
+"batchbot=600/60/0.5,alice=120/30/2".
+
+Buckets and the fair queue live in each API worker process and are not
+shared: with N uvicorn workers (WEB_CONCURRENCY) behind one address a user
+can get up to N times their quota, and fairness holds within each worker.
+Set quotas per worker accordingly. A web-client batch upload larger than the
+burst is paced by 429s: app.py waits out each Retry-After without spending
+one of the file's attempts on it.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+from metrics import registry
+
+Quota = namedtuple("Quota", ["per_minute", "burst", "weight"])
+
+DEFAULT_QUOTA = Quota(
+    float(os.environ.get("PREDICT_RATE_PER_MINUTE", 60)),
+    float(os.environ.get("PREDICT_BURST", 20)),
+    1.0,
+)
+# Model slots per API worker. Each inference service process (INFERENCE_WORKERS,
+# see inference_service.py) runs one prediction at a time, so by default the
+# service's processes are split across the API workers; more slots would only
+# move the queue into the service's socket backlog, where it is not fair
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 1))
+API_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+MODEL_CONCURRENCY = int(os.environ.get("MODEL_CONCURRENCY", max(1, INFERENCE_WORKERS // API_WORKERS)))
+MAX_PENDING_PER_USER = int(os.environ.get("PREDICT_MAX_PENDING_PER_USER", 8))
+# Idle buckets are dropped once there are this many, since a full bucket
+# carries no state worth keeping
+MAX_TRACKED_USERS = 10000
+
+
+def parse_quotas(spec):
+    quotas = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        username, _, values = entry.partition("=")
+        parts = [float(value) for value in values.split("/")]
+        per_minute = parts[0]
+        burst = parts[1] if len(parts) > 1 else DEFAULT_QUOTA.burst
+        weight = parts[2] if len(parts) > 2 else DEFAULT_QUOTA.weight
+        quotas[username.strip()] = Quota(per_minute, burst, weight)
+    return quotas
+
+
+QUOTAS = parse_quotas(os.environ.get("PREDICT_QUOTAS", ""))
+
+
+def quota_for(username):
+    return QUOTAS.get(username, DEFAULT_QUOTA)
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after, headers):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+class QueueClosed(Exception):
+    """Raised to predictions still waiting for a slot when the queue is handed off."""
+
+
+def _limit_headers(quota, remaining, reset_after):
+    return {
+        "X-RateLimit-Limit": str(int(quota.burst)),
+        "X-RateLimit-Remaining": str(max(int(remaining), 0)),
+        "X-RateLimit-Reset": str(math.ceil(reset_after)),
+    }
+
+
+class TokenBucketLimiter:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        # key -> [tokens, last refill time]
+        self._buckets = {}
+
+    def acquire(self, key, quota, cost=1.0):
+        """
+        Take cost tokens from key's bucket. Returns the rate-limit headers for
+        the response, or raises RateLimited with a Retry-After hint.
+        """
+        now = self.clock()
+        rate = quota.per_minute / 60.0
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_TRACKED_USERS:
+                    self._prune(now)
+                bucket = self._buckets[key] = [quota.burst, now]
+            tokens = min(quota.burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens < cost:
+                bucket[0] = tokens
+                retry_after = (cost - tokens) / rate if rate > 0 else 3600.0
+                headers = _limit_headers(quota, tokens, (quota.burst - tokens) / rate if rate > 0 else 3600.0)
+                headers["Retry-After"] = str(math.ceil(retry_after))
+                raise RateLimited("rate", retry_after, headers)
+            bucket[0] = tokens - cost
+            # Seconds until the bucket is full again
+            reset_after = (quota.burst - bucket[0]) / rate if rate > 0 else 0.0
+            return _limit_headers(quota, bucket[0], reset_after)
+
+    def _prune(self, now):
+        # Buckets untouched long enough to have refilled completely hold no state
+        stale = [key for key, (_, last) in self._buckets.items() if now - last > 600]
+        for key in stale:
+            del self._buckets[key]
+
+
+class _Waiter:
+    __slots__ = ("future", "loop", "granted", "cancelled")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+        self.cancelled = False
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _fail(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+class FairScheduler:
+    def __init__(self, slots=MODEL_CONCURRENCY, max_pending_per_user=MAX_PENDING_PER_USER):
+        self.slots = slots
+        self.max_pending_per_user = max_pending_per_user
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._virtual_time = 0.0
+        self._finish_tags = {}
+        self._pending = {}
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def queued(self):
+        with self._lock:
+            return sum(not waiter.cancelled for _, _, waiter in self._heap)
+
+    @asynccontextmanager
+    async def slot(self, key, weight=1.0, cost=1.0):
+        """Wait for a model slot in fair order; raises RateLimited if key's backlog is full."""
+        with self._lock:
+            pending = self._pending.get(key, 0)
+            if pending >= self.max_pending_per_user:
+                raise RateLimited("queue", 1.0, {"Retry-After": "1"})
+            self._pending[key] = pending + 1
+            if len(self._finish_tags) >= MAX_TRACKED_USERS:
+                self._finish_tags = {k: tag for k, tag in self._finish_tags.items() if tag > self._virtual_time}
+            start = max(self._virtual_time, self._finish_tags.get(key, 0.0))
+            self._finish_tags[key] = start + cost / weight
+            if self._busy < self.slots and not self._heap:
+                self._busy += 1
+                self._virtual_time = start
+                waiter = None
+            else:
+                waiter = _Waiter(asyncio.get_running_loop())
+                heapq.heappush(self._heap, (start, next(self._sequence), waiter))
+
+        granted = waiter is None
+        try:
+            if waiter is not None:
+                try:
+                    await waiter.future
+                except asyncio.CancelledError:
+                    with self._lock:
+                        granted = waiter.granted
+                        waiter.cancelled = True
+                    raise
+                granted = True
+            yield
+        finally:
+            with self._lock:
+                self._pending[key] -= 1
+                if not self._pending[key]:
+                    del self._pending[key]
+                    # Finish tags behind the virtual clock no longer matter
+                    if self._finish_tags.get(key, 0.0) <= self._virtual_time:
+                        self._finish_tags.pop(key, None)
+            if granted:
+                self._release()
+
+    def hand_off(self):
+        """
+        Fail every prediction still waiting for a slot with QueueClosed so its
+        client can retry on another server; running predictions are unaffected.
+        Returns how many were handed off.
+        """
+        with self._lock:
+            waiters = [waiter for _, _, waiter in self._heap if not waiter.cancelled]
+            self._heap = []
+            for waiter in waiters:
+                waiter.cancelled = True
+                waiter.loop.call_soon_threadsafe(_fail, waiter.future, QueueClosed())
+        return len(waiters)
+
+    def _release(self):
+        with self._lock:
+            while self._heap:
+                start, _, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self._virtual_time = start
+                # The waiter may belong to another event loop (e.g. a test client's portal)
+                waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+                return
+            self._busy -= 1
+
+
+predict_limiter = TokenBucketLimiter()
+model_scheduler = FairScheduler()
+registry.gauge(
+    "predict_fair_queue_waiting", "Predictions waiting in the fair queue for a model slot",
+    callback=model_scheduler.queued
+)
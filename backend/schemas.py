@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, EmailStr
-from datetime import datetime
+from datetime import datetime, date
 from typing import Optional, List
 from enum import Enum
 
@@ -83,6 +83,10 @@ class PredictionCreate(PredictionBase):
     image_id: int
     user_id: int
 
+class ClassProbability(BaseModel):
+    disease: DiseaseClass
+    probability: float
+
 class Prediction(BaseModel):
     id: int
     disease: DiseaseClass
@@ -94,6 +98,13 @@ class Prediction(BaseModel):
     class Config:
         from_attributes = True
 
+class PredictionWithTopK(Prediction):
+    # Most likely classes first; None for predictions made before the full
+    # probability vector was stored. Sent where a prediction is shown in full
+    # (predict, image details, comment search); the bulk listings
+    # (all-predictions, similar) do not decode vectors and leave it out
+    top_k: Optional[List[ClassProbability]] = None
+
 class CommentBase(BaseModel):
     comment_text: str = Field(..., max_length=1000)
 
@@ -141,12 +152,20 @@ class ImageDetails(BaseModel):
     id: int
     filename: str
     uploaded_at: datetime
-    prediction: Optional[Prediction]
+    prediction: Optional[PredictionWithTopK]
     comments: List[CommentWithUser]
 
     class Config:
         from_attributes = True
 
+class SimilarImage(BaseModel):
+    id: int
+    filename: str
+    uploaded_at: datetime
+    similarity: float
+    prediction: Optional[Prediction]
+    comments: List[CommentWithUser]
+
 class UserImageUpload(BaseModel):
     id: int
     filename: str
@@ -155,4 +174,77 @@ class UserImageUpload(BaseModel):
     user_id: int
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class DiseaseStat(BaseModel):
+    disease: str
+    count: int
+    mean_confidence: float
+
+class DailyDiseaseStat(DiseaseStat):
+    day: date
+
+class UserDiseaseStat(DiseaseStat):
+    user_id: int
+
+class ConfidenceBucket(BaseModel):
+    disease: str
+    lower: float
+    upper: float
+    count: int
+
+class PredictionStats(BaseModel):
+    total_predictions: int
+    per_disease: List[DiseaseStat]
+    per_day: List[DailyDiseaseStat]
+    per_user: List[UserDiseaseStat]
+    confidence_histogram: List[ConfidenceBucket]
+
+class PredictionSortField(str, Enum):
+    predicted_at = "predicted_at"
+    confidence = "confidence"
+    uploaded_at = "uploaded_at"
+
+class PredictionSearchItem(BaseModel):
+    id: int
+    disease: DiseaseClass
+    confidence: float
+    predicted_at: datetime
+    image_id: int
+    user_id: int
+    filename: str
+    uploaded_at: datetime
+    uploader_id: int
+
+class PredictionSearchPage(BaseModel):
+    items: List[PredictionSearchItem]
+    page: int
+    page_size: int
+    total: int
+    # True when counting stopped at the cap and total is a lower bound
+    total_is_estimate: bool
+
+class CommentSearchItem(BaseModel):
+    # Relevance as reported by the search backend; higher is better
+    score: float
+    comment: CommentWithUser
+    filename: str
+    uploaded_at: datetime
+    # The image's first prediction, if it has one
+    prediction: Optional[PredictionWithTopK]
+
+class CommentSearchPage(BaseModel):
+    items: List[CommentSearchItem]
+    page: int
+    page_size: int
+    total: int
+    # True when counting stopped at the cap and total is a lower bound
+    total_is_estimate: bool
+
+class ProfilingConfig(BaseModel):
+    # Fraction of requests that open a sampling window (0 disables the sampler)
+    sample_rate: Optional[float] = Field(None, ge=0, le=1)
+    sample_interval_ms: Optional[float] = Field(None, gt=0, le=1000)
+    # Capture a TensorFlow profiler trace around the next model.predict
+    capture_predict_trace: bool = False
+    trace_upload_allocations: Optional[bool] = None
@@ -0,0 +1,311 @@
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import make_transient_to_detached
+
+import models
+from database import SessionLocal
+
+# Session configuration, overridable per deployment through the environment
+SESSION_STORE = os.environ.get("SESSION_STORE", "database")  # 'database' or 'sqlite'
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 24 * 60 * 60))
+SESSION_SQLITE_PATH = os.environ.get("SESSION_SQLITE_PATH", "sessions.db")
+# How long a worker trusts a token it has already looked up
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get("SESSION_CACHE_TTL_SECONDS", 10))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 4096))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL_SECONDS = int(os.environ.get("USER_CACHE_TTL_SECONDS", 60))
+
+
+class TokenCache:
+    """
+    Short-lived, bounded map of token -> user id in front of the session store,
+    so a client making several requests in a row costs one store lookup. An
+    entry never outlives the session's own expiry; a logout on another worker
+    is seen here once the entry ages out (SESSION_CACHE_TTL_SECONDS).
+    """
+
+    def __init__(self, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user_id, valid_until = entry
+            if time.monotonic() >= valid_until:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return user_id
+
+    def put(self, token, user_id, expires_at):
+        valid_for = min(self.ttl, (expires_at - datetime.now()).total_seconds())
+        if valid_for <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (user_id, time.monotonic() + valid_for)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SessionStore(ABC):
+    """
+    Maps session tokens to user ids with a sliding expiry.
+    Every successful get() pushes the expiry forward, but the new expiry is only
+    written back once it has moved by more than refresh_interval, so an active
+    session does not cost a write on every request. Lookups are served from a
+    per-process TokenCache for up to cache_ttl seconds.
+    """
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, refresh_interval=None, cache_ttl=SESSION_CACHE_TTL_SECONDS):
+        self.ttl = timedelta(seconds=ttl)
+        self.refresh_interval = timedelta(seconds=refresh_interval if refresh_interval is not None else max(ttl // 100, 1))
+        self.cache = TokenCache(ttl=cache_ttl)
+
+    def _needs_refresh(self, expires_at, now):
+        return now + self.ttl - expires_at > self.refresh_interval
+
+    def get(self, token, db=None):
+        """User id for a live token, or None. db is the request's session, used instead of opening another."""
+        user_id = self.cache.get(token)
+        if user_id is not None:
+            return user_id
+        found = self._lookup(token, db)
+        if found is None:
+            return None
+        user_id, expires_at = found
+        self.cache.put(token, user_id, expires_at)
+        return user_id
+
+    def delete(self, token):
+        self.cache.invalidate(token)
+        return self._delete(token)
+
+    @abstractmethod
+    def create(self, token, user_id):
+        pass
+
+    @abstractmethod
+    def _lookup(self, token, db):
+        """(user id, expiry after any refresh) for a live token, or None."""
+
+    @abstractmethod
+    def _delete(self, token):
+        pass
+
+    @abstractmethod
+    def purge_expired(self):
+        pass
+
+
+class DatabaseSessionStore(SessionStore):
+    """Sessions kept in the user_sessions table, shared by every worker and node."""
+
+    def __init__(self, session_factory=SessionLocal, **kwargs):
+        super().__init__(**kwargs)
+        self.session_factory = session_factory
+
+    def create(self, token, user_id):
+        db = self.session_factory()
+        try:
+            db.add(models.UserSession(token=token, user_id=user_id, expires_at=datetime.now() + self.ttl))
+            db.commit()
+        finally:
+            db.close()
+
+    def _lookup(self, token, db):
+        if db is not None:
+            return self._lookup_in(db, token)
+        db = self.session_factory()
+        try:
+            return self._lookup_in(db, token)
+        finally:
+            db.close()
+
+    def _lookup_in(self, db, token):
+        session = db.query(models.UserSession).filter(models.UserSession.token == token).first()
+        if session is None:
+            return None
+        now = datetime.now()
+        if session.expires_at <= now:
+            db.delete(session)
+            db.commit()
+            return None
+        user_id = session.user_id
+        expires_at = session.expires_at
+        if self._needs_refresh(expires_at, now):
+            expires_at = session.expires_at = now + self.ttl
+            db.commit()
+        return user_id, expires_at
+
+    def _delete(self, token):
+        db = self.session_factory()
+        try:
+            session = db.query(models.UserSession).filter(models.UserSession.token == token).first()
+            if session is None:
+                return None
+            user_id = session.user_id
+            db.delete(session)
+            db.commit()
+            return user_id
+        finally:
+            db.close()
+
+    def purge_expired(self):
+        db = self.session_factory()
+        try:
+            db.query(models.UserSession).filter(
+                models.UserSession.expires_at <= datetime.now()
+            ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions kept in a local SQLite file. Every worker process on the same node
+    shares the file, which is enough for a single-host multi-worker deployment
+    without touching the main database.
+    """
+
+    def __init__(self, path=SESSION_SQLITE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_sessions ("
+                "token TEXT PRIMARY KEY, user_id INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_user_sessions_expires_at ON user_sessions (expires_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, token, user_id):
+        expires_at = (datetime.now() + self.ttl).timestamp()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO user_sessions VALUES (?, ?, ?)", (token, user_id, expires_at))
+
+    def _lookup(self, token, db):
+        conn = self._connect()
+        row = conn.execute("SELECT user_id, expires_at FROM user_sessions WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None
+        user_id, expires_at = row
+        now = datetime.now()
+        expires_at = datetime.fromtimestamp(expires_at)
+        with conn:
+            if expires_at <= now:
+                conn.execute("DELETE FROM user_sessions WHERE token = ?", (token,))
+                return None
+            if self._needs_refresh(expires_at, now):
+                expires_at = now + self.ttl
+                conn.execute(
+                    "UPDATE user_sessions SET expires_at = ? WHERE token = ?", (expires_at.timestamp(), token)
+                )
+        return user_id, expires_at
+
+    def _delete(self, token):
+        with self._connect() as conn:
+            row = conn.execute("SELECT user_id FROM user_sessions WHERE token = ?", (token,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM user_sessions WHERE token = ?", (token,))
+            return row[0]
+
+    def purge_expired(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM user_sessions WHERE expires_at <= ?", (time.time(),))
+
+
+class UserCache:
+    """
+    Bounded LRU of resolved users keyed by user id. Entries hold plain column
+    values rather than ORM instances, so they are safe to share across requests.
+    """
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            values, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return values
+
+    def put(self, user):
+        values = {column.name: getattr(user, column.name) for column in models.User.__table__.columns}
+        with self._lock:
+            self._entries[user.id] = (values, time.monotonic())
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def create_session_store():
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore()
+    if SESSION_STORE == "database":
+        return DatabaseSessionStore()
+    raise ValueError(f"Unknown SESSION_STORE '{SESSION_STORE}', expected 'database' or 'sqlite'")
+
+
+session_store = create_session_store()
+user_cache = UserCache()
+
+
+def resolve_user(db, user_id):
+    # Serve the user from the cache and attach it to the request session without
+    # a SELECT; fall back to the users table on a miss
+    values = user_cache.get(user_id)
+    if values is not None:
+        user = models.User(**values)
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+    user = db.query(models.User).filter(models.User.id == user_id).first()
+    if user is not None:
+        user_cache.put(user)
+    return user
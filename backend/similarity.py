@@ -0,0 +1,302 @@
+"""
+Embedding store and nearest-neighbour search over past images.
+
+Embeddings (the penultimate-layer activations of the classifier) are
+L2-normalised and appended as fixed-size records of
+(image_id, list_id, float16 vector) to a single file, which is memory-mapped
+for search. Appends are a single O_APPEND write per record, so several workers
+can add to the same file; every search picks up records appended since the
+last one with a cheap stat(). Cosine similarity is then a dot product.
+Appenders hold a shared flock on the file and `train` an exclusive one while it
+swaps in the rewritten file, so no append lands in the replaced copy.
+
+Search is an inverted-file (IVF) index: `python similarity.py train` clusters
+the stored vectors with spherical k-means and tags every record with its
+nearest centroid (list_id). A query is then only compared with the records in
+its `nprobe` closest lists, which keeps search in milliseconds at a million
+images. Records added before training (list_id -1) are always scanned.
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no advisory locks, so train() can lose a concurrent append
+    fcntl = None
+
+EMBEDDING_DIR = os.environ.get("EMBEDDING_DIR", "embeddings")
+DEFAULT_NPROBE = int(os.environ.get("EMBEDDING_NPROBE", 16))
+SEARCH_CHUNK_ROWS = 131072
+UNASSIGNED = -1
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class EmbeddingIndex:
+    def __init__(self, directory=EMBEDDING_DIR, nprobe=DEFAULT_NPROBE):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.data_path = os.path.join(directory, "embeddings.f16")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.centroids_path = os.path.join(directory, "centroids.npy")
+        self._lock = threading.Lock()
+        self.dtype = None
+        self._centroids = None
+        self._centroids_mtime = None
+        self._reset()
+
+    def _reset(self):
+        self._records = None
+        self._file_id = None
+        self._mapped_rows = 0
+        self._latest_row = {}
+        self._lists = {}
+
+    def _set_dim(self, dim):
+        self.dim = dim
+        self.dtype = np.dtype([("image_id", "<i8"), ("list_id", "<i8"), ("vector", "<f2", (dim,))])
+
+    def _load_meta(self):
+        if self.dtype is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as meta:
+                self._set_dim(json.load(meta)["dim"])
+
+    def _ensure_meta(self, dim):
+        self._load_meta()
+        if self.dtype is not None:
+            if dim != self.dim:
+                raise ValueError(f"Embedding has {dim} dimensions, index expects {self.dim}")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.meta_path, "w") as meta:
+            json.dump({"dim": dim}, meta)
+        self._set_dim(dim)
+
+    def _load_centroids(self):
+        if not os.path.exists(self.centroids_path):
+            return
+        mtime = os.path.getmtime(self.centroids_path)
+        if mtime != self._centroids_mtime:
+            self._centroids = np.load(self.centroids_path)
+            self._centroids_mtime = mtime
+
+    def _refresh(self):
+        self._load_meta()
+        if self.dtype is None or not os.path.exists(self.data_path):
+            return
+        stat = os.stat(self.data_path)
+        rows = stat.st_size // self.dtype.itemsize
+        file_id = (stat.st_ino, stat.st_dev)
+        if rows == self._mapped_rows and file_id == self._file_id:
+            return
+        with self._lock:
+            self._load_centroids()
+            if file_id != self._file_id or rows < self._mapped_rows:
+                # First load, or the file was rewritten by `train`: start over
+                self._reset()
+                self._file_id = file_id
+            if rows == self._mapped_rows:
+                return
+            records = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(rows,))
+            start = self._mapped_rows
+            new_ids = records["image_id"][start:rows].tolist()
+            self._latest_row.update(zip(new_ids, range(start, rows)))
+
+            # Group the new rows by inverted list
+            list_ids = np.asarray(records["list_id"][start:rows])
+            order = np.argsort(list_ids, kind="stable")
+            boundaries = np.flatnonzero(np.diff(list_ids[order])) + 1
+            for group in np.split(order, boundaries):
+                if group.size:
+                    self._lists.setdefault(int(list_ids[group[0]]), []).append(group + start)
+            self._records = records
+            self._mapped_rows = rows
+
+    def __len__(self):
+        self._refresh()
+        return len(self._latest_row)
+
+    def _assign(self, vectors):
+        if self._centroids is None:
+            return np.full(len(vectors), UNASSIGNED, dtype=np.int64)
+        return np.argmax(vectors @ self._centroids.T, axis=1)
+
+    def add(self, image_id, embedding):
+        vector = _normalize(np.ravel(embedding))
+        self._ensure_meta(vector.shape[0])
+        self._load_centroids()
+        record = np.zeros(1, dtype=self.dtype)
+        record["image_id"] = image_id
+        record["list_id"] = self._assign(vector[None, :])[0]
+        record["vector"] = vector.astype(np.float16)
+        # One write per record keeps concurrent appends from interleaving
+        while True:
+            fd = os.open(self.data_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                    if os.fstat(fd).st_ino != os.stat(self.data_path).st_ino:
+                        # train() swapped the file while we waited: append to the new one
+                        continue
+                os.write(fd, record.tobytes())
+                return
+            finally:
+                os.close(fd)
+
+    def get(self, image_id):
+        self._refresh()
+        row = self._latest_row.get(image_id)
+        if row is None:
+            return None
+        return np.asarray(self._records["vector"][row], dtype=np.float32)
+
+    def _candidate_rows(self, query):
+        # Without centroids every row is a candidate (exact search)
+        if self._centroids is None:
+            return None
+        nprobe = min(self.nprobe, len(self._centroids))
+        probe = np.argpartition(self._centroids @ query, -nprobe)[-nprobe:]
+        chunks = []
+        for list_id in [UNASSIGNED, *probe.tolist()]:
+            chunks.extend(self._lists.get(list_id, []))
+        return np.sort(np.concatenate(chunks)) if chunks else np.empty(0, dtype=np.int64)
+
+    def search(self, query, k=10, exclude_image_id=None):
+        """Return [(image_id, cosine similarity)] for the k most similar images."""
+        self._refresh()
+        if self._records is None or k <= 0:
+            return []
+        records = self._records
+        query = _normalize(query)
+        candidates = self._candidate_rows(query)
+        total = self._mapped_rows if candidates is None else len(candidates)
+
+        # Over-fetch a little so superseded rows and the query image can be dropped
+        want = k + 8
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        for start in range(0, total, SEARCH_CHUNK_ROWS):
+            stop = min(start + SEARCH_CHUNK_ROWS, total)
+            rows = np.arange(start, stop) if candidates is None else candidates[start:stop]
+            vectors = records["vector"][start:stop] if candidates is None else records["vector"][rows]
+            scores = vectors.astype(np.float32) @ query
+            top = np.argpartition(scores, -want)[-want:] if scores.shape[0] > want else np.arange(scores.shape[0])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            best_rows = np.concatenate([best_rows, rows[top]])
+            if best_scores.shape[0] > want:
+                keep = np.argpartition(best_scores, -want)[-want:]
+                best_scores, best_rows = best_scores[keep], best_rows[keep]
+
+        results = []
+        for index in np.argsort(-best_scores):
+            row = int(best_rows[index])
+            image_id = int(records["image_id"][row])
+            if image_id == exclude_image_id or self._latest_row.get(image_id) != row:
+                continue
+            results.append((image_id, float(best_scores[index])))
+            if len(results) == k:
+                break
+        return results
+
+    def train(self, n_lists=None, sample_size=100000, iterations=10, seed=0):
+        """
+        Cluster the stored vectors with spherical k-means, then rewrite the data
+        file with every record tagged by its nearest centroid. Records appended
+        meanwhile are copied over at the end, under an exclusive lock that holds
+        appends back until the rewritten file is in place.
+        """
+        self._refresh()
+        if self._records is None:
+            raise ValueError("The index is empty")
+        rows = self._mapped_rows
+        n_lists = n_lists or int(np.clip(np.sqrt(rows), 16, 4096))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(rows, size=min(sample_size, rows), replace=False))
+        sample = self._records["vector"][sample_rows].astype(np.float32)
+        n_lists = min(n_lists, len(sample))
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.empty(len(sample), dtype=np.int64)
+            for start in range(0, len(sample), 16384):
+                assignment[start:start + 16384] = np.argmax(sample[start:start + 16384] @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            # Re-seed empty clusters from random sample points
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+            centroids = _normalize(sums)
+
+        tmp_path = self.data_path + ".tmp"
+        with open(tmp_path, "wb") as output, open(self.data_path, "rb") as data_file:
+            copied = 0
+
+            def copy_appended():
+                nonlocal copied
+                while True:
+                    current = os.fstat(data_file.fileno()).st_size // self.dtype.itemsize
+                    if copied == current:
+                        return
+                    source = np.memmap(data_file, dtype=self.dtype, mode="r", shape=(current,))
+                    for start in range(copied, current, SEARCH_CHUNK_ROWS):
+                        chunk = np.array(source[start:min(start + SEARCH_CHUNK_ROWS, current)])
+                        chunk["list_id"] = np.argmax(chunk["vector"].astype(np.float32) @ centroids.T, axis=1)
+                        output.write(chunk.tobytes())
+                    copied = current
+                    del source
+
+            # The bulk is copied while workers keep appending; only the tail
+            # and the swap hold them back
+            copy_appended()
+            if fcntl is not None:
+                fcntl.flock(data_file.fileno(), fcntl.LOCK_EX)
+            copy_appended()
+            output.close()
+            np.save(self.centroids_path + ".tmp.npy", centroids.astype(np.float32))
+            os.replace(self.centroids_path + ".tmp.npy", self.centroids_path)
+            os.replace(tmp_path, self.data_path)
+            # Closing data_file releases the lock; waiting appenders see the new inode
+        self._centroids_mtime = None
+        self._refresh()
+        return n_lists
+
+
+embedding_index = EmbeddingIndex()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the image embedding index")
+    parser.add_argument("command", choices=["backfill", "train"])
+    parser.add_argument("--uploads", default="uploads")
+    parser.add_argument("--lists", type=int, default=None, help="Number of IVF lists (default: sqrt of the row count)")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        n_lists = embedding_index.train(n_lists=args.lists)
+        print(f"Trained {n_lists} lists over {len(embedding_index)} images")
+    else:
+        import models
+        from database import SessionLocal
+        from ml_model import extract_embedding
+
+        db = SessionLocal()
+        try:
+            added = 0
+            for image_id, filename in db.query(models.Image.id, models.Image.filename).order_by(models.Image.id):
+                path = os.path.join(args.uploads, filename)
+                if embedding_index.get(image_id) is not None or not os.path.exists(path):
+                    continue
+                embedding_index.add(image_id, extract_embedding(path))
+                added += 1
+            print(f"Added {added} embeddings, index now holds {len(embedding_index)} images")
+        finally:
+            db.close()
@@ -0,0 +1,197 @@
+import argparse
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import delete, event, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal, engine
+
+HISTOGRAM_BUCKETS = 10
+# Each attempt either increments the row or inserts it; inserting only fails
+# when another transaction inserted the same row first
+ROLLUP_UPSERT_ATTEMPTS = 3
+
+
+def confidence_bucket(confidence):
+    # Clamp so that a confidence of exactly 1.0 lands in the top bucket
+    bucket = int((confidence or 0.0) * HISTOGRAM_BUCKETS)
+    return min(max(bucket, 0), HISTOGRAM_BUCKETS - 1)
+
+
+def _rollup_keys(prediction):
+    predicted_at = prediction.predicted_at or datetime.datetime.now()
+    return [
+        (models.PredictionDailyStat, {"day": predicted_at.date(), "disease": prediction.disease}),
+        (models.PredictionUserStat, {"user_id": prediction.user_id, "disease": prediction.disease}),
+        (models.ConfidenceHistogram, {"disease": prediction.disease, "bucket": confidence_bucket(prediction.confidence)}),
+    ]
+
+
+def _increment_rollup(connection, rollup_model, key, count, confidence_sum):
+    table = rollup_model.__table__
+    increment = update(table).where(*(table.c[name] == value for name, value in key.items())).values(
+        prediction_count=table.c.prediction_count + count,
+        confidence_sum=table.c.confidence_sum + confidence_sum
+    )
+    for _ in range(ROLLUP_UPSERT_ATTEMPTS):
+        # An existing row is incremented in place; the UPDATE's row lock
+        # serializes concurrent predictions on the counter
+        if connection.execute(increment).rowcount:
+            return
+        try:
+            # Only the INSERT is undone if a concurrent first prediction for
+            # the same key committed its row in the meantime
+            with connection.begin_nested():
+                connection.execute(insert(table).values(prediction_count=count, confidence_sum=confidence_sum, **key))
+            return
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"Could not update {table.name} for {key}")
+
+
+def _rollup_totals(predictions):
+    # (rollup model, key items) -> [prediction count, confidence sum]
+    totals = defaultdict(lambda: [0, 0.0])
+    for prediction in predictions:
+        for rollup_model, key in _rollup_keys(prediction):
+            entry = totals[rollup_model, tuple(sorted(key.items()))]
+            entry[0] += 1
+            entry[1] += prediction.confidence or 0.0
+    return totals
+
+
+@event.listens_for(Session, "after_flush")
+def update_rollups_on_flush(session, flush_context):
+    new_predictions = [obj for obj in session.new if isinstance(obj, models.Prediction)]
+    if not new_predictions:
+        return
+
+    # Runs after the predictions' INSERTs, inside the same transaction, so the
+    # rollups commit (or roll back) together with them
+    connection = session.connection()
+    for (rollup_model, key), (count, confidence_sum) in _rollup_totals(new_predictions).items():
+        _increment_rollup(connection, rollup_model, dict(key), count, confidence_sum)
+
+
+def remove_from_rollups(db, predictions):
+    """
+    Take predictions that are being deleted (rows with predicted_at, user_id,
+    disease and confidence) out of the rollups, in the caller's transaction, so
+    the rollups keep describing the predictions table as rebuild_stats would.
+    """
+    connection = db.connection()
+    for (rollup_model, key), (count, confidence_sum) in _rollup_totals(predictions).items():
+        table = rollup_model.__table__
+        match = [table.c[name] == value for name, value in key]
+        connection.execute(update(table).where(*match).values(
+            prediction_count=table.c.prediction_count - count,
+            confidence_sum=table.c.confidence_sum - confidence_sum
+        ))
+        # rebuild_stats has no rows for keys without predictions
+        connection.execute(delete(table).where(*match, table.c.prediction_count <= 0))
+
+
+def rebuild_stats(db, batch_size=10000):
+    """
+    Recompute every rollup table from the predictions table.
+    Predictions are streamed in batches so memory stays flat on large archives.
+    """
+    totals = {
+        models.PredictionDailyStat: defaultdict(lambda: [0, 0.0]),
+        models.PredictionUserStat: defaultdict(lambda: [0, 0.0]),
+        models.ConfidenceHistogram: defaultdict(lambda: [0, 0.0]),
+    }
+
+    rows = db.query(
+        models.Prediction.predicted_at,
+        models.Prediction.user_id,
+        models.Prediction.disease,
+        models.Prediction.confidence
+    ).execution_options(yield_per=batch_size)
+
+    scanned = 0
+    for row in rows:
+        for rollup_model, key in _rollup_keys(row):
+            entry = totals[rollup_model][tuple(sorted(key.items()))]
+            entry[0] += 1
+            entry[1] += row.confidence or 0.0
+        scanned += 1
+
+    for rollup_model, entries in totals.items():
+        db.query(rollup_model).delete(synchronize_session=False)
+        db.bulk_insert_mappings(rollup_model, [
+            dict(key, prediction_count=count, confidence_sum=confidence_sum)
+            for key, (count, confidence_sum) in entries.items()
+        ])
+    db.commit()
+    return scanned
+
+
+def read_stats(db, days=30):
+    # Every query below only reads rollup tables, whose size is bounded by
+    # days x classes, users x classes and classes x buckets
+    since = datetime.date.today() - datetime.timedelta(days=days - 1)
+
+    per_disease = db.query(
+        models.ConfidenceHistogram.disease,
+        func.sum(models.ConfidenceHistogram.prediction_count),
+        func.sum(models.ConfidenceHistogram.confidence_sum)
+    ).group_by(models.ConfidenceHistogram.disease).all()
+
+    per_day = db.query(models.PredictionDailyStat).filter(
+        models.PredictionDailyStat.day >= since
+    ).order_by(models.PredictionDailyStat.day, models.PredictionDailyStat.disease).all()
+
+    per_user = db.query(models.PredictionUserStat).order_by(
+        models.PredictionUserStat.user_id, models.PredictionUserStat.disease
+    ).all()
+
+    histogram = db.query(models.ConfidenceHistogram).order_by(
+        models.ConfidenceHistogram.disease, models.ConfidenceHistogram.bucket
+    ).all()
+
+    def mean(total, count):
+        return total / count if count else 0.0
+
+    return {
+        "total_predictions": sum(count or 0 for _, count, _ in per_disease),
+        "per_disease": [
+            {"disease": disease, "count": count, "mean_confidence": mean(total, count)}
+            for disease, count, total in per_disease
+        ],
+        "per_day": [
+            {"day": row.day, "disease": row.disease, "count": row.prediction_count,
+             "mean_confidence": mean(row.confidence_sum, row.prediction_count)}
+            for row in per_day
+        ],
+        "per_user": [
+            {"user_id": row.user_id, "disease": row.disease, "count": row.prediction_count,
+             "mean_confidence": mean(row.confidence_sum, row.prediction_count)}
+            for row in per_user
+        ],
+        "confidence_histogram": [
+            {"disease": row.disease,
+             "lower": row.bucket / HISTOGRAM_BUCKETS,
+             "upper": (row.bucket + 1) / HISTOGRAM_BUCKETS,
+             "count": row.prediction_count}
+            for row in histogram
+        ],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain prediction statistics rollups")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        scanned = rebuild_stats(db, batch_size=args.batch_size)
+        print(f"Rebuilt prediction statistics from {scanned} predictions")
+    finally:
+        db.close()
@@ -0,0 +1,46 @@
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic_core import to_json
+
+from database import SessionLocal
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 1000
+
+
+def wants_ndjson(request: Request, response_format=None):
+    # Streaming is opt-in through ?format=ndjson or an NDJSON Accept header
+    if response_format is not None:
+        return response_format.lower() == "ndjson"
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def json_response(rows):
+    # Rows are plain dicts built straight from result rows, so they are serialized
+    # once by pydantic-core instead of being validated into schemas and then
+    # validated again against the route's response_model
+    return Response(content=to_json(rows), media_type="application/json")
+
+
+def ndjson_response(statement, row_to_dict, batch_size=STREAM_BATCH_SIZE):
+    """
+    Stream one JSON document per line straight from a server-side cursor.
+    The generator owns its own session: the request's get_db session is closed
+    before a StreamingResponse body starts being sent.
+    """
+    def generate():
+        db = SessionLocal()
+        try:
+            result = db.execute(statement.execution_options(stream_results=True, yield_per=batch_size))
+            for partition in result.mappings().partitions(batch_size):
+                yield b"".join(to_json(row_to_dict(row)) + b"\n" for row in partition)
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE)
+
+
+def listing_response(request: Request, response_format, db, statement, row_to_dict):
+    if wants_ndjson(request, response_format):
+        return ndjson_response(statement, row_to_dict)
+    return json_response([row_to_dict(row) for row in db.execute(statement).mappings()])
@@ -0,0 +1,147 @@
+"""
+Concurrency check for /upload: many clients upload the same bytes, retry with
+one Idempotency-Key, and upload distinct images, all at once. Afterwards every
+request must have succeeded, there must be exactly one image row and one file
+per distinct image, no file without a row (or the reverse), and the retried
+requests must all have returned the same upload.
+
+    python stress_upload.py --url http://localhost:8000 --uploads-dir uploads
+    python stress_upload.py --in-process --concurrency 64
+
+--in-process drives main.app through ASGI in a throwaway directory; to check a
+running server, pass its uploads directory and run this from the backend
+directory so the same DATABASE_URL is used. Exits non-zero on any violation.
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import secrets
+import sys
+import tempfile
+from collections import Counter
+
+import httpx
+import numpy as np
+from PIL import Image
+
+
+def noise_png(seed, size=128):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def login(client, index):
+    username = f"stress_{secrets.token_hex(4)}_{index}"
+    await client.post("/register", json={"username": username, "email": f"{username}@example.com", "password": "stress1"})
+    response = await client.post("/login", json={"username": username, "password": "stress1"})
+    response.raise_for_status()
+    return response.json()["token"]
+
+
+async def run(client, concurrency, users, distinct):
+    tokens = [await login(client, index) for index in range(users)]
+    base_seed = secrets.randbelow(2 ** 31)
+    same = noise_png(base_seed)
+    keyed = noise_png(base_seed + 1)
+    key = secrets.token_hex(16)
+
+    # (token, bytes, idempotency key)
+    jobs = [(tokens[i % users], same, None) for i in range(concurrency)]
+    jobs += [(tokens[0], keyed, key) for _ in range(concurrency // 2)]
+    distinct_images = [noise_png(base_seed + 2 + i) for i in range(distinct)]
+    jobs += [(tokens[i % users], data, None) for i, data in enumerate(distinct_images + distinct_images[: distinct // 2])]
+    random.shuffle(jobs)
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def upload(token, data, idempotency_key):
+        headers = {"Authorization": f"Bearer {token}"}
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        async with slots:
+            response = await client.post("/upload", headers=headers, files={"file": ("stress.png", data, "image/png")})
+        return response.status_code, response.json(), idempotency_key
+
+    results = await asyncio.gather(*(upload(*job) for job in jobs))
+    expected_images = {data for _, data, _ in jobs}
+    return results, len(expected_images)
+
+
+def check(results, expected_images, uploads_dir):
+    import models
+    from database import SessionLocal
+
+    problems = []
+    statuses = Counter(status for status, _, _ in results)
+    print(f"{len(results)} uploads, statuses {dict(statuses)}")
+    if set(statuses) != {200}:
+        problems.append(f"non-200 responses: {[body for status, body, _ in results if status != 200][:5]}")
+
+    keyed_uploads = {body["upload"]["id"] for status, body, key in results if key and status == 200}
+    if len(keyed_uploads) != 1:
+        problems.append(f"idempotent retries produced {len(keyed_uploads)} uploads")
+
+    image_ids = {body["image"]["id"] for status, body, _ in results if status == 200}
+    db = SessionLocal()
+    try:
+        filenames = {
+            filename for (filename,) in db.query(models.Image.filename).filter(models.Image.id.in_(image_ids))
+        }
+        all_filenames = {filename for (filename,) in db.query(models.Image.filename)}
+    finally:
+        db.close()
+    if len(image_ids) != expected_images:
+        problems.append(f"{len(image_ids)} image rows for {expected_images} distinct images")
+
+    files = set(os.listdir(uploads_dir))
+    leftovers = [name for name in files if name.endswith(".tmp")]
+    orphans = files - all_filenames - set(leftovers)
+    missing = filenames - files
+    print(f"{len(image_ids)} images, {len(files)} files, {len(orphans)} orphaned, {len(missing)} missing, {len(leftovers)} temp")
+    if orphans or missing or leftovers:
+        problems.append(f"orphaned {sorted(orphans)[:5]}, missing {sorted(missing)[:5]}, temp {leftovers[:5]}")
+    return problems
+
+
+async def main_async(args):
+    if args.in_process:
+        from loadtest import install_stub_model
+
+        workdir = tempfile.mkdtemp(prefix="stress-upload-")
+        os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'stress.db')}")
+        os.environ.setdefault("SESSION_SQLITE_PATH", os.path.join(workdir, "sessions.db"))
+        install_stub_model()
+        os.chdir(workdir)
+        from main import app
+
+        print(f"in-process run, working directory {workdir}")
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://stress", timeout=120)
+        uploads_dir = os.path.join(workdir, "uploads")
+    else:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=args.url, timeout=120, limits=limits)
+        uploads_dir = args.uploads_dir
+    async with client:
+        results, expected_images = await run(client, args.concurrency, args.users, args.distinct)
+    return check(results, expected_images, uploads_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running API server")
+    target.add_argument("--in-process", action="store_true", help="Drive main.app directly through ASGI")
+    parser.add_argument("--uploads-dir", default="uploads", help="Server's uploads directory (with --url)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--distinct", type=int, default=100)
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    problems = asyncio.run(main_async(args))
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,78 @@
+"""
+Shared test setup. main.py creates its tables and indexes at import, so the
+throwaway SQLite database, the working directory (uploads/, embeddings/) and
+loadtest.py's stub model are all put in place before anything imports it.
+"""
+import io
+import os
+import secrets
+import sys
+import tempfile
+
+import pytest
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="backend-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ["SESSION_SQLITE_PATH"] = os.path.join(WORKDIR, "sessions.db")
+os.environ["DETAILS_CACHE_SQLITE_PATH"] = os.path.join(WORKDIR, "details_cache.db")
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(WORKDIR)
+
+import loadtest  # noqa: E402
+
+loadtest.install_stub_model()
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    # One client for the whole run so startup and shutdown hooks run once
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def db():
+    from database import SessionLocal
+
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def login(client):
+    """Registers a fresh user; returns (auth headers, user id)."""
+    def register_and_login():
+        username = f"user{secrets.token_hex(4)}"
+        client.post("/register", json={"username": username, "email": f"{username}@example.com", "password": "secret1"})
+        response = client.post("/login", json={"username": username, "password": "secret1"}).json()
+        return {"Authorization": f"Bearer {response['token']}"}, response["user"]["id"]
+
+    return register_and_login
+
+
+def jpeg_bytes(seed=None):
+    """A small JPEG whose content (and so hash) differs per seed."""
+    seed = secrets.randbelow(1 << 24) if seed is None else seed
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (seed & 255, (seed >> 8) & 255, (seed >> 16) & 255)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def upload(client):
+    """Uploads a fresh image as the given user; returns its image id."""
+    def upload_image(headers, data=None):
+        response = client.post("/upload", files={"file": ("leaf.jpg", data or jpeg_bytes(), "image/jpeg")}, headers=headers)
+        assert response.status_code == 200, response.text
+        return response.json()["image"]["id"]
+
+    return upload_image
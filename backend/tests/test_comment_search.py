@@ -0,0 +1,43 @@
+import secrets
+
+import pytest
+
+import comment_search
+from database import engine
+
+
+@pytest.fixture
+def commented_image(client, login, upload):
+    """An image with comments around two fresh words, so other tests' comments never match."""
+    headers, user_id = login()
+    image_id = upload(headers)
+    blight, leaf = f"blight{secrets.token_hex(3)}", f"leaf{secrets.token_hex(3)}"
+    texts = {
+        "dense": f"{blight} {leaf} {blight}",
+        "diluted": f"{blight} spotted on one {leaf} near the edge of the field after rain",
+        "only_blight": f"{blight} everywhere",
+    }
+    ids = {}
+    for name, comment_text in texts.items():
+        response = client.post("/comment", json={"comment_text": comment_text, "image_id": image_id, "user_id": user_id})
+        assert response.status_code == 200, response.text
+        ids[response.json()["id"]] = name
+    return blight, leaf, ids
+
+
+def test_search_ranks_matches_of_every_term(client, commented_image):
+    blight, leaf, ids = commented_image
+    page = client.get("/comments/search", params={"q": f"{blight} {leaf}"}).json()
+
+    assert [ids[item["comment"]["id"]] for item in page["items"]] == ["dense", "diluted"]
+    assert page["items"][0]["score"] > page["items"][1]["score"]
+    assert page["total"] == 2
+
+
+def test_inverted_index_ranks_like_the_native_backend(client, db, commented_image):
+    blight, leaf, ids = commented_image
+    comment_search.InvertedIndex.rebuild(engine)
+    hits, total = comment_search.InvertedIndex().page(db, [blight, leaf], 0, 10, 100)
+
+    assert [ids[comment_id] for comment_id, score in hits] == ["dense", "diluted"]
+    assert total == 2
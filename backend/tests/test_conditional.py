@@ -0,0 +1,36 @@
+import calibration
+
+
+def test_backfill_changes_etags_cached_details_and_stats(client, db, login, upload):
+    headers, _ = login()
+    image_id = upload(headers)
+    prediction = client.post("/predict", json={"image_id": image_id}, headers=headers).json()
+
+    details = client.get(f"/image-details/{image_id}")
+    listing = client.get("/all-predictions")
+    for response in (details, listing):
+        assert client.get(response.request.url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    # Weight the predicted class down so hard that every stored label moves off it
+    candidate = calibration.Calibration(class_weights={prediction["disease"]: 1e-9})
+    try:
+        assert calibration.backfill(db, candidate)[1] > 0
+
+        for response in (details, listing):
+            revalidated = client.get(response.request.url, headers={"If-None-Match": response.headers["ETag"]})
+            assert revalidated.status_code == 200
+            assert revalidated.headers["ETag"] != response.headers["ETag"]
+        assert client.get(f"/image-details/{image_id}").json()["prediction"]["disease"] != prediction["disease"]
+        per_disease = {item["disease"]: item["count"] for item in client.get("/stats").json()["per_disease"]}
+        assert per_disease.get(prediction["disease"], 0) == 0
+    finally:
+        calibration.backfill(db, calibration.Calibration())
+
+
+def test_top_k_is_sent_with_single_predictions(client, login, upload):
+    headers, _ = login()
+    image_id = upload(headers)
+    prediction = client.post("/predict", json={"image_id": image_id}, headers=headers).json()
+
+    assert prediction["top_k"][0]["disease"] == prediction["disease"]
+    assert client.get(f"/image-details/{image_id}").json()["prediction"]["top_k"] == prediction["top_k"]
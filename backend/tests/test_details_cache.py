@@ -0,0 +1,28 @@
+from datetime import datetime, timezone
+
+from details_cache import CachedDetails, MemoryDetailsCache, SQLiteDetailsCache, bump_shared_epoch
+
+ENTRY = CachedDetails('"etag"', datetime(2024, 1, 1, tzinfo=timezone.utc), b"{}")
+
+
+def test_bulk_clear_elsewhere_reaches_every_cache(client, tmp_path):
+    # client: main.py has created the tables, cache_epochs among them
+    # Two workers with their own caches; the epoch poll runs on every lookup
+    caches = [MemoryDetailsCache(epoch_poll=0), SQLiteDetailsCache(path=str(tmp_path / "cache.db"), epoch_poll=0)]
+    for cache in caches:
+        cache.put(1, ENTRY, cache.ticket())
+        assert cache.get(1) == ENTRY
+
+    # What archive.py or a calibration backfill does from its own process
+    bump_shared_epoch()
+
+    for cache in caches:
+        assert cache.get(1) is None
+
+
+def test_reader_that_started_before_a_bulk_clear_does_not_store(client):
+    cache = MemoryDetailsCache(epoch_poll=0)
+    ticket = cache.ticket()
+    bump_shared_epoch()
+    cache.put(1, ENTRY, ticket)
+    assert cache.get(1) is None
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+import pytest
+
+import lifecycle
+from inference import InferenceBusy, InferenceUnavailable
+
+
+class FakeInference:
+    def __init__(self, last_success=None, status_error=None):
+        self.last_success = last_success
+        self.status_error = status_error
+        self.status_calls = 0
+
+    def status(self, timeout=None):
+        self.status_calls += 1
+        if self.status_error is not None:
+            raise self.status_error
+        return {"ok": True, "backend": "service", "model_loaded": True}
+
+
+class Depth:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+@pytest.fixture
+def check_model(monkeypatch):
+    def check(fake, in_flight=0):
+        monkeypatch.setattr(lifecycle, "inference", fake)
+        monkeypatch.setattr(lifecycle, "model_queue_depth", Depth(in_flight))
+        return asyncio.run(lifecycle.Lifecycle()._check_model())
+
+    return check
+
+
+def test_busy_worker_with_completing_predictions_is_ready_without_a_status_call(check_model):
+    fake = FakeInference(last_success=time.monotonic() - 20)
+    assert check_model(fake, in_flight=12)["ok"]
+    assert fake.status_calls == 0
+
+
+def test_busy_worker_whose_predictions_stopped_completing_is_not_ready(check_model):
+    fake = FakeInference(last_success=time.monotonic() - lifecycle.INFERENCE_TIMEOUT_SECONDS - 1)
+    assert not check_model(fake, in_flight=3)["ok"]
+    assert fake.status_calls == 0
+
+
+def test_idle_worker_asks_the_service(check_model):
+    assert check_model(FakeInference())["ok"]
+    # Queued behind other workers' predictions: reachable, so still ready
+    assert check_model(FakeInference(status_error=InferenceBusy("busy")))["ok"]
+    assert not check_model(FakeInference(status_error=InferenceUnavailable("down")))["ok"]
@@ -0,0 +1,37 @@
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine.reflection import Inspector
+
+import models
+
+
+def test_migrate_adds_what_existing_tables_lack(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_upload_idempotency_keys_created_at")
+        connection.exec_driver_sql("ALTER TABLE predictions DROP COLUMN probabilities")
+
+    assert set(models.pending_migrations(engine)) == {
+        "predictions.probabilities", "upload_idempotency_keys.ix_upload_idempotency_keys_created_at"
+    }
+    assert models.migrate(engine) == ["predictions.probabilities", "upload_idempotency_keys.ix_upload_idempotency_keys_created_at"]
+    assert models.pending_migrations(engine) == []
+    assert models.migrate(engine) == []
+
+
+def test_migrate_tolerates_a_concurrent_run(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'raced.db'}")
+    models.Base.metadata.create_all(bind=engine)
+    # Another process created every index between our check and our CREATE INDEX
+    checked = set()
+    has_index = Inspector.has_index
+
+    def stale_has_index(self, table_name, index_name, schema=None):
+        if index_name not in checked:
+            checked.add(index_name)
+            return False
+        return has_index(self, table_name, index_name, schema)
+
+    monkeypatch.setattr(Inspector, "has_index", stale_has_index)
+    assert models.migrate(engine) == []
+    assert inspect(engine).has_index("predictions", "ix_predictions_id")
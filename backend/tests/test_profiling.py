@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import profiling
+from profiling import SamplingProfiler, run_in_threadpool
+
+
+def spin(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def sampled_work():
+    spin(0.3)
+
+
+def unsampled_work(stop):
+    while not stop.is_set():
+        spin(0.01)
+
+
+async def unsampled_request():
+    await run_in_threadpool(unsampled_work_briefly)
+
+
+def unsampled_work_briefly():
+    spin(0.3)
+
+
+def test_only_threads_serving_sampled_requests_are_sampled():
+    profiler = SamplingProfiler()
+    profiler.configure(sample_rate=1.0, interval=0.002)
+    stop = threading.Event()
+    bystander = threading.Thread(target=unsampled_work, args=(stop,))
+    bystander.start()
+
+    async def sampled_request():
+        with profiler.sampled_request():
+            await run_in_threadpool(sampled_work)
+
+    async def main():
+        await asyncio.gather(sampled_request(), unsampled_request())
+
+    try:
+        asyncio.run(main())
+    finally:
+        stop.set()
+        bystander.join()
+        profiler.configure(sample_rate=0)
+
+    _, folded = profiler.dump()
+    assert "sampled_work" in folded
+    assert "unsampled_work" not in folded
+    # Nothing is kept for requests that have finished
+    assert not profiler._loops and not profiling._sampled_threads
+
+
+def test_sync_endpoints_of_sampled_requests_are_sampled(monkeypatch):
+    profiler = SamplingProfiler()
+    monkeypatch.setattr(profiling, "sampler", profiler)
+    app = FastAPI()
+    app.router.route_class = profiling.ProfiledRoute
+    app.add_middleware(profiling.ProfilingMiddleware)
+
+    @app.get("/work")
+    def sync_endpoint_work():
+        spin(0.3)
+        return {}
+
+    profiler.configure(sample_rate=1.0, interval=0.002)
+    try:
+        with TestClient(app) as client:
+            assert client.get("/work").status_code == 200
+    finally:
+        profiler.configure(sample_rate=0)
+
+    assert "sync_endpoint_work" in profiler.dump()[1]
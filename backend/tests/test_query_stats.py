@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+import query_stats
+from database import engine
+
+
+def test_rows_are_counted_for_writes_only(client, db):
+    query_stats.statement_stats.reset()
+    db.execute(text("SELECT id FROM users"))
+    db.execute(text("UPDATE users SET email = email"))
+    db.rollback()
+
+    statements = query_stats.statement_stats.snapshot(top=500)["top_statements"]
+    by_statement = {entry["statement"].split()[0]: entry for entry in statements}
+    assert "rows_affected" not in by_statement["SELECT"]
+    assert by_statement["UPDATE"]["rows_affected"] >= 1
+
+
+class FailingCursor:
+    def __init__(self, executed):
+        self.executed = executed
+        self.description = None
+
+    def execute(self, sql, params=()):
+        self.executed.append(sql)
+        if sql.startswith("SELECT"):
+            raise RuntimeError("plan failed")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+        self.invalidated = self.closed = False
+
+    def cursor(self):
+        return FailingCursor(self.executed)
+
+    def invalidate(self):
+        self.invalidated = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_showplan_switches_off_and_drops_the_connection():
+    connection = FakeConnection()
+    mssql = SimpleNamespace(dialect=SimpleNamespace(name="mssql"), raw_connection=lambda: connection)
+
+    assert query_stats._explain(mssql, "SELECT 1", ()).startswith("EXPLAIN failed")
+    assert connection.executed[-1] == "SET SHOWPLAN_TEXT OFF"
+    assert connection.invalidated and connection.closed
+
+
+def test_sqlite_plan(client):
+    plan = query_stats._explain(engine, "SELECT * FROM users WHERE email = ?", ("x",))
+    assert plan and "users" in plan and not plan.startswith("EXPLAIN failed")
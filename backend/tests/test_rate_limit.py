@@ -0,0 +1,60 @@
+import requests
+
+import app
+import main
+from rate_limit import Quota
+
+
+def test_predictions_over_the_burst_get_429_with_retry_after(client, login, upload, monkeypatch):
+    monkeypatch.setattr(main, "quota_for", lambda username: Quota(60, 2, 1.0))
+    headers, _ = login()
+    image_id = upload(headers)
+
+    responses = [client.post("/predict", json={"image_id": image_id}, headers=headers) for _ in range(3)]
+
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert int(responses[2].headers["Retry-After"]) >= 1
+    assert responses[2].headers["X-RateLimit-Remaining"] == "0"
+
+
+def throttled(status_code=429, retry_after="2"):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers["Retry-After"] = retry_after
+    return requests.exceptions.HTTPError(response=response)
+
+
+def test_batch_client_waits_out_429_without_spending_attempts(monkeypatch):
+    failures = [throttled() for _ in range(app.BATCH_MAX_ATTEMPTS + 2)]
+
+    def post_predict(image_id, token):
+        if failures:
+            raise failures.pop()
+        return {"disease": "healthy", "confidence": 0.9}
+
+    sleeps = []
+    monkeypatch.setattr(app, "prepare_upload", lambda *args, **kwargs: None)
+    monkeypatch.setattr(app, "_post_upload", lambda upload, token, key: {"image": {"id": 1}})
+    monkeypatch.setattr(app, "_post_predict", post_predict)
+    monkeypatch.setattr(app.time, "sleep", sleeps.append)
+
+    result = app.classify_file("leaf.jpg", b"", "image/jpeg", "token", {}, {})
+
+    assert result["status"] == "done"
+    assert sleeps == [2.0] * (app.BATCH_MAX_ATTEMPTS + 2)
+
+
+def test_batch_client_gives_up_once_throttled_too_long(monkeypatch):
+    def post_predict(image_id, token):
+        raise throttled(retry_after="120")
+
+    sleeps = []
+    monkeypatch.setattr(app, "prepare_upload", lambda *args, **kwargs: None)
+    monkeypatch.setattr(app, "_post_upload", lambda upload, token, key: {"image": {"id": 1}})
+    monkeypatch.setattr(app, "_post_predict", post_predict)
+    monkeypatch.setattr(app.time, "sleep", sleeps.append)
+
+    result = app.classify_file("leaf.jpg", b"", "image/jpeg", "token", {}, {})
+
+    assert result["status"] == "failed"
+    assert sum(sleeps) <= app.BATCH_MAX_THROTTLED_SECONDS + 120 * app.BATCH_MAX_ATTEMPTS
@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from database import engine
+from sessions import session_store
+
+
+@contextmanager
+def session_queries():
+    """Collects the SQL statements that touch user_sessions."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "user_sessions" in statement:
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def test_repeat_requests_are_served_from_the_token_cache(client, login):
+    headers, user_id = login()
+    session_store.cache.clear()
+
+    with session_queries() as statements:
+        assert client.get("/images", headers=headers).status_code == 200
+    assert len(statements) == 1
+
+    with session_queries() as statements:
+        for _ in range(3):
+            assert client.get("/images", headers=headers).status_code == 200
+    assert statements == []
+
+
+def test_logout_invalidates_cached_token(client, login):
+    headers, user_id = login()
+    assert client.get("/images", headers=headers).status_code == 200
+
+    token = headers["Authorization"].split()[1]
+    assert client.post("/logout", params={"token": token}).status_code == 200
+    assert client.get("/images", headers=headers).status_code == 401
@@ -0,0 +1,44 @@
+import os
+import threading
+
+import numpy as np
+
+import main
+from similarity import EmbeddingIndex
+
+
+def test_append_racing_the_train_swap_is_kept(tmp_path, monkeypatch):
+    index = EmbeddingIndex(directory=str(tmp_path))
+    rng = np.random.default_rng(0)
+    for image_id in range(200):
+        index.add(image_id, rng.normal(size=16))
+
+    # Another worker appends just as train() swaps in the rewritten file
+    other = EmbeddingIndex(directory=str(tmp_path))
+    writer = threading.Thread(target=other.add, args=(200, rng.normal(size=16)))
+    replace = os.replace
+
+    def racing_replace(source, destination):
+        if destination == index.data_path:
+            writer.start()
+            writer.join(timeout=0.2)
+        replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", racing_replace)
+    index.train(n_lists=4)
+    writer.join()
+
+    assert all(index.get(image_id) is not None for image_id in range(201))
+
+
+def test_embedding_failure_does_not_fail_prediction(client, login, upload, monkeypatch):
+    def broken_add(image_id, embedding):
+        raise ValueError("Embedding has 3 dimensions, index expects 1056")
+
+    monkeypatch.setattr(main.embedding_index, "add", broken_add)
+    headers, _ = login()
+    image_id = upload(headers)
+
+    response = client.post("/predict", json={"image_id": image_id}, headers=headers)
+    assert response.status_code == 200
+    assert client.get(f"/image-details/{image_id}").json()["prediction"]["id"] == response.json()["id"]
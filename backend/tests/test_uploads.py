@@ -0,0 +1,60 @@
+import secrets
+
+import pytest
+from sqlalchemy import event
+
+import archive
+import main
+import models
+from conftest import jpeg_bytes
+from database import engine
+
+
+def post_upload(client, headers, data, key):
+    return client.post("/upload", files={"file": ("leaf.jpg", data, "image/jpeg")},
+                       headers={**headers, "Idempotency-Key": key})
+
+
+def test_retried_upload_returns_the_original(client, login):
+    headers, _ = login()
+    key, data = secrets.token_hex(8), jpeg_bytes()
+
+    first = post_upload(client, headers, data, key).json()
+    retry = post_upload(client, headers, data, key).json()
+    assert retry["upload"]["id"] == first["upload"]["id"]
+
+    assert post_upload(client, headers, jpeg_bytes(), key).status_code == 422
+
+
+def test_expired_key_records_a_new_upload(client, login, monkeypatch):
+    headers, _ = login()
+    key, data = secrets.token_hex(8), jpeg_bytes()
+    first = post_upload(client, headers, data, key).json()
+
+    monkeypatch.setattr(main, "UPLOAD_IDEMPOTENCY_TTL_SECONDS", 0)
+    assert post_upload(client, headers, data, key).json()["upload"]["id"] != first["upload"]["id"]
+
+
+@pytest.fixture
+def foreign_keys_enforced():
+    # SQLite only checks foreign keys when asked to, per connection
+    def enable(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+    event.listen(engine, "connect", enable)
+    engine.dispose()
+    yield
+    event.remove(engine, "connect", enable)
+    engine.dispose()
+
+
+def test_archiving_uploads_removes_their_idempotency_keys(client, db, login, foreign_keys_enforced, tmp_path):
+    headers, _ = login()
+    upload_id = post_upload(client, headers, jpeg_bytes(), secrets.token_hex(8)).json()["upload"]["id"]
+
+    # A negative retention archives everything, including the upload just made
+    deleted, _ = archive.archive_table(db, "image_uploads", retention_days=-1, out_dir=str(tmp_path))
+
+    assert deleted >= 1
+    assert db.get(models.ImageUpload, upload_id) is None
+    assert db.query(models.UploadIdempotencyKey).filter_by(image_upload_id=upload_id).count() == 0
@@ -0,0 +1,98 @@
+"""
+Cheap checks run on an upload before anything is written to disk or the
+database. Only the magic bytes and the image header are inspected (PIL's
+Image.open is lazy and does not decode pixel data), so a corrupt file, a
+non-image or a decompression bomb is turned away without ever being decoded.
+"""
+import io
+import os
+import warnings
+
+from PIL import Image
+
+from metrics import upload_rejections_total
+
+# Limits are configurable per deployment; the model only needs 256x256 input,
+# so the defaults are generous for phone photos and nothing more
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 20 * 1024 * 1024))
+UPLOAD_MAX_PIXELS = int(os.environ.get("UPLOAD_MAX_PIXELS", 40_000_000))
+UPLOAD_MAX_EDGE = int(os.environ.get("UPLOAD_MAX_EDGE", 12000))
+UPLOAD_MIN_EDGE = int(os.environ.get("UPLOAD_MIN_EDGE", 32))
+UPLOAD_ALLOWED_FORMATS = {
+    name.strip().upper() for name in os.environ.get("UPLOAD_ALLOWED_FORMATS", "JPEG,PNG,WEBP,BMP").split(",")
+    if name.strip()
+}
+
+# (offset, signature, PIL format name)
+MAGIC_BYTES = [
+    (0, b"\xff\xd8\xff", "JPEG"),
+    (0, b"\x89PNG\r\n\x1a\n", "PNG"),
+    (8, b"WEBP", "WEBP"),
+    (0, b"GIF87a", "GIF"),
+    (0, b"GIF89a", "GIF"),
+    (0, b"BM", "BMP"),
+    (0, b"II*\x00", "TIFF"),
+    (0, b"MM\x00*", "TIFF"),
+]
+
+# File extension stored uploads get for each accepted format
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "BMP": ".bmp", "GIF": ".gif", "TIFF": ".tif"}
+
+
+class UploadRejected(Exception):
+    def __init__(self, reason, detail, status_code=400):
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+        self.status_code = status_code
+
+
+def sniff_format(header):
+    for offset, signature, image_format in MAGIC_BYTES:
+        if header[offset:offset + len(signature)] == signature:
+            if image_format == "WEBP" and header[:4] != b"RIFF":
+                continue
+            return image_format
+    return None
+
+
+def _reject(reason, detail, status_code=400):
+    upload_rejections_total.inc(reason=reason)
+    raise UploadRejected(reason, detail, status_code)
+
+
+def validate_image_bytes(contents):
+    """
+    Check an upload against the configured limits using only its header.
+    Returns (format, width, height) or raises UploadRejected.
+    """
+    if not contents:
+        _reject("empty", "Uploaded file is empty")
+    if len(contents) > UPLOAD_MAX_BYTES:
+        _reject("too_large", f"File exceeds the {UPLOAD_MAX_BYTES} byte limit", 413)
+
+    sniffed = sniff_format(contents[:16])
+    if sniffed is None:
+        _reject("not_an_image", "File is not a recognised image", 415)
+    if sniffed not in UPLOAD_ALLOWED_FORMATS:
+        _reject("unsupported_format", f"{sniffed} images are not accepted", 415)
+
+    try:
+        with warnings.catch_warnings():
+            # PIL warns (and above 2x its own limit raises) on very large images;
+            # the pixel limit below is the one that applies here
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            with Image.open(io.BytesIO(contents), formats=[sniffed]) as image:
+                width, height = image.size
+    except Image.DecompressionBombError:
+        _reject("too_many_pixels", f"Image exceeds the {UPLOAD_MAX_PIXELS} pixel limit", 413)
+    except Exception:
+        _reject("corrupt_header", "Image header could not be read")
+
+    if width * height > UPLOAD_MAX_PIXELS:
+        _reject("too_many_pixels", f"Image exceeds the {UPLOAD_MAX_PIXELS} pixel limit", 413)
+    if max(width, height) > UPLOAD_MAX_EDGE:
+        _reject("too_wide", f"Image sides must be at most {UPLOAD_MAX_EDGE} pixels", 413)
+    if min(width, height) < UPLOAD_MIN_EDGE:
+        _reject("too_small", f"Image sides must be at least {UPLOAD_MIN_EDGE} pixels")
+    return sniffed, width, height